@@ -0,0 +1,170 @@
+"""
+Micro-benchmark of Backend._save_data: CPU time, peak allocation and size of the public data.json at different
+data sizes.
+
+The current implementation is compared with the previous one, which deep-copied the data, hashed every auth token
+and serialized the sessions twice. Like the current one, the previous one here compresses the public data.json at
+GZIP_LEVEL, so both do the same work. Both must produce the same data.json objects.
+S3 is replaced by the in-memory storage, so only the work done in Python is measured, including the compression.
+Set GZIP_LEVEL to compare compression levels.
+
+Usage: python devtools/bench_save_data.py [--sizes 100 1000 10000] [--repeat 5] [--json]
+"""
+
+import argparse
+import gzip
+import itertools
+import json
+import os
+import sys
+import time
+import tracemalloc
+from copy import deepcopy
+from random import Random
+from typing import Any, Callable, Final
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ["STORAGE"] = "memory"
+
+import main  # pylint: disable=wrong-import-position
+
+PARTICIPANTS_PER_SESSION: Final = 20
+
+
+def make_data(n_users: int, n_sessions: int) -> main.Data:
+    """
+    Synthetic data with n_users users and n_sessions sessions, a tenth of them old and archived
+    """
+    random = Random(n_users * 31 + n_sessions)
+    users = {}
+    for i in range(n_users):
+        user_id = main.make_id()
+        users[user_id] = main.User(
+            user_id=user_id,
+            name=f"User {i}",
+            role="Student" if i % 10 else "Coach",
+            auth_token=main.make_auth_token(random),
+        )
+    user_ids = list(users)
+    now = int(time.time())
+    sessions = {}
+    for i in range(n_sessions):
+        session_id = main.make_id()
+        start_time = main.EpochT(now + (i - n_sessions // 10) * 86400)
+        sessions[session_id] = main.TrainingSession(
+            session_id=session_id,
+            start_time=start_time,
+            end_time=main.EpochT(start_time + 5400),
+            state="archived" if start_time < now else "scheduled",
+            coach=user_ids[0],
+            comment=f"Session {i}",
+            participation={
+                user_id: random.choice(["Yes", "No", "Maybe"])
+                for user_id in random.sample(user_ids, min(PARTICIPANTS_PER_SESSION, n_users))
+            },
+        )
+    return main.Data(users=users, sessions=sessions)
+
+
+def legacy_save_data(data: main.Data, client: main.MemoryS3Client) -> None:
+    """
+    The implementation of Backend._save_data before it avoided copies and repeated serialization
+    """
+    filtered: dict[str, Any] = dict(deepcopy(data))
+    time_now = time.time()
+    for session_id, session in list(filtered["sessions"].items()):
+        if session["state"] == "archived" and session["end_time"] + 43200 < time_now:
+            filtered["sessions"].pop(session_id)
+    client.put_object(main.PRIVATE_BUCKET_NAME, "data.json", json.dumps(filtered).encode("utf-8"))
+    public = filtered | {
+        "users": {
+            user_id: user | {"auth_token": main.hash_token(user["auth_token"])}
+            for user_id, user in filtered["users"].items()
+        }
+    }
+    client.put_object(
+        main.PUBLIC_BUCKET_NAME,
+        "data.json",
+        gzip.compress(json.dumps(public).encode("utf-8"), compresslevel=main.GZIP_LEVEL, mtime=0),
+    )
+
+
+def measure(func: Callable[[], None], repeat: int) -> tuple[float, float]:
+    """
+    Return the best CPU time in ms and the peak allocation in MiB of func
+    """
+    best_ms = float("inf")
+    for _ in range(repeat):
+        start = time.process_time()
+        func()
+        best_ms = min(best_ms, (time.process_time() - start) * 1000)
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return best_ms, peak / 2**20
+
+
+def bench(size: int, repeat: int) -> dict[str, float]:  # pylint: disable=too-many-locals
+    """
+    Benchmark both implementations with size users and size sessions
+    """
+    data = make_data(size, size)
+
+    legacy_client = main.MemoryS3Client()
+    legacy_ms, legacy_mib = measure(lambda: legacy_save_data(data, legacy_client), repeat)
+
+    client = main.MemoryS3Client()
+    main.S3_CLIENT = client
+    main.forget_cached_data()
+    client.put_object(main.PRIVATE_BUCKET_NAME, "data.json", json.dumps(data).encode("utf-8"))
+    backend = main.Backend()
+    # A session in the future, as the expired sessions are removed by the first save
+    sessions = backend._data["sessions"].values()  # pylint: disable=protected-access
+    session = max(sessions, key=lambda session: session["start_time"])
+    comments = itertools.count()
+
+    def save_changed_data() -> None:
+        # Unchanged data would not be written at all
+        session["comment"] = f"Changed {next(comments)}"
+        backend._save_data()  # pylint: disable=protected-access
+
+    current_ms, current_mib = measure(save_changed_data, repeat)
+
+    legacy_save_data(backend._data, legacy_client)  # pylint: disable=protected-access
+    public_body, _ = client.get_object(main.PUBLIC_BUCKET_NAME, "data.json")
+    for bucket in [main.PRIVATE_BUCKET_NAME, main.PUBLIC_BUCKET_NAME]:
+        body, _ = client.get_object(bucket, "data.json")
+        legacy_body, _ = legacy_client.get_object(bucket, "data.json")
+        if bucket == main.PUBLIC_BUCKET_NAME:
+            body, legacy_body = gzip.decompress(body), gzip.decompress(legacy_body)
+        assert json.loads(body) == json.loads(legacy_body), "Different data.json objects"
+    return {
+        "size": size,
+        "legacy_ms": legacy_ms,
+        "current_ms": current_ms,
+        "legacy_peak_mib": legacy_mib,
+        "current_peak_mib": current_mib,
+        "public_kib": len(public_body) / 1024,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--json", action="store_true", help="Print the result as json")
+    args = parser.parse_args()
+    main.logger.setLevel("WARNING")
+
+    results = [bench(size, args.repeat) for size in args.sizes]
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print("Users and sessions  legacy ms  current ms  legacy peak MiB  current peak MiB  public KiB")
+        for result in results:
+            print(
+                f"{result['size']:>18}  {result['legacy_ms']:>9.1f}  {result['current_ms']:>10.1f}"
+                f"  {result['legacy_peak_mib']:>15.2f}  {result['current_peak_mib']:>16.2f}"
+                f"  {result['public_kib']:>10.1f}"
+            )
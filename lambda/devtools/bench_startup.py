@@ -0,0 +1,213 @@
+"""
+Measures the cold start of main.py and fails if it exceeds a budget.
+
+Each sample is a fresh Python process playing the role of a new Lambda instance against the local S3 stand-in
+(see local_s3.py), with and without prewarming (PREWARM, see main.prewarm). It measures:
+
+* import_ms: Importing main.py without prewarming, from `python -X importtime`
+* init_ms: Importing main.py as Lambda does in the INIT phase, including the prewarming if enabled
+* first_response_ms: The first request (any_get_sessions of the coming week)
+* total_ms: init_ms + first_response_ms
+* compile_ms: Compiling main.py, which every cold start pays unless the deployment includes main.py compiled.
+  The other measurements use the compiled main.py.
+
+The slowest modules imported by main.py are listed, and the modules in LAZY_MODULES must not be imported by it.
+
+The exit code is 1 if a median exceeds its budget or a lazy module is imported, so it can run in CI.
+The default budgets are about twice the times on a development machine.
+
+Usage: python devtools/bench_startup.py [--samples 10] [--transport sigv4] [--budget-import-ms 60]
+           [--budget-first-response-ms 20] [--budget-total-ms 120] [--json]
+"""
+
+import argparse
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Final
+
+LAMBDA_DIR: Final = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, LAMBDA_DIR)
+
+from devtools.local_s3 import LocalS3Server  # pylint: disable=wrong-import-position
+
+TEST_SECRET: Final = "bench-secret"
+
+# Only needed by some actions or storages. Importing main.py must not import them
+LAZY_MODULES: Final = ("botocore", "http.client", "zoneinfo", "concurrent.futures", "uuid", "tempfile", "csv")
+
+IMPORTTIME_PATTERN: Final = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)")
+
+# Executed in the measured processes. Prints the timings as json. Nothing but main.py is imported before.
+CHILD_CODE: Final = """
+import json, time
+start = time.perf_counter()
+import main
+init_ms = (time.perf_counter() - start) * 1000
+now = int(time.time())
+start = time.perf_counter()
+response = main.lambda_handler({"action": "any_get_sessions", "start_time": now, "end_time": now + 7 * 86400}, None)
+first_response_ms = (time.perf_counter() - start) * 1000
+assert response["statusCode"] == 200, response
+print(json.dumps({"init_ms": init_ms, "first_response_ms": first_response_ms}))
+"""
+
+
+def measure_import(environment: dict[str, str]) -> tuple[float, dict[str, float], list[str]]:
+    """
+    Return the import time of main.py in ms, the self time in ms of the modules it imported and the imported
+    modules of LAZY_MODULES
+    """
+    completed = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import main"],
+        env=environment | {"PREWARM": "0"},
+        cwd=LAMBDA_DIR,
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+    # The imports are listed as a tree, each module after the modules it imported. Top level modules are indented
+    # by one space. The modules before main.py are those of the interpreter.
+    modules: dict[str, float] = {}
+    for line in completed.stderr.splitlines():
+        if not (match := IMPORTTIME_PATTERN.match(line)):
+            continue
+        self_us, cumulative_us, indent, module = match.groups()
+        if module == "main":
+            return int(cumulative_us) / 1000, modules, [name for name in LAZY_MODULES if name in modules]
+        modules[module] = int(self_us) / 1000
+        if len(indent) == 1:
+            modules = {}
+    raise AssertionError("main.py not found in the output of -X importtime")
+
+
+def measure_compile(n_samples: int) -> float:
+    """
+    Return the median time in ms to compile main.py
+    """
+    with open(os.path.join(LAMBDA_DIR, "main.py"), encoding="utf-8") as file:
+        source = file.read()
+    samples = []
+    for _ in range(n_samples):
+        start = time.perf_counter()
+        compile(source, "main.py", "exec", dont_inherit=True)
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples)
+
+
+def run_benchmark(n_samples: int, transport: str) -> dict[str, Any]:
+    """
+    Return the medians of the samples
+    """
+    server = LocalS3Server()
+    server.start()
+    # The compiled modules are kept in a separate directory, also if the environment disables writing them
+    pycache_prefix = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+    environment = {key: value for key, value in os.environ.items() if key != "PYTHONDONTWRITEBYTECODE"}
+    environment |= server.environment("bench-public", "bench-private") | {
+        "TEST_SECRET": TEST_SECRET,
+        "S3_TRANSPORT": transport,
+        "AWS_LAMBDA_FUNCTION_NAME": "bench",
+        "TRACING": "0",
+        "PYTHONPYCACHEPREFIX": pycache_prefix.name,
+    }
+    # Create data.json. Also compiles the imported modules
+    subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            "import main; main.lambda_handler({'action': 'any_reset_test_setup', 'test_secret': %r}, None)"
+            % TEST_SECRET,
+        ],
+        env=environment | {"PREWARM": "0"},
+        cwd=LAMBDA_DIR,
+        check=True,
+        capture_output=True,
+    )
+
+    import_samples = [measure_import(environment) for _ in range(n_samples)]
+    slowest_modules = sorted(
+        (
+            (module, statistics.median(sample[1].get(module, 0.0) for sample in import_samples))
+            for module in import_samples[0][1]
+        ),
+        key=lambda item: -item[1],
+    )
+    result: dict[str, Any] = {
+        "import_ms": statistics.median(sample[0] for sample in import_samples),
+        "compile_ms": measure_compile(n_samples),
+        "slowest_modules": dict(slowest_modules[:10]),
+        "lazy_modules_imported": import_samples[0][2],
+    }
+    for prewarm in ["1", "0"]:
+        samples = []
+        for _ in range(n_samples):
+            completed = subprocess.run(
+                [sys.executable, "-c", CHILD_CODE],
+                env=environment | {"PREWARM": prewarm},
+                cwd=LAMBDA_DIR,
+                check=True,
+                capture_output=True,
+                text=True,
+            )
+            sample = json.loads(completed.stdout.strip().splitlines()[-1])
+            sample["total_ms"] = sample["init_ms"] + sample["first_response_ms"]
+            samples.append(sample)
+        result["prewarm" if prewarm == "1" else "no_prewarm"] = {
+            key: statistics.median(sample[key] for sample in samples) for key in samples[0]
+        }
+    server.shutdown()
+    pycache_prefix.cleanup()
+    return result
+
+
+def check_budget(result: dict[str, Any], arguments: argparse.Namespace) -> list[str]:
+    """
+    Return the exceeded budgets
+    """
+    exceeded = []
+    for name, value, budget in [
+        ("import_ms", result["import_ms"], arguments.budget_import_ms),
+        ("first_response_ms", result["prewarm"]["first_response_ms"], arguments.budget_first_response_ms),
+        ("total_ms", result["prewarm"]["total_ms"], arguments.budget_total_ms),
+    ]:
+        if value > budget:
+            exceeded.append(f"{name} {value:.1f} > {budget}")
+    if result["lazy_modules_imported"]:
+        exceeded.append(f"main.py imports {', '.join(result['lazy_modules_imported'])}")
+    return exceeded
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--samples", type=int, default=10)
+    parser.add_argument("--transport", default="sigv4", help="S3_TRANSPORT of the measured processes")
+    parser.add_argument("--budget-import-ms", type=float, default=60)
+    parser.add_argument("--budget-first-response-ms", type=float, default=20)
+    parser.add_argument("--budget-total-ms", type=float, default=120)
+    parser.add_argument("--json", action="store_true", help="Print the result as json")
+    args = parser.parse_args()
+
+    benchmark = run_benchmark(args.samples, args.transport)
+    failures = check_budget(benchmark, args)
+    if args.json:
+        print(json.dumps(benchmark | {"exceeded": failures}, indent=2))
+    else:
+        print(f"Median of {args.samples} cold starts with S3_TRANSPORT={args.transport}")
+        print(f"import_ms (without prewarming): {benchmark['import_ms']:.1f}")
+        print(f"compile_ms (without the compiled main.py): {benchmark['compile_ms']:.1f}")
+        columns = ["init_ms", "first_response_ms", "total_ms"]
+        print(f"{'':<12}" + "".join(f"{column:>18}" for column in columns))
+        for mode in ["prewarm", "no_prewarm"]:
+            print(f"{mode:<12}" + "".join(f"{benchmark[mode][column]:>18.1f}" for column in columns))
+        print("Slowest modules imported by main.py (self ms):")
+        for module_name, module_ms in benchmark["slowest_modules"].items():
+            print(f"  {module_name:<30}{module_ms:>8.2f}")
+        for failure in failures:
+            print(f"Budget exceeded: {failure}")
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,459 @@
+"""
+Benchmark of every action at club scale: latency percentiles, S3 traffic and peak memory.
+
+A synthetic club is generated with the given number of users, training sessions per week and years of history,
+and stored in the in-memory storage (STORAGE=memory) or the local S3 stand-in (see local_s3.py, using the sigv4
+transport). Each action is then sent to lambda_handler a number of times on a warm instance, like on Lambda.
+It reports per action:
+
+* p50_ms, p95_ms, p99_ms and max_ms: the latency of lambda_handler
+* s3_gets, s3_puts, bytes_read and bytes_written: the S3 traffic per request
+* peak_mib: the peak memory allocated by one request (measured separately with tracemalloc)
+
+Use --users with several values to see how the actions scale with the size of data.json.
+Use --json to get a machine readable result, e.g. for comparing commits.
+
+Usage: python devtools/bench_suite.py [--users 100 1000] [--sessions-per-week 6] [--years 2] [--iterations 20]
+                                      [--storage memory|local-s3] [--cold] [--json]
+"""
+
+import argparse
+import datetime
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+from random import Random
+from typing import TYPE_CHECKING, Any, Callable, Final, TypedDict
+
+LAMBDA_DIR: Final = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, LAMBDA_DIR)
+
+from devtools.local_s3 import LocalS3Server  # pylint: disable=wrong-import-position
+
+if TYPE_CHECKING:
+    import main
+
+WEEKS_AHEAD: Final = 4  # Sessions are scheduled this far ahead
+MAX_PARTICIPANTS: Final = 30  # Participants of a session in the history
+
+# Actions that are not benchmarked and why
+SKIPPED_ACTIONS: Final = {
+    "any_reset_test_setup": "Replaces the generated data",
+    "admin_compact_journal": "Part of the mutating actions with SAVE_MODE=journal",
+}
+
+
+class ClubT(TypedDict):
+    """
+    The generated users and sessions the requests refer to
+    """
+
+    admin_token: str
+    coach_id: str
+    coach_token: str
+    student_ids: list[str]
+    student_tokens: list[str]
+    scheduled_session_ids: list[str]
+    current_session_id: str  # A session that has started, so participation can be registered
+    deletable_user_ids: list[str]  # One per iteration of admin_delete_user
+
+
+class CountingS3Client:
+    """
+    S3Client counting the calls and bytes of another S3Client
+    """
+
+    def __init__(self, client: "main.S3Client") -> None:
+        self._client: Final = client
+        self.counts = {"s3_gets": 0, "s3_puts": 0, "bytes_read": 0, "bytes_written": 0}
+
+    def get_object(self, bucket: str, key: str, if_none_match: str | None = None) -> tuple[bytes, str]:
+        """
+        See main.S3Client
+        """
+        self.counts["s3_gets"] += 1
+        body, etag = self._client.get_object(bucket, key, if_none_match=if_none_match)
+        self.counts["bytes_read"] += len(body)
+        return body, etag
+
+    def put_object(  # pylint: disable=too-many-arguments
+        self,
+        bucket: str,
+        key: str,
+        body: bytes,
+        if_match: str | None = None,
+        if_none_match: str | None = None,
+        **kwargs: Any,
+    ) -> str:
+        """
+        See main.S3Client
+        """
+        self.counts["s3_puts"] += 1
+        self.counts["bytes_written"] += len(body)
+        return self._client.put_object(bucket, key, body, if_match=if_match, if_none_match=if_none_match, **kwargs)
+
+    def create_multipart_upload(self, bucket: str, key: str, *, content_type: str | None = None) -> str:
+        """
+        See main.S3Client
+        """
+        return self._client.create_multipart_upload(bucket, key, content_type=content_type)
+
+    def upload_part(  # pylint: disable=too-many-arguments,too-many-positional-arguments
+        self, bucket: str, key: str, upload_id: str, part_number: int, body: bytes
+    ) -> str:
+        """
+        See main.S3Client. Counted as a PUT.
+        """
+        self.counts["s3_puts"] += 1
+        self.counts["bytes_written"] += len(body)
+        return self._client.upload_part(bucket, key, upload_id, part_number, body)
+
+    def complete_multipart_upload(self, bucket: str, key: str, upload_id: str, part_etags: list[str]) -> str:
+        """
+        See main.S3Client
+        """
+        return self._client.complete_multipart_upload(bucket, key, upload_id, part_etags)
+
+    def abort_multipart_upload(self, bucket: str, key: str, upload_id: str) -> None:
+        """
+        See main.S3Client
+        """
+        self._client.abort_multipart_upload(bucket, key, upload_id)
+
+    def presign_get_object(self, bucket: str, key: str, expires_in: int) -> str | None:
+        """
+        See main.S3Client
+        """
+        return self._client.presign_get_object(bucket, key, expires_in)
+
+
+def make_club(  # pylint: disable=too-many-locals
+    n_users: int, sessions_per_week: int, years: int, n_iterations: int, random: Random
+) -> tuple["main.Data", dict[str, dict[str, "main.Participation"]], ClubT]:
+    """
+    Generate data.json and the history partitions of a club.
+
+    5% of the users are coaches. The sessions of the past years are in the history; data.json holds the sessions of
+    the next WEEKS_AHEAD weeks and one that is in progress.
+    """
+    users: dict[str, main.User] = {}
+    for i in range(n_users + n_iterations + 1):
+        user_id = main.make_id()
+        role: main.RoleT = "Admin" if i == 0 else "Coach" if i % 20 == 1 else "Student"
+        users[user_id] = main.User(
+            user_id=user_id, name=f"Member {i}", role=role, auth_token=main.make_auth_token(random)
+        )
+    user_ids = list(users)
+    admin_id, deletable_user_ids, member_ids = user_ids[0], user_ids[1 : n_iterations + 1], user_ids[n_iterations + 1 :]
+    coach_ids = [user_id for user_id in member_ids if users[user_id]["role"] == "Coach"] or [admin_id]
+    student_ids = [user_id for user_id in member_ids if users[user_id]["role"] == "Student"]
+
+    now = int(time.time())
+    week_start = now - now % 604800
+    interval = 604800 // sessions_per_week
+
+    def make_session(start_time: int) -> "main.TrainingSession":
+        coach_id = random.choice(coach_ids)
+        session = main.make_training_session(
+            main.EpochT(start_time), main.EpochT(start_time + 5400), coach_id, "Generated session"
+        )
+        for user_id in random.sample(student_ids, min(len(student_ids), random.randint(5, MAX_PARTICIPANTS))):
+            session["participation"][user_id] = random.choice(["Yes", "No", "Maybe"])
+        return session
+
+    sessions = {}
+    for start_time in range(week_start + 604800, week_start + 604800 * (WEEKS_AHEAD + 1), interval):
+        session = make_session(start_time)
+        sessions[session["session_id"]] = session
+    current_session = make_session(now - 600)
+    sessions[current_session["session_id"]] = current_session
+
+    histories: dict[str, dict[str, main.Participation]] = {}
+    for start_time in range(week_start - 604800 * 52 * years, week_start, interval):
+        session = make_session(start_time)
+        session["state"] = "archived"
+        participants = sorted(user_id for user_id, joining in session["participation"].items() if joining == "Yes")
+        partition = main.history_partition(start_time)
+        histories.setdefault(partition, {})[session["session_id"]] = main.Participation(
+            session=session, participants=participants
+        )
+
+    club = ClubT(
+        admin_token=users[admin_id]["auth_token"],
+        coach_id=coach_ids[0],
+        coach_token=users[coach_ids[0]]["auth_token"],
+        student_ids=student_ids,
+        student_tokens=[users[user_id]["auth_token"] for user_id in student_ids],
+        scheduled_session_ids=[session_id for session_id in sessions if session_id != current_session["session_id"]],
+        current_session_id=current_session["session_id"],
+        deletable_user_ids=deletable_user_ids,
+    )
+    return main.Data(users=users, sessions=sessions), histories, club
+
+
+def store_club(
+    client: "main.S3Client", data: "main.Data", histories: dict[str, dict[str, "main.Participation"]]
+) -> int:
+    """
+    Write the generated club to the storage. Returns the size of data.json.
+    """
+    body = json.dumps(data).encode("utf-8")
+    client.put_object(main.PRIVATE_BUCKET_NAME, "data.json", body)
+    for partition, history in histories.items():
+        client.put_object(main.PRIVATE_BUCKET_NAME, main.history_key(partition), json.dumps(history).encode("utf-8"))
+        attendance = json.dumps(main.make_monthly_attendance(history)).encode("utf-8")
+        client.put_object(main.PRIVATE_BUCKET_NAME, main.attendance_key(partition), attendance)
+    manifest = main.HistoryManifestT(partitions=sorted(histories))
+    client.put_object(main.PRIVATE_BUCKET_NAME, main.HISTORY_MANIFEST_KEY, json.dumps(manifest).encode("utf-8"))
+    return len(body)
+
+
+def make_requests(club: ClubT) -> dict[str, Callable[[int], dict[str, Any]]]:
+    """
+    Return a function per benchmark creating the request of an iteration. Each iteration changes something.
+    """
+    admin, coach = {"auth_token": club["admin_token"]}, {"auth_token": club["coach_token"]}
+    student_id, student_token = club["student_ids"][0], club["student_tokens"][0]
+    session_ids = club["scheduled_session_ids"]
+    now = int(time.time())
+    first_day = datetime.date.today() + datetime.timedelta(days=7 * (WEEKS_AHEAD + 2))
+
+    def add_session(i: int) -> dict[str, Any]:
+        # After the sessions added by coach_add_recurring_sessions
+        start_time = now + 86400 * 365 * 10 + 3600 * i
+        return {
+            "action": "coach_add_training_session",
+            "start_time": start_time,
+            "end_time": start_time + 1800,
+            "coach": club["coach_id"],
+            "comment": f"Added {i}",
+        }
+
+    return {
+        "admin_create_user": lambda i: admin | {"action": "admin_create_user", "name": f"New {i}", "role": "Student"},
+        "admin_update_user": lambda i: admin
+        | {"action": "admin_update_user", "user_id": student_id, "name": f"Renamed {i}", "role": "Student"},
+        "admin_delete_user": lambda i: admin
+        | {"action": "admin_delete_user", "user_id": club["deletable_user_ids"][i]},
+        "admin_show_auth_token": lambda i: admin | {"action": "admin_show_auth_token", "user_id": student_id},
+        "admin_migrate_participation_history": lambda i: admin | {"action": "admin_migrate_participation_history"},
+        "admin_rebuild_attendance_summary": lambda i: admin | {"action": "admin_rebuild_attendance_summary"},
+        "any_trigger_initialization": lambda i: {"action": "any_trigger_initialization"},
+        "any_describe_api": lambda i: {"action": "any_describe_api"},
+        "any_get_sessions": lambda i: {
+            "action": "any_get_sessions",
+            "start_time": now,
+            "end_time": now + 7 * 86400,
+            "states": ["scheduled"],
+        },
+        "any_register_participation": lambda i: {
+            "action": "any_register_participation",
+            "joining_sessions": {session_ids[i % len(session_ids)]: ["Yes", "No"][i % 2]},
+            "user_auth_tokens": [student_token],
+        },
+        "any_batch": lambda i: coach
+        | {"action": "any_batch", "actions": [add_session(1000 + 10 * i + j) for j in range(10)]},
+        "coach_add_training_session": lambda i: coach | add_session(i),
+        "coach_add_training_session[replay]": lambda i: coach | add_session(-1) | {"request_id": "bench-replay"},
+        "coach_add_recurring_sessions": lambda i: coach
+        | {
+            "action": "coach_add_recurring_sessions",
+            "weekday": 6,
+            "time_of_day": "08:00",
+            "duration": 3600,
+            "first_date": (first_day + datetime.timedelta(weeks=10 * i)).isoformat(),
+            "last_date": (first_day + datetime.timedelta(weeks=10 * i + 9)).isoformat(),
+            "coach": club["coach_id"],
+            "comment": f"Recurring {i}",
+        },
+        "coach_update_training_session": lambda i: coach
+        | {
+            "action": "coach_update_training_session",
+            "session_id": session_ids[0],
+            "start_time": now + 86400 * 400,
+            "end_time": now + 86400 * 400 + 5400,
+            "coach": club["coach_id"],
+            "comment": f"Updated {i}",
+        },
+        "coach_update_training_session[state]": lambda i: coach
+        | {
+            "action": "coach_update_training_session",
+            "session_id": session_ids[1],
+            "session_state": ["cancelled", "scheduled"][i % 2],
+        },
+        "coach_register_participation": lambda i: coach
+        | {
+            "action": "coach_register_participation",
+            "session_id": club["current_session_id"],
+            "participants": club["student_ids"][: i % MAX_PARTICIPANTS + 1],
+        },
+        "coach_get_historical_participation": lambda i: coach
+        | {"action": "coach_get_historical_participation", "start_time": now - 86400 * 365, "end_time": now},
+        "coach_get_historical_participation[page]": lambda i: coach
+        | {
+            "action": "coach_get_historical_participation",
+            "start_time": now - 86400 * 365,
+            "end_time": now,
+            "limit": 50,
+        },
+        "coach_get_attendance_summary": lambda i: coach
+        | {"action": "coach_get_attendance_summary", "since": now - 86400 * 90},
+        "coach_export_participation": lambda i: coach
+        | {"action": "coach_export_participation", "start_time": now - 86400 * 365, "end_time": now},
+        "coach_get_attendance_stats": lambda i: coach
+        | {
+            "action": "coach_get_attendance_stats",
+            "start_time": now - 86400 * 365,
+            "end_time": now,
+            "group_by": ["user", "coach", "weekday"][i % 3],
+        },
+    }
+
+
+def percentile(sorted_values: list[float], fraction: float) -> float:
+    """
+    The value below which the fraction of the sorted values fall (nearest rank)
+    """
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def run_action(  # pylint: disable=too-many-locals
+    client: CountingS3Client, make_request: Callable[[int], dict[str, Any]], n_iterations: int, cold: bool
+) -> dict[str, Any]:
+    """
+    Send the requests of a benchmark to lambda_handler and summarize the measurements
+    """
+    latencies_ms = []
+    errors = []
+    counts_before = dict(client.counts)
+    for i in range(n_iterations):
+        request = make_request(i)
+        if cold:
+            main.forget_cached_data()
+        start = time.perf_counter()
+        response = main.lambda_handler(request, None)  # type: ignore[arg-type, unused-ignore]
+        latencies_ms.append((time.perf_counter() - start) * 1000)
+        if response["statusCode"] != 200:
+            errors.append(response["body"])
+    counts = {key: (count - counts_before[key]) / n_iterations for key, count in client.counts.items()}
+
+    # Measured separately as tracemalloc slows down the execution considerably
+    tracemalloc.start()
+    main.lambda_handler(make_request(n_iterations), None)  # type: ignore[arg-type, unused-ignore]
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    latencies_ms.sort()
+    return (
+        {
+            "p50_ms": percentile(latencies_ms, 0.50),
+            "p95_ms": percentile(latencies_ms, 0.95),
+            "p99_ms": percentile(latencies_ms, 0.99),
+            "max_ms": latencies_ms[-1],
+            "mean_ms": statistics.fmean(latencies_ms),
+        }
+        | counts
+        | {
+            "peak_mib": peak / 2**20,
+            "errors": len(errors),
+            "first_error": errors[0] if errors else None,
+        }
+    )
+
+
+def run_benchmark(  # pylint: disable=too-many-arguments,too-many-positional-arguments
+    n_users: int, sessions_per_week: int, years: int, n_iterations: int, cold: bool, seed: int
+) -> dict[str, Any]:
+    """
+    Benchmark all actions on a freshly generated club
+    """
+    main.S3_CLIENT = None
+    client = CountingS3Client(main.create_s3_client())
+    main.S3_CLIENT = client
+    main.forget_cached_data()
+
+    # One more iteration per action is used for measuring the memory
+    data, histories, club = make_club(n_users, sessions_per_week, years, n_iterations + 1, Random(seed))
+    data_json_bytes = store_club(client, data, histories)
+    requests = make_requests(club)
+
+    missing = set(main.ACTIONS) - {name.split("[")[0] for name in requests} - set(SKIPPED_ACTIONS)
+    assert not missing, f"No benchmark for the actions {missing}"
+
+    main.lambda_handler({"action": "any_trigger_initialization"}, None)  # type: ignore[arg-type, unused-ignore]
+    return {
+        "dataset": {
+            "users": len(data["users"]),
+            "sessions": len(data["sessions"]),
+            "history_sessions": sum(len(history) for history in histories.values()),
+            "history_partitions": len(histories),
+            "data_json_bytes": data_json_bytes,
+        },
+        "actions": {
+            name: run_action(client, make_request, n_iterations, cold) for name, make_request in requests.items()
+        },
+    }
+
+
+def git_commit() -> str | None:
+    """
+    The commit of the working tree, for comparing runs
+    """
+    try:
+        completed = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=LAMBDA_DIR, capture_output=True, text=True, check=True
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return completed.stdout.strip()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, nargs="+", default=[100, 1000])
+    parser.add_argument("--sessions-per-week", type=int, default=6)
+    parser.add_argument("--years", type=int, default=2)
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--storage", choices=["memory", "local-s3"], default="memory")
+    parser.add_argument("--cold", action="store_true", help="Drop the cached data.json before each request")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", action="store_true", help="Print the result as json")
+    args = parser.parse_args()
+
+    # main reads the configuration when imported
+    if args.storage == "memory":
+        os.environ["STORAGE"] = "memory"
+    else:
+        server = LocalS3Server()
+        server.start()
+        os.environ.update(server.environment("bench-public", "bench-private") | {"S3_TRANSPORT": "sigv4"})
+    import main  # pylint: disable=wrong-import-position,redefined-outer-name
+
+    main.logger.setLevel("WARNING")
+
+    result: dict[str, Any] = {
+        "commit": git_commit(),
+        "parameters": {key: value for key, value in vars(args).items() if key != "json"},
+        "runs": [
+            run_benchmark(n_users, args.sessions_per_week, args.years, args.iterations, args.cold, args.seed)
+            for n_users in args.users
+        ],
+    }
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        columns = ["p50_ms", "p95_ms", "p99_ms", "s3_gets", "s3_puts", "bytes_read", "bytes_written", "peak_mib"]
+        for run in result["runs"]:
+            print(", ".join(f"{key}: {value}" for key, value in run["dataset"].items()))
+            print(f"{'action':<42}" + "".join(f"{column:>14}" for column in columns) + "  errors")
+            for name, measurements in run["actions"].items():
+                print(
+                    f"{name:<42}"
+                    + "".join(f"{measurements[column]:>14.1f}" for column in columns)
+                    + f"  {measurements['errors'] or ''}"
+                )
+            print()
@@ -0,0 +1,129 @@
+"""
+Compares the cold start of the two S3 transports selectable with S3_TRANSPORT ("botocore" and "sigv4").
+
+Each sample is a fresh Python process playing the role of a cold Lambda instance against the local S3 stand-in
+(see local_s3.py). It measures:
+
+* import_ms: importing main.py
+* client_ms: create_s3_client()
+* first_request_ms: the first request ("any_trigger_initialization", i.e. reading data.json)
+* warm_request_ms: the same request again on the warm instance
+* process_ms: the wall time of the whole process as seen from the outside
+
+Usage: python devtools/bench_transport.py [--samples 10] [--json]
+"""
+
+import argparse
+import json
+import logging
+import os
+import statistics
+import subprocess
+import sys
+import time
+from typing import Any, Final
+
+LAMBDA_DIR: Final = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, LAMBDA_DIR)
+
+from devtools.local_s3 import LocalS3Server  # pylint: disable=wrong-import-position
+
+TRANSPORTS: Final = ("botocore", "sigv4")
+TEST_SECRET: Final = "bench-secret"
+
+
+def run_child() -> None:
+    """
+    Executed in the measured process. Prints the timings as json.
+    """
+    timings: dict[str, Any] = {}
+    start = time.perf_counter()
+    import main  # pylint: disable=import-outside-toplevel
+
+    timings["import_ms"] = (time.perf_counter() - start) * 1000
+    logging.getLogger().setLevel(logging.WARNING)
+
+    start = time.perf_counter()
+    main.create_s3_client()
+    timings["client_ms"] = (time.perf_counter() - start) * 1000
+
+    request = {"action": "any_trigger_initialization"}
+    for name in ["first_request_ms", "warm_request_ms"]:
+        start = time.perf_counter()
+        response = main.lambda_handler(request, None)  # type: ignore[arg-type, unused-ignore]
+        timings[name] = (time.perf_counter() - start) * 1000
+        assert response["statusCode"] == 200, response
+
+    timings["botocore_imported"] = "botocore" in sys.modules
+    print(json.dumps(timings))
+
+
+def run_benchmark(n_samples: int) -> dict[str, dict[str, Any]]:
+    """
+    Returns the median timings per transport
+    """
+    server = LocalS3Server()
+    server.start()
+    environment = os.environ | server.environment("bench-public", "bench-private") | {"TEST_SECRET": TEST_SECRET}
+
+    # Create data.json
+    subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            "import main; main.lambda_handler({'action': 'any_reset_test_setup', 'test_secret': %r}, None)"
+            % TEST_SECRET,
+        ],
+        env=environment | {"S3_TRANSPORT": "sigv4"},
+        cwd=LAMBDA_DIR,
+        check=True,
+        capture_output=True,
+    )
+
+    results = {}
+    for transport in TRANSPORTS:
+        samples = []
+        for _ in range(n_samples):
+            start = time.perf_counter()
+            completed = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), "--child"],
+                env=environment | {"S3_TRANSPORT": transport},
+                cwd=LAMBDA_DIR,
+                check=True,
+                capture_output=True,
+                text=True,
+            )
+            sample = json.loads(completed.stdout.strip().splitlines()[-1])
+            sample["process_ms"] = (time.perf_counter() - start) * 1000
+            samples.append(sample)
+        results[transport] = {
+            key: (statistics.median(sample[key] for sample in samples) if key.endswith("_ms") else samples[0][key])
+            for key in samples[0]
+        }
+    server.shutdown()
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--samples", type=int, default=10)
+    parser.add_argument("--json", action="store_true", help="Print the result as json")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        run_child()
+        sys.exit(0)
+
+    medians = run_benchmark(args.samples)
+    if args.json:
+        print(json.dumps(medians, indent=2))
+    else:
+        columns = ["import_ms", "client_ms", "first_request_ms", "warm_request_ms", "process_ms"]
+        print(f"Median of {args.samples} cold starts")
+        print(f"{'transport':<10}" + "".join(f"{column:>18}" for column in columns) + "  botocore imported")
+        for transport_name, medians_ms in medians.items():
+            print(
+                f"{transport_name:<10}"
+                + "".join(f"{medians_ms[column]:>18.1f}" for column in columns)
+                + f"  {medians_ms['botocore_imported']}"
+            )
@@ -0,0 +1,225 @@
+"""
+Checks that concurrent Lambda instances do not lose each others updates.
+
+Every worker process plays the role of a separate Lambda instance sharing the same local S3 (see local_s3.py).
+All workers fire mutating actions at the same time:
+
+* "coach_add_training_session" with a comment that identifies the worker and round
+* "any_register_participation" for a user owned by the worker
+
+Afterwards the final data.json must contain every added session and the last registration of every worker,
+and the public manifest.json must list its version.
+Set SAVE_MODE=journal to check the journal instead.
+
+Usage: python devtools/concurrency_harness.py [--workers 8] [--rounds 10]
+"""
+
+import argparse
+import gzip
+import json
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from multiprocessing.synchronize import Barrier
+from typing import Any, TypedDict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from devtools.local_s3 import LocalS3Server  # pylint: disable=wrong-import-position
+
+PUBLIC_BUCKET_NAME = "harness-public"
+PRIVATE_BUCKET_NAME = "harness-private"
+TEST_SECRET = "harness-secret"
+
+WORKER_BARRIER: Barrier | None = None
+
+
+class WorkerTaskT(TypedDict):
+    """
+    The work done by a single worker
+    """
+
+    worker: int
+    rounds: int
+    coach_id: str
+    coach_auth_token: str
+    user_auth_token: str
+    session_ids: list[str]
+
+
+class WorkerResultT(TypedDict):
+    """
+    What a worker did
+    """
+
+    worker: int
+    added_session_ids: list[str]
+    last_joining: dict[str, str]  # session_id -> last registered value
+    failures: list[str]
+
+
+def configure_environment(environment: dict[str, str], barrier: Barrier | None = None) -> None:
+    """
+    Make main.py use the local S3. Must be called before main is imported.
+    """
+    global WORKER_BARRIER  # pylint: disable=global-statement
+    WORKER_BARRIER = barrier
+    os.environ.update(environment)
+
+
+def invoke(data: dict[str, Any]) -> tuple[int, Any]:
+    """
+    Call the lambda handler as AWS would
+    """
+    import main  # pylint: disable=import-outside-toplevel
+
+    response = main.lambda_handler(data, None)  # type: ignore[arg-type, unused-ignore]
+    return response["statusCode"], json.loads(response["body"])
+
+
+def run_worker(task: WorkerTaskT) -> WorkerResultT:
+    """
+    Executed in a worker process
+    """
+    import main  # pylint: disable=import-outside-toplevel
+
+    logging.getLogger().setLevel(logging.WARNING)
+    main.create_s3_client()  # Keep the client creation out of the race
+    if WORKER_BARRIER is not None:
+        WORKER_BARRIER.wait()
+
+    result = WorkerResultT(worker=task["worker"], added_session_ids=[], last_joining={}, failures=[])
+    start_time = int(time.time()) + 86400
+    for round_no in range(task["rounds"]):
+        status, body = invoke(
+            {
+                "action": "coach_add_training_session",
+                "auth_token": task["coach_auth_token"],
+                "start_time": start_time + round_no * 3600,
+                "end_time": start_time + round_no * 3600 + 3600,
+                "coach": task["coach_id"],
+                "comment": f"harness worker {task['worker']} round {round_no}",
+            }
+        )
+        if status == 200:
+            result["added_session_ids"].append(body["session"]["session_id"])
+        else:
+            result["failures"].append(f"coach_add_training_session: {status} {body}")
+
+        joining = {session_id: ("Yes", "No", "Maybe")[round_no % 3] for session_id in task["session_ids"]}
+        status, body = invoke(
+            {
+                "action": "any_register_participation",
+                "joining_sessions": joining,
+                "user_auth_tokens": [task["user_auth_token"]],
+            }
+        )
+        if status == 200:
+            result["last_joining"] = joining
+        else:
+            result["failures"].append(f"any_register_participation: {status} {body}")
+    return result
+
+
+def main_harness(n_workers: int, n_rounds: int) -> int:  # pylint: disable=too-many-locals
+    """
+    Returns the process exit code
+    """
+    server = LocalS3Server()
+    server.start()
+    environment = server.environment(PUBLIC_BUCKET_NAME, PRIVATE_BUCKET_NAME) | {"TEST_SECRET": TEST_SECRET}
+    configure_environment(environment)
+    logging.getLogger().setLevel(logging.WARNING)
+
+    status, body = invoke({"action": "any_reset_test_setup", "test_secret": TEST_SECRET})
+    assert status == 200, body
+
+    def read_data() -> dict[str, Any]:
+        """
+        The private data.json with the newer journal entries applied (SAVE_MODE "journal")
+        """
+        import main  # pylint: disable=import-outside-toplevel
+
+        with server.lock:
+            data = json.loads(server.objects[(PRIVATE_BUCKET_NAME, "data.json")]["body"])
+            user_index, fragments = main.make_user_index(data["users"]), main.make_fragments(data)
+            session_index = main.make_session_index(data["sessions"])
+            while (key := (PRIVATE_BUCKET_NAME, main.journal_key(data.get("version", 0) + 1))) in server.objects:
+                entry = json.loads(server.objects[key]["body"])
+                main.apply_journal_entry(data, user_index, session_index, fragments, entry)
+            return dict(data)
+
+    users = read_data()["users"].values()
+    admin = next(user for user in users if user["role"] == "Admin")
+    coach = next(user for user in users if user["role"] == "Coach")
+    session_ids = list(read_data()["sessions"])
+
+    tasks = []
+    for worker in range(n_workers):
+        status, body = invoke(
+            {
+                "action": "admin_create_user",
+                "auth_token": admin["auth_token"],
+                "name": f"Harness worker {worker}",
+                "role": "Student",
+            }
+        )
+        assert status == 200, body
+        tasks.append(
+            WorkerTaskT(
+                worker=worker,
+                rounds=n_rounds,
+                coach_id=coach["user_id"],
+                coach_auth_token=coach["auth_token"],
+                user_auth_token=body["auth_token"],
+                session_ids=session_ids,
+            )
+        )
+
+    context = get_context("spawn")
+    barrier = context.Barrier(n_workers)
+    start = time.perf_counter()
+    with ProcessPoolExecutor(
+        max_workers=n_workers,
+        mp_context=context,
+        initializer=configure_environment,
+        initargs=(environment, barrier),
+    ) as executor:
+        results = list(executor.map(run_worker, tasks))
+    elapsed = time.perf_counter() - start
+
+    data = read_data()
+    user_ids_by_name = {user["name"]: user_id for user_id, user in data["users"].items()}
+    errors: list[str] = []
+    for result in results:
+        errors.extend(f"worker {result['worker']}: {failure}" for failure in result["failures"])
+        for session_id in result["added_session_ids"]:
+            if session_id not in data["sessions"]:
+                errors.append(f"worker {result['worker']}: lost session {session_id}")
+        user_id = user_ids_by_name[f"Harness worker {result['worker']}"]
+        for session_id, joining in result["last_joining"].items():
+            if (found := data["sessions"][session_id]["participation"].get(user_id)) != joining:
+                errors.append(f"worker {result['worker']}: lost participation {joining} != {found} for {session_id}")
+    with server.lock:
+        manifest = json.loads(gzip.decompress(server.objects[(PUBLIC_BUCKET_NAME, "manifest.json")]["body"]))
+    if manifest["version"] != data["version"]:
+        errors.append(f"public manifest.json has version {manifest['version']} instead of {data['version']}")
+
+    n_actions = 2 * n_workers * n_rounds
+    print(f"{n_actions} mutating actions from {n_workers} concurrent workers in {elapsed:.2f} s")
+    for error in errors:
+        print(f"ERROR: {error}")
+    print("FAILED: updates were lost" if errors else "OK: no updates were lost")
+    server.shutdown()
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--rounds", type=int, default=10)
+    args = parser.parse_args()
+    sys.exit(main_harness(args.workers, args.rounds))
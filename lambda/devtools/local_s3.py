@@ -0,0 +1,268 @@
+"""
+A minimal in-memory stand-in for S3 served over HTTP on localhost.
+
+Only the parts of the S3 REST API used by main.py are implemented: GetObject, HeadObject and PutObject
+with path-style addressing and the conditional headers If-Match and If-None-Match, and the multipart uploads
+(CreateMultipartUpload, UploadPart, CompleteMultipartUpload and AbortMultipartUpload).
+Requests are not authenticated, so any credentials and presigned URLs will do.
+
+Point botocore at it with the environment variable AWS_ENDPOINT_URL_S3=http://127.0.0.1:<port>
+"""
+
+import hashlib
+import os
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Final, TypedDict
+from urllib.parse import parse_qs, unquote, urlsplit
+
+
+class StoredObjectT(TypedDict):
+    """
+    An object stored in the local S3
+    """
+
+    body: bytes
+    etag: str
+    headers: dict[str, str]  # The stored Content-Type etc.
+
+
+class UploadT(TypedDict):
+    """
+    A multipart upload in progress
+    """
+
+    bucket_and_key: tuple[str, str]
+    headers: dict[str, str]  # Given to CreateMultipartUpload
+    parts: dict[int, bytes]  # Part number -> body
+
+
+# Request headers that are stored with the object and returned on GET
+STORED_HEADERS: Final = ("Content-Type", "Content-Encoding", "Cache-Control")
+
+# The minimum size of all parts of a multipart upload but the last
+MIN_PART_SIZE: Final = 5 * 2**20
+
+
+class LocalS3Server(ThreadingHTTPServer):
+    """
+    The HTTP server holding the objects of all buckets
+    """
+
+    daemon_threads = True
+
+    def __init__(self, port: int = 0) -> None:
+        super().__init__(("127.0.0.1", port), LocalS3RequestHandler)
+        self.objects: dict[tuple[str, str], StoredObjectT] = {}
+        self.uploads: dict[str, UploadT] = {}  # Upload id -> upload
+        self.lock = threading.Lock()
+
+    @property
+    def endpoint_url(self) -> str:
+        """
+        The value to use for AWS_ENDPOINT_URL_S3
+        """
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def environment(self, public_bucket_name: str, private_bucket_name: str) -> dict[str, str]:
+        """
+        The environment variables that make main.py use this server
+        """
+        return {
+            "AWS_ENDPOINT_URL_S3": self.endpoint_url,
+            "AWS_ACCESS_KEY_ID": "local",
+            "AWS_SECRET_ACCESS_KEY": "local",
+            "AWS_DEFAULT_REGION": "eu-central-1",
+            "PUBLIC_BUCKET_NAME": public_bucket_name,
+            "PRIVATE_BUCKET_NAME": private_bucket_name,
+        }
+
+    def start(self) -> None:
+        """
+        Serve requests from a background thread
+        """
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+
+class LocalS3RequestHandler(BaseHTTPRequestHandler):
+    """
+    Handles a single path-style S3 request
+    """
+
+    server: LocalS3Server
+    protocol_version = "HTTP/1.1"
+    # Otherwise a kept-alive connection waits for the delayed ACK of the previous response (~40 ms per request)
+    disable_nagle_algorithm = True
+
+    def log_message(self, format: str, *args: object) -> None:  # pylint: disable=redefined-builtin
+        pass
+
+    def _bucket_and_key(self) -> tuple[str, str]:
+        path = unquote(urlsplit(self.path).path)
+        bucket, _, key = path.lstrip("/").partition("/")
+        return bucket, key
+
+    def _query(self) -> dict[str, str]:
+        return {name: values[0] for name, values in parse_qs(urlsplit(self.path).query, keep_blank_values=True).items()}
+
+    def _send_xml(self, body: str) -> None:
+        encoded = f'<?xml version="1.0" encoding="UTF-8"?>\n{body}'.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/xml")
+        self.send_header("Content-Length", str(len(encoded)))
+        self.end_headers()
+        self.wfile.write(encoded)
+
+    def _send_error(self, status: int, code: str) -> None:
+        body = (
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            f"<Error><Code>{code}</Code><Message>{code}</Message><Resource>{self.path}</Resource></Error>"
+        ).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/xml")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def _send_object(self, stored: StoredObjectT) -> None:
+        if (if_match := self.headers.get("If-Match")) is not None and if_match != stored["etag"]:
+            self._send_error(412, "PreconditionFailed")
+            return
+        if self.headers.get("If-None-Match") in ("*", stored["etag"]):
+            self.send_response(304)
+            self.send_header("ETag", stored["etag"])
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("ETag", stored["etag"])
+        self.send_header("Content-Length", str(len(stored["body"])))
+        for name, value in stored["headers"].items():
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(stored["body"])
+
+    def do_GET(self) -> None:  # pylint: disable=invalid-name
+        """
+        GetObject
+        """
+        with self.server.lock:
+            stored = self.server.objects.get(self._bucket_and_key())
+        if stored is None:
+            self._send_error(404, "NoSuchKey")
+        else:
+            self._send_object(stored)
+
+    do_HEAD = do_GET
+
+    def do_PUT(self) -> None:  # pylint: disable=invalid-name
+        """
+        PutObject or UploadPart
+        """
+        body = self.rfile.read(int(self.headers.get("Content-Length", "0")))
+        bucket_and_key = self._bucket_and_key()
+        if "uploadId" in (query := self._query()):
+            self._upload_part(query["uploadId"], int(query["partNumber"]), body)
+            return
+        with self.server.lock:
+            current = self.server.objects.get(bucket_and_key)
+            if (if_match := self.headers.get("If-Match")) is not None:
+                if current is None:
+                    self._send_error(404, "NoSuchKey")
+                    return
+                if current["etag"] != if_match:
+                    self._send_error(412, "PreconditionFailed")
+                    return
+            if self.headers.get("If-None-Match") == "*" and current is not None:
+                self._send_error(412, "PreconditionFailed")
+                return
+            etag = f'"{hashlib.md5(body).hexdigest()}"'
+            self.server.objects[bucket_and_key] = StoredObjectT(
+                body=body,
+                etag=etag,
+                headers={name: value for name in STORED_HEADERS if (value := self.headers.get(name)) is not None},
+            )
+        self.send_response(200)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def _upload_part(self, upload_id: str, part_number: int, body: bytes) -> None:
+        with self.server.lock:
+            if (upload := self.server.uploads.get(upload_id)) is None:
+                self._send_error(404, "NoSuchUpload")
+                return
+            upload["parts"][part_number] = body
+        self.send_response(200)
+        self.send_header("ETag", f'"{hashlib.md5(body).hexdigest()}"')
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_POST(self) -> None:  # pylint: disable=invalid-name
+        """
+        CreateMultipartUpload or CompleteMultipartUpload
+        """
+        body = self.rfile.read(int(self.headers.get("Content-Length", "0")))
+        bucket, key = self._bucket_and_key()
+        query = self._query()
+        if "uploads" in query:
+            upload_id = os.urandom(16).hex()
+            with self.server.lock:
+                self.server.uploads[upload_id] = UploadT(
+                    bucket_and_key=(bucket, key),
+                    headers={name: value for name in STORED_HEADERS if (value := self.headers.get(name)) is not None},
+                    parts={},
+                )
+            self._send_xml(
+                f"<InitiateMultipartUploadResult><Bucket>{bucket}</Bucket><Key>{key}</Key>"
+                f"<UploadId>{upload_id}</UploadId></InitiateMultipartUploadResult>"
+            )
+            return
+        if "uploadId" not in query:
+            self._send_error(400, "InvalidRequest")
+            return
+        part_etags = [etag.replace("&quot;", '"') for etag in re.findall(r"<ETag>([^<]*)</ETag>", body.decode("utf-8"))]
+        with self.server.lock:
+            if (upload := self.server.uploads.get(query["uploadId"])) is None:
+                self._send_error(404, "NoSuchUpload")
+                return
+            parts = [upload["parts"].get(part_number, b"") for part_number in range(1, len(part_etags) + 1)]
+            if not part_etags or any(
+                f'"{hashlib.md5(part).hexdigest()}"' != etag for part, etag in zip(parts, part_etags)
+            ):
+                self._send_error(400, "InvalidPart")
+                return
+            if any(len(part) < MIN_PART_SIZE for part in parts[:-1]):
+                self._send_error(400, "EntityTooSmall")
+                return
+            digests = b"".join(hashlib.md5(part).digest() for part in parts)
+            etag = f'"{hashlib.md5(digests).hexdigest()}-{len(parts)}"'
+            self.server.objects[upload["bucket_and_key"]] = StoredObjectT(
+                body=b"".join(parts), etag=etag, headers=upload["headers"]
+            )
+            del self.server.uploads[query["uploadId"]]
+        escaped_etag = etag.replace('"', "&quot;")
+        self._send_xml(
+            f"<CompleteMultipartUploadResult><Bucket>{bucket}</Bucket><Key>{key}</Key>"
+            f"<ETag>{escaped_etag}</ETag></CompleteMultipartUploadResult>"
+        )
+
+    def do_DELETE(self) -> None:  # pylint: disable=invalid-name
+        """
+        AbortMultipartUpload
+        """
+        with self.server.lock:
+            if self.server.uploads.pop(self._query().get("uploadId", ""), None) is None:
+                self._send_error(404, "NoSuchUpload")
+                return
+        self.send_response(204)
+        self.end_headers()
+
+
+if __name__ == "__main__":
+    server = LocalS3Server(port=9000)
+    print(f"Serving local S3 on {server.endpoint_url}")
+    server.serve_forever()
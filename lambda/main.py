@@ -13,6 +13,9 @@ Every action is refixed with the required role, lower cased, followed by an unde
 The implementation does validation of every request to the endpoint.
 However, it assumes that only valid configurations are ever stored in the S3 objects.
 
+The actions changing data take an optional "request_id" (a string of up to 128 characters). A request repeated
+with the same request_id gets the response of the first one without being executed again. See run_idempotent_action
+
 
 Admin actions
 
@@ -40,6 +43,18 @@ Admin actions
 {"action": "admin_show_auth_token", "auth_token": "tEYhxhie", "user_id": "f8b12140-3e72-4dfa-99f3-3b4486af0018"}
 =>
 {"auth_token": "5635a8d1-b8a1-42f7-af20-4e544b5773ee"}
+
+{"action": "admin_migrate_participation_history", "auth_token": "tEYhxhie"}
+=>
+{"migrated_sessions": 152, "partitions": ["2023-11", "2023-12", "2024-01"]}
+
+{"action": "admin_rebuild_attendance_summary", "auth_token": "tEYhxhie"}
+=>
+{"users": 42}
+
+{"action": "admin_compact_journal", "auth_token": "tEYhxhie"}  // Only with SAVE_MODE "journal"
+=>
+{"version": 318}
 ```
 
 Coach actions
@@ -61,6 +76,28 @@ Coach actions
     "state": "scheduled",
 }
 
+{
+    "action": "coach_add_recurring_sessions", "auth_token": "tEYhxhie",
+    "weekday": 1,  // Monday is 0
+    "time_of_day": "17:00", "duration": 5400,
+    "first_date": "2024-09-03", "last_date": "2025-06-24",
+    "excluded_dates": ["2024-10-15", "2024-12-24"],  // Optional
+    "timezone": "Europe/Copenhagen",  // Optional. This is the default
+    "coach": "df11c4d5-d5a3-4da0-ad96-44aca7519df6",
+    "comment": "Dtaf-Pensumtræning - Træning foregår på squashbanen"
+}
+=>
+{
+    "sessions": [
+        {
+            "session_id": "e3058f7e-4d45-4d55-9047-7f46db2cf9ff",
+            "start_time": 1725375600,
+            // Etc. as for coach_add_training_session
+        },
+        // Etc.
+    ]
+}
+
 {
     "action": "coach_update_training_session", "auth_token": "tEYhxhie",
     "session_id": "e3058f7e-4d45-4d55-9047-7f46db2cf9ff",
@@ -113,6 +150,60 @@ Coach actions
     },
     // Etc.
 }
+
+{
+    "action": "coach_get_historical_participation", "auth_token": "tEYhxhie",
+    "start_time": 1700000000, "end_time": 1727375400,
+    "limit": 100,  // Optional. Page size, at most 1000
+    "cursor": "WzE3MjQ...",  // Optional. The cursor of the previous page, absent for the first page
+}
+=>
+{
+    "sessions": {...},  // Up to limit sessions as above
+    "cursor": "WzE3MjU...",  // The cursor of the next page. null after the last page
+}
+
+{
+    "action": "coach_export_participation", "auth_token": "tEYhxhie",
+    "start_time": 1700000000, "end_time": 1727375400,
+}
+=>
+{
+    // CSV in the private bucket: session_id,start_time,end_time,coach_id,coach_name,comment,user_id,user_name
+    "key": "exports/participation_2023-11_2024-09_5f0c7e6a1b2d3c4e.csv",
+    "url": "https://...",  // Presigned GET of the key, valid for an hour. null for STORAGE file or memory
+}
+
+{
+    "action": "coach_get_attendance_stats", "auth_token": "tEYhxhie",
+    "start_time": 1704067200, "end_time": 1735689600,  // Sessions starting in [start_time, end_time[
+    "group_by": "weekday",  // Optional. "user" (default): In total. "coach": Per coach. "weekday": Monday is 0
+}
+=>
+{
+    "groups": [
+        {
+            "key": 1,  // The coach, the weekday or null for "user". Groups without sessions are left out
+            "sessions": 48,
+            "attendances": 571,
+            "users": {"f8b12140-3e72-4dfa-99f3-3b4486af0018": 31, ...},  // Users with attendance only
+        },
+        // Etc.
+    ]
+}
+
+{"action": "coach_get_attendance_summary", "auth_token": "tEYhxhie", "since": 1719792000}
+=>
+{
+    // User id
+    "f8b12140-3e72-4dfa-99f3-3b4486af0018": {
+        "total": 32,
+        "last_attended": 1727370000,
+        "per_month": {"2024-07": 6, "2024-08": 9, "2024-09": 7},
+        "attended_since": 22,  // Only included if "since" is given
+    },
+    // Etc.
+}
 ```
 
 
@@ -124,6 +215,25 @@ Multi-user actions
 {}
 ```
 
+```
+{
+    "action": "any_get_sessions",
+    "start_time": 1727370000, "end_time": 1727974800,  // Sessions starting in [start_time, end_time[
+    "states": ["scheduled"],  // Optional. All states by default
+}
+=>
+{
+    "sessions": [
+        {
+            "session_id": "e3058f7e-4d45-4d55-9047-7f46db2cf9ff",
+            "start_time": 1727370000,
+            // Etc. as in data.json, sorted by start_time
+        },
+        // Etc.
+    ]
+}
+```
+
 ```
 {
     "action": "any_register_participation",
@@ -137,53 +247,139 @@ Multi-user actions
 {}
 ```
 
+```
+{
+    "action": "any_batch", "auth_token": "tEYhxhie",
+    "mode": "best_effort",  // Optional. "atomic" (default): Nothing is saved if an action fails
+    "actions": [
+        {
+            "action": "coach_add_training_session", "start_time": 1727370000, "end_time": 1727375400,
+            "coach": "df11c4d5-d5a3-4da0-ad96-44aca7519df6", "comment": null
+        },
+        {"action": "admin_delete_user", "user_id": "unknown"},
+    ],
+}
+=>
+{
+    "results": [
+        {"result": {"session": {...}}},
+        {"error": "User with id unknown not found"},
+    ]
+}
+```
+
 ```
 {"action": "any_reset_test_setup", "test_secret": "secret"}
 =>
 {}
 ```
+
+```
+{"action": "any_describe_api"}
+=>
+{
+    "actions": {
+        "admin_delete_user": {
+            "role": "Admin",
+            "description": "Deletes a user",
+            "request": {  // JSON Schema
+                "type": "object",
+                "properties": {
+                    "action": {"const": "admin_delete_user"},
+                    "auth_token": {"type": "string"},
+                    "user_id": {"type": "string"}
+                },
+                "required": ["action", "auth_token", "user_id"]
+            }
+        },
+        // Etc.
+    }
+}
+```
 """
 
 import base64
+import bisect
+import contextvars
 import datetime
 import hashlib
+import hmac
+import itertools
 import json
 import logging
 import os
+import re
 import string
+import threading
 import time
 import unicodedata
-from copy import deepcopy
+import zlib
+from contextlib import contextmanager
 from functools import wraps
 from random import Random, SystemRandom
+from types import UnionType
 from typing import (
     TYPE_CHECKING,
     Any,
     Callable,
     Final,
+    Iterable,
+    Iterator,
     Literal,
     Mapping,
     NewType,
     NotRequired,
+    Protocol,
     TypeAlias,
     TypedDict,
     TypeVar,
     cast,
     get_args,
+    get_origin,
 )
-from uuid import uuid4
+from urllib.parse import quote, unquote, urlsplit
 
-from botocore.exceptions import ClientError
-from botocore.session import Session
+# Modules only needed by some actions or storages are imported where they are used, as importing them all
+# would add to every cold start. Check with devtools/bench_startup.py.
 
 if TYPE_CHECKING:
+    import http.client
+    from concurrent.futures import ThreadPoolExecutor
+
     from aws_lambda_powertools.utilities.typing import LambdaContext
 else:
     LambdaContext = type(None)
 
-PUBLIC_BUCKET_NAME: Final = os.environ["PUBLIC_BUCKET_NAME"]
-PRIVATE_BUCKET_NAME: Final = os.environ["PRIVATE_BUCKET_NAME"]
+STORAGE: Final = os.getenv("STORAGE", "s3")  # "s3", "file" or "memory". See create_s3_client
+STORAGE_DIRECTORY: Final = os.getenv("STORAGE_DIRECTORY", "storage")  # The buckets are subdirectories
+# Only required for S3
+PUBLIC_BUCKET_NAME: Final = (
+    os.environ["PUBLIC_BUCKET_NAME"] if STORAGE == "s3" else os.getenv("PUBLIC_BUCKET_NAME", "public")
+)
+PRIVATE_BUCKET_NAME: Final = (
+    os.environ["PRIVATE_BUCKET_NAME"] if STORAGE == "s3" else os.getenv("PRIVATE_BUCKET_NAME", "private")
+)
 TEST_SECRET: Final = os.getenv("TEST_SECRET")  # The action "reset_test_setup" requires this secret
+S3_TRANSPORT: Final = os.getenv("S3_TRANSPORT", "botocore")  # "botocore" or "sigv4". See create_s3_client
+# "1" emits a trace of every request. See trace_request. On by default on Lambda
+TRACING: Final = os.getenv("TRACING", "1" if os.getenv("AWS_LAMBDA_FUNCTION_NAME") else "0") == "1"
+# Create the S3 client and read data.json when the module is imported. See prewarm
+PREWARM: Final = os.getenv("PREWARM", "1" if os.getenv("AWS_LAMBDA_FUNCTION_NAME") else "0") == "1"
+METRICS_NAMESPACE: Final = os.getenv("METRICS_NAMESPACE", "TaekwondoBackend")  # CloudWatch namespace of the metrics
+# The probability of logging a request per action, "*" for the other actions. See parse_sample_rates
+LOG_SAMPLE_RATES: Final = os.getenv("LOG_SAMPLE_RATES", "*=1")
+LOG_MAX_ITEMS: Final = int(os.getenv("LOG_MAX_ITEMS", "20"))  # Longer lists and objects are shortened in the log
+LOG_MAX_CHARS: Final = int(os.getenv("LOG_MAX_CHARS", "2000"))  # Longer logged requests are truncated
+SAVE_MODE: Final = os.getenv("SAVE_MODE", "snapshot")  # "snapshot" or "journal". See Backend._save_data
+# With SAVE_MODE "journal" a new snapshot is written after this many journal entries or seconds
+JOURNAL_SNAPSHOT_ENTRIES: Final = int(os.getenv("JOURNAL_SNAPSHOT_ENTRIES", "50"))
+JOURNAL_SNAPSHOT_SECONDS: Final = int(os.getenv("JOURNAL_SNAPSHOT_SECONDS", "3600"))
+# The public shards/upcoming.json has the sessions of this many days. See PublicManifestT
+PUBLIC_WINDOW_DAYS: Final = int(os.getenv("PUBLIC_WINDOW_DAYS", "28"))
+# The public objects: "data_json" (data.json and the change log) or "shards". See PublicManifestT
+PUBLIC_FORMAT: Final = os.getenv("PUBLIC_FORMAT", "data_json")
+# Compression level of the public objects. Level 6 takes three times as long as 1 for 8 % smaller objects
+GZIP_LEVEL: Final = int(os.getenv("GZIP_LEVEL", "1"))
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
@@ -195,6 +391,8 @@ EpochT = NewType("EpochT", int)
 YesNoT: TypeAlias = Literal["Yes", "No"]
 YesNoMaybeT: TypeAlias = Literal["Yes", "No", "Maybe"]
 SessionStateT: TypeAlias = Literal["archived", "cancelled", "scheduled"]
+BatchModeT: TypeAlias = Literal["atomic", "best_effort"]
+AttendanceGroupT: TypeAlias = Literal["user", "coach", "weekday"]
 
 
 def role_includes(role_a: RoleT, role_b: RoleT) -> bool:
@@ -236,6 +434,68 @@ class Data(TypedDict):
 
     users: dict[str, User]
     sessions: dict[str, TrainingSession]
+    version: NotRequired[int]  # Incremented whenever the content changes. See ChangesT
+
+
+class ChangesT(TypedDict):
+    """
+    The public change log entry for a single version of data.json.
+
+    Applying the changes of version v to the public data.json of version v - 1 gives the public data.json of
+    version v. A user or session that was removed is null.
+    """
+
+    version: int
+    users: dict[str, User | None]
+    sessions: dict[str, TrainingSession | None]
+
+
+class FragmentsT(TypedDict):
+    """
+    The users and sessions of data.json, each serialized separately. See json_object_pieces
+    """
+
+    users: dict[str, bytes]  # user_id -> json.dumps(user) encoded
+    sessions: dict[str, bytes]  # session_id -> json.dumps(session) encoded
+
+
+class PublicManifestT(TypedDict):
+    """
+    The public manifest.json, listing the public objects written for a version of data.json.
+
+    With PUBLIC_FORMAT "data_json":
+
+    * data.json: The data without the auth tokens, which are replaced by their hash
+    * changes/{version}.json: The change log. See ChangesT
+
+    With PUBLIC_FORMAT "shards":
+
+    * shards/users.json: All users as in the public data.json
+    * shards/upcoming.json: The sessions without their participation, ending after window_start and starting
+      before window_end. The window starts 12 hours before the hour of the last change and spans PUBLIC_WINDOW_DAYS.
+    * shards/participation/{session_id}.json: The participation of each session in shards/upcoming.json
+
+    An object is only written when its content changes, and the manifest after the objects it lists.
+    Clients read the manifest and the objects whose version differs from the version they hold.
+    """
+
+    version: int  # The version of data.json the objects were written for
+    oldest_version: int  # Clients holding an older version than oldest_version - 1 must read the full objects
+    objects: dict[str, str]  # key -> version: The first 16 hex digits of the sha256 of the content
+
+
+class JournalEntryT(TypedDict):
+    """
+    A change of the data in the journal (SAVE_MODE "journal"). See Backend._save_data
+    """
+
+    version: int  # The version of the data after the change
+    time: float
+    action: str | None
+    caller: str | None  # user_id of the authenticated caller
+    arguments: dict[str, Any]  # The request without secrets
+    users: dict[str, User | None]  # The changed users. None if removed
+    sessions: dict[str, TrainingSession | None]  # The changed sessions. None if removed
 
 
 class Participation(TypedDict):
@@ -247,26 +507,314 @@ class Participation(TypedDict):
     participants: list[str]  # Ordered list of user_ids
 
 
+class HistoryManifestT(TypedDict):
+    """
+    The index of the historical participation data.
+
+    The history is partitioned by the month of the session start_time. Each partition is a separate S3 object
+    holding a dict[str, Participation] (see history_key). The manifest is only rewritten when a partition is added.
+    """
+
+    partitions: list[str]  # Sorted "yyyy-mm" of the existing partitions
+
+
+class MonthlyAttendanceT(TypedDict):
+    """
+    The attendance of a single user in a single month
+    """
+
+    count: int  # Number of sessions attended
+    last_attended: EpochT  # The start_time of the last session attended
+
+
+class AttendanceT(TypedDict):
+    """
+    The attendance of a single user. Derived from the historical participation data.
+    """
+
+    total: int  # Number of sessions attended
+    last_attended: EpochT  # The start_time of the last session attended
+    months: dict[str, MonthlyAttendanceT]  # "yyyy-mm" -> attendance
+
+
+class AttendanceSummaryT(TypedDict):
+    """
+    The attendance of every user who attended at least one session. Added up from the monthly attendance objects.
+    """
+
+    users: dict[str, AttendanceT]  # user_id -> attendance
+
+
+class ParticipationMatrixT(TypedDict):
+    """
+    The participation of the history partitions as bitsets (python ints). See make_participation_matrix
+
+    Bit j of a bitset is the j-th session sorted by start time. Counting the sessions in a time range is a bisect
+    for the range of bits and a bit_count of the masked bitset.
+    """
+
+    start_times: list[int]  # Sorted
+    columns: dict[str, int]  # user_id -> bitset of the sessions attended
+    coach_masks: dict[str, int]  # coach ("" if none) -> bitset of the sessions
+    weekday_masks: list[int]  # weekday in DEFAULT_TIMEZONE (Monday is 0) -> bitset of the sessions
+
+
+class UserIndexT(TypedDict):
+    """
+    Lookup tables for Data["users"]
+    """
+
+    by_token_hash: dict[str, str]  # hash_token(auth_token) -> user_id
+    by_name: dict[str, str]  # name -> user_id
+    token_hashes: dict[str, str]  # user_id -> hash_token(auth_token)
+
+
+class IdempotencyRecordT(TypedDict):
+    """
+    The outcome of a request with a request_id. See run_idempotent_action
+    """
+
+    request_hash: str  # sha256 of the request, so a request_id used for another request is detected
+    expires: float  # The record is ignored after this time
+    status_code: int  # 0 while the request is in progress
+    response: Mapping[str, Any] | None  # None if larger than MAX_IDEMPOTENT_RESPONSE_SIZE
+
+
+class SessionIndexT(TypedDict):
+    """
+    The sessions of Data sorted by time. Updated with add_to_session_index and remove_from_session_index
+    """
+
+    by_start_time: list[tuple[int, str]]  # (start_time, session_id)
+    archived_by_end_time: list[tuple[int, str]]  # (end_time, session_id) of the archived sessions only
+
+
+class CachedDataT(TypedDict):
+    """
+    The content of data.json as last read from or written to S3
+    """
+
+    etag: str  # The ETag S3 returned for the object
+    data: Data  # With SAVE_MODE "journal" the journal entries read or written since are applied
+    snapshot_version: int  # The version of the object
+    journal_start: float  # The time of the oldest journal entry newer than the object. 0 if none
+    user_index: UserIndexT
+    session_index: SessionIndexT
+    private_digest: str  # sha256 of the object
+    # The previous content is needed to find the changes when a new version is written. Either as the fragments
+    # serialized when writing the object, or as the object itself if it was read.
+    fragments: FragmentsT | None
+    body: bytes
+    manifest: PublicManifestT | None  # The public manifest.json as last written by this instance. None if unknown
+
+
+class SpanT(TypedDict):
+    """
+    A timed part of a request. See trace_span
+    """
+
+    name: str
+    start_ms: float  # Since the start of the request
+    duration_ms: float
+    attributes: dict[str, Any]
+    children: list["SpanT"]
+
+
 F = TypeVar("F", bound=Callable[..., Any])
+V = TypeVar("V")
+
+
+# The innermost open span of the current request. None outside of a traced request
+CURRENT_SPAN: contextvars.ContextVar[SpanT | None] = contextvars.ContextVar("CURRENT_SPAN", default=None)
+
+# time.perf_counter() at the start of the current request
+TRACE_START = 0.0
+
+# True until the first request of this instance has finished
+COLD_START = True
 
 
-def log_execution_time(func: F) -> F:
+@contextmanager
+def trace_span(name: str, **attributes: Any) -> Iterator[dict[str, Any]]:
     """
-    Logs the execution time of the function in milliseconds.
+    Time the enclosed code as a child of the current span.
+
+    Yields the attributes of the span, which may be extended within. Does nothing outside of a traced request.
+    """
+    if (parent := CURRENT_SPAN.get()) is None:
+        yield attributes
+        return
+    start = time.perf_counter()
+    span = SpanT(
+        name=name, start_ms=round((start - TRACE_START) * 1000, 3), duration_ms=0.0, attributes=attributes, children=[]
+    )
+    parent["children"].append(span)
+    token = CURRENT_SPAN.set(span)
+    try:
+        yield attributes
+    except Exception as exc:
+        attributes["error"] = type(exc).__name__
+        raise
+    finally:
+        CURRENT_SPAN.reset(token)
+        span["duration_ms"] = round((time.perf_counter() - start) * 1000, 3)
+
+
+def traced(func: F) -> F:
+    """
+    Trace each call of the function as a span named after it. See trace_span
     """
 
     @wraps(func)
     def wrapper(*args: Any, **kwargs: Any) -> Any:
-        start_time: float = time.time()
-        result: Any = func(*args, **kwargs)
-        end_time: float = time.time()
-        execution_time: float = (end_time - start_time) * 1000  # convert to milliseconds
-        logger.info(f"Executed {func.__name__} in {execution_time:.2f} ms")
-        return result
+        with trace_span(func.__qualname__):
+            return func(*args, **kwargs)
 
     return wrapper  # type: ignore
 
 
+def add_span_attributes(**attributes: Any) -> None:
+    """
+    Add attributes to the current span, if any
+    """
+    if (span := CURRENT_SPAN.get()) is not None:
+        span["attributes"].update(attributes)
+
+
+def sum_span_attribute(span: SpanT, name: str, key: str) -> tuple[int, int]:
+    """
+    Return the number of spans with the name in the tree and the sum of their attribute key
+    """
+    count, total = (1, span["attributes"].get(key, 0)) if span["name"] == name else (0, 0)
+    for child in span["children"]:
+        child_count, child_total = sum_span_attribute(child, name, key)
+        count, total = count + child_count, total + child_total
+    return count, total
+
+
+def make_metrics_record(root: SpanT, request_id: str | None, cold_start: bool) -> dict[str, Any]:
+    """
+    Return the trace of a request in CloudWatch embedded metric format.
+
+    The metrics per action are extracted by CloudWatch. The span tree is kept in the log record.
+    """
+    s3_gets, s3_bytes_read = sum_span_attribute(root, "s3_get", "bytes")
+    s3_puts, s3_bytes_written = sum_span_attribute(root, "s3_put", "bytes")
+    units = {
+        "duration": "Milliseconds",
+        "s3_gets": "Count",
+        "s3_puts": "Count",
+        "s3_bytes_read": "Bytes",
+        "s3_bytes_written": "Bytes",
+    }
+    return {
+        "_aws": {
+            "Timestamp": int(time.time() * 1000),
+            "CloudWatchMetrics": [
+                {
+                    "Namespace": METRICS_NAMESPACE,
+                    "Dimensions": [["action"]],
+                    "Metrics": [{"Name": name, "Unit": unit} for name, unit in units.items()],
+                }
+            ],
+        },
+        "action": root["attributes"].get("action", "none"),
+        "requestId": request_id,
+        "cold": cold_start,
+        "duration": root["duration_ms"],
+        "s3_gets": s3_gets,
+        "s3_puts": s3_puts,
+        "s3_bytes_read": s3_bytes_read,
+        "s3_bytes_written": s3_bytes_written,
+        "trace": root,
+    }
+
+
+@contextmanager
+def trace_request(request_id: str | None) -> Iterator[None]:
+    """
+    Trace the enclosed request and print the trace as one json record when done.
+
+    Lambda passes stdout to CloudWatch Logs, which extracts the metrics of the record (see make_metrics_record).
+    """
+    global TRACE_START, COLD_START  # pylint: disable=global-statement
+    TRACE_START = time.perf_counter()
+    root = SpanT(name="request", start_ms=0.0, duration_ms=0.0, attributes={}, children=[])
+    token = CURRENT_SPAN.set(root)
+    try:
+        yield
+    finally:
+        CURRENT_SPAN.reset(token)
+        root["duration_ms"] = round((time.perf_counter() - TRACE_START) * 1000, 3)
+        print(json.dumps(make_metrics_record(root, request_id, COLD_START)), flush=True)
+        COLD_START = False
+
+
+def parse_sample_rates(spec: str) -> dict[str, float]:
+    """
+    Parse e.g. "any_trigger_initialization=0,coach_register_participation=1,*=0.1" into a rate per action
+    """
+    rates = {}
+    for item in filter(None, (item.strip() for item in spec.split(","))):
+        action, separator, rate = item.partition("=")
+        if not separator or not 0 <= float(rate) <= 1:
+            raise ValueError(f"Invalid sample rate: {item}")
+        rates[action.strip()] = float(rate)
+    return rates
+
+
+SAMPLE_RATES: Final = parse_sample_rates(LOG_SAMPLE_RATES)
+
+# Values of these keys are never logged
+REDACTED_KEYS: Final = frozenset(["auth_token", "user_auth_tokens", "test_secret"])
+
+# Decides which requests are logged. Not used for anything secret
+LOG_RANDOM: Final = Random()
+
+
+def is_request_logged(action: Any) -> bool:
+    """
+    Randomly decide whether to log a request with the action according to SAMPLE_RATES
+    """
+    rate = SAMPLE_RATES.get(action if isinstance(action, str) else "*", SAMPLE_RATES.get("*", 1.0))
+    return rate >= 1 or LOG_RANDOM.random() < rate
+
+
+def redact(value: Any, max_items: int | None = LOG_MAX_ITEMS) -> Any:
+    """
+    Return a copy of a request for the log without secrets. Lists and objects are cut after max_items items.
+    """
+    if isinstance(value, dict):
+        result = {
+            key: "<redacted>" if key in REDACTED_KEYS else redact(item, max_items)
+            for key, item in itertools.islice(value.items(), max_items)
+        }
+        if max_items is not None and len(value) > max_items:
+            result["..."] = f"{len(value) - max_items} more"
+        return result
+    if isinstance(value, list):
+        items = [redact(item, max_items) for item in value[:max_items]]
+        if max_items is not None and len(value) > max_items:
+            items.append(f"... {len(value) - max_items} more")
+        return items
+    return value
+
+
+class LoggedRequest:  # pylint: disable=too-few-public-methods
+    """
+    Log argument formatting a request (see redact) only if the log record is actually emitted
+    """
+
+    def __init__(self, data: Any) -> None:
+        self._data: Final = data
+
+    def __str__(self) -> str:
+        text = json.dumps(redact(self._data))
+        if len(text) > LOG_MAX_CHARS:
+            return f"{text[:LOG_MAX_CHARS]}... ({len(text)} characters)"
+        return text
+
+
 def hash_token(auth_token: str) -> str:
     """
     Return the SHA256 hash of the auth_token
@@ -279,54 +827,510 @@ def hash_token(auth_token: str) -> str:
     return sha256_hash.hexdigest()
 
 
-def make_auth_token(random: Random | None = None) -> str:
+# No historical data exists before this time
+EARLIEST_HISTORY_TIME: Final = EpochT(1700000000)
+
+HISTORY_MANIFEST_KEY: Final = "history/manifest.json"
+
+# Max number of S3 requests made concurrently. See map_concurrently
+S3_CONCURRENCY: Final = 8
+
+# The threads of map_concurrently. Kept between requests, so their S3 connections are reused
+EXECUTOR: "ThreadPoolExecutor | None" = None
+
+
+def history_partition(epoch: int) -> str:
     """
-    Creates a new login token for a user
+    Return the name ("yyyy-mm") of the history partition for sessions starting at epoch
     """
-    return "".join((random or SystemRandom()).choice(string.ascii_letters + string.digits) for _ in range(8))
+    return datetime.datetime.fromtimestamp(epoch, datetime.timezone.utc).strftime("%Y-%m")
 
 
-def make_id() -> str:
+def history_key(partition: str) -> str:
     """
-    Creates a new id string
+    Return the private S3 key of a history partition
     """
-    return str(uuid4())
+    return f"history/participation_{partition}.json"
 
 
-def make_default_data() -> Data:
+def encode_history_cursor(start_time: int, session_id: str) -> str:
     """
-    Creates a small valid dataset
+    Return the cursor of coach_get_historical_participation continuing after the given session
     """
-    default_admin_id = make_id()
+    return base64.urlsafe_b64encode(json.dumps([start_time, session_id]).encode("utf-8")).decode("ascii")
 
-    time_now = time.time()
-    session_1_start_time = 1727370000
-    while session_1_start_time < time_now:
-        session_1_start_time += 604800
-    session_2_start_time = 1727802000
-    while session_2_start_time < time_now:
-        session_2_start_time += 604800
 
-    return Data(
-        users={
-            default_admin_id: User(
-                user_id=default_admin_id,
-                role="Admin",
-                name="Default admin",
-                auth_token=make_auth_token(),
-            ),
-        },
-        sessions={},
-    )
+def decode_history_cursor(cursor: str) -> tuple[int, str]:
+    """
+    Return the start time and the session id of the last session before the cursor
+    """
+    try:
+        start_time, session_id = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    except (ValueError, TypeError) as exc:
+        raise ArgumentError(f"Invalid cursor: {cursor}") from exc
+    if not isinstance(start_time, int) or not isinstance(session_id, str):
+        raise ArgumentError(f"Invalid cursor: {cursor}")
+    return start_time, session_id
 
 
-def make_test_data() -> tuple[Data, dict[str, Participation]]:  # pylint: disable=too-many-locals
+def check_history_range(start_time: int, end_time: int) -> None:
     """
-    Creates a small valid dataset
+    Raise ArgumentError unless [start_time, end_time[ is a valid range of the history
     """
-    admin_id = "01ebbd39-3f48-43d5-89c4-98383d185a27"
-    tuesday_coach_id = "5bca8421-f626-4358-b51e-57f8f81aaeba"
-    thursday_coach_id = "252451bc-b589-4f63-bbaa-9451da6f2baf"
+    if start_time >= end_time:
+        raise ArgumentError(f"Invalid time range: {start_time} >= {end_time}")
+    if start_time < EARLIEST_HISTORY_TIME:
+        raise ArgumentError(f"Invalid start time (too far in the past): {start_time}")
+    if end_time > time.time() + 31 * 86400:
+        raise ArgumentError(f"Invalid end time (in the future): {end_time}")
+
+
+# The private S3 keys of the files written by coach_export_participation start with this
+EXPORT_KEY_PREFIX: Final = "exports/"
+
+# The size of the parts in which coach_export_participation uploads the CSV. At least MIN_PART_SIZE.
+EXPORT_PART_SIZE: Final = 8 * 2**20
+
+# Number of seconds the URL returned by coach_export_participation is valid
+EXPORT_URL_EXPIRES: Final = 3600
+
+EXPORT_COLUMNS: Final = (
+    "session_id",
+    "start_time",
+    "end_time",
+    "coach_id",
+    "coach_name",
+    "comment",
+    "user_id",
+    "user_name",
+)
+
+
+def encode_csv_chunks(rows: Iterable[Iterable[Any]], chunk_size: int) -> Iterator[bytes]:
+    """
+    Yield the rows as UTF-8 encoded CSV in chunks of at least chunk_size bytes, except the last one
+    """
+    import csv  # pylint: disable=import-outside-toplevel
+    import io  # pylint: disable=import-outside-toplevel
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    empty = True
+    for row in rows:
+        writer.writerow(row)
+        # Counts characters, so the encoded chunk has at least as many bytes
+        if buffer.tell() >= chunk_size:
+            yield buffer.getvalue().encode("utf-8")
+            buffer.seek(0)
+            buffer.truncate()
+            empty = False
+    if buffer.tell() or empty:
+        yield buffer.getvalue().encode("utf-8")
+
+
+def attendance_key(partition: str) -> str:
+    """
+    Return the private S3 key of the attendance per user of a history partition: a dict[str, MonthlyAttendanceT]
+
+    It is kept up to date by coach_register_participation and can be rebuilt from the history partition.
+    """
+    return f"attendance/{partition}.json"
+
+
+def make_monthly_attendance(history: Mapping[str, Participation]) -> dict[str, MonthlyAttendanceT]:
+    """
+    Return the attendance per user_id for a single history partition
+    """
+    monthly_attendance: dict[str, MonthlyAttendanceT] = {}
+    for participation in history.values():
+        start_time = participation["session"]["start_time"]
+        for user_id in participation["participants"]:
+            if (attendance := monthly_attendance.get(user_id)) is None:
+                monthly_attendance[user_id] = MonthlyAttendanceT(count=1, last_attended=start_time)
+            else:
+                attendance["count"] += 1
+                attendance["last_attended"] = max(attendance["last_attended"], start_time)
+    return monthly_attendance
+
+
+def make_attendance_summary(
+    monthly_attendances: Mapping[str, Mapping[str, MonthlyAttendanceT]],
+) -> AttendanceSummaryT:
+    """
+    Add up the attendance per user of the history partitions (partition -> user_id -> attendance)
+    """
+    summary = AttendanceSummaryT(users={})
+    for partition, monthly_attendance in sorted(monthly_attendances.items()):
+        for user_id, month in monthly_attendance.items():
+            if (attendance := summary["users"].get(user_id)) is None:
+                summary["users"][user_id] = AttendanceT(
+                    total=month["count"], last_attended=month["last_attended"], months={partition: month}
+                )
+            else:
+                attendance["total"] += month["count"]
+                attendance["last_attended"] = max(attendance["last_attended"], month["last_attended"])
+                attendance["months"][partition] = month
+    return summary
+
+
+def make_participation_matrix(histories: Iterable[Mapping[str, Participation]]) -> ParticipationMatrixT:
+    """
+    Create the bitsets of the sessions in the history partitions
+    """
+    from zoneinfo import ZoneInfo  # pylint: disable=import-outside-toplevel
+
+    tzinfo = ZoneInfo(DEFAULT_TIMEZONE)
+    participations = sorted(
+        (
+            (participation["session"]["start_time"], session_id, participation)
+            for history in histories
+            for session_id, participation in history.items()
+        ),
+        key=lambda item: item[:2],
+    )
+    n_bytes = (len(participations) + 7) // 8
+    columns: dict[str, bytearray] = {}
+    coach_masks: dict[str, bytearray] = {}
+    weekday_masks = [bytearray(n_bytes) for _ in range(7)]
+    for j, (start_time, _, participation) in enumerate(participations):
+        byte, bit = divmod(j, 8)
+        for user_id in participation["participants"]:
+            columns.setdefault(user_id, bytearray(n_bytes))[byte] |= 1 << bit
+        coach_masks.setdefault(participation["session"].get("coach") or "", bytearray(n_bytes))[byte] |= 1 << bit
+        weekday_masks[datetime.datetime.fromtimestamp(start_time, tzinfo).weekday()][byte] |= 1 << bit
+    return ParticipationMatrixT(
+        start_times=[start_time for start_time, _, _ in participations],
+        columns={user_id: int.from_bytes(column, "little") for user_id, column in columns.items()},
+        coach_masks={coach: int.from_bytes(mask, "little") for coach, mask in coach_masks.items()},
+        weekday_masks=[int.from_bytes(mask, "little") for mask in weekday_masks],
+    )
+
+
+def count_attendance(
+    matrix: ParticipationMatrixT, start_time: int, end_time: int, group_by: AttendanceGroupT
+) -> list[dict[str, Any]]:
+    """
+    Return the number of sessions starting in [start_time, end_time[ and the attendance of each user in them,
+    in total or per coach or weekday.
+    """
+    first = bisect.bisect_left(matrix["start_times"], start_time)
+    last = bisect.bisect_left(matrix["start_times"], end_time, lo=first)
+    window = (1 << last) - (1 << first)
+    groups: dict[str | int | None, int]
+    if group_by == "coach":
+        groups = {coach: mask & window for coach, mask in sorted(matrix["coach_masks"].items())}
+    elif group_by == "weekday":
+        groups = {weekday: mask & window for weekday, mask in enumerate(matrix["weekday_masks"])}
+    else:
+        groups = {None: window}
+    result = []
+    for key, mask in groups.items():
+        if not mask and key is not None:
+            continue
+        users = {
+            user_id: count for user_id, column in matrix["columns"].items() if (count := (column & mask).bit_count())
+        }
+        result.append({"key": key, "sessions": mask.bit_count(), "attendances": sum(users.values()), "users": users})
+    return result
+
+
+def map_concurrently(func: Callable[[str], V], items: list[str]) -> list[V]:
+    """
+    Return [func(item) for item in items], with up to S3_CONCURRENCY calls running at a time.
+
+    func must not call map_concurrently itself, as the threads are shared.
+    """
+    global EXECUTOR  # pylint: disable=global-statement
+    if len(items) <= 1:
+        return [func(item) for item in items]
+    if EXECUTOR is None:
+        from concurrent.futures import ThreadPoolExecutor  # pylint: disable=import-outside-toplevel
+
+        EXECUTOR = ThreadPoolExecutor(max_workers=S3_CONCURRENCY)
+    # Each thread runs in a copy of the current context, so its spans are added to the current span
+    futures = [EXECUTOR.submit(contextvars.copy_context().run, func, item) for item in items]
+    return [future.result() for future in futures]
+
+
+def legacy_history_key(yyyy: int) -> str:
+    """
+    Return the private S3 key of the yearly history files used before the history was partitioned by month
+    """
+    return f"sessions/participation_data_{yyyy}.json"
+
+
+def make_user_index(users: Mapping[str, User]) -> UserIndexT:
+    """
+    Creates the lookup tables for the users
+    """
+    token_hashes = {user_id: hash_token(user["auth_token"]) for user_id, user in users.items()}
+    return UserIndexT(
+        by_token_hash={token_hash: user_id for user_id, token_hash in token_hashes.items()},
+        by_name={user["name"]: user_id for user_id, user in users.items()},
+        token_hashes=token_hashes,
+    )
+
+
+def make_session_index(sessions: Mapping[str, TrainingSession]) -> SessionIndexT:
+    """
+    Creates the time ordered index of the sessions
+    """
+    return SessionIndexT(
+        by_start_time=sorted((session["start_time"], session_id) for session_id, session in sessions.items()),
+        archived_by_end_time=sorted(
+            (session["end_time"], session_id)
+            for session_id, session in sessions.items()
+            if session["state"] == "archived"
+        ),
+    )
+
+
+def add_to_session_index(session_index: SessionIndexT, session: TrainingSession) -> None:
+    """
+    Add a session to the index. Its times and state must not change until removed again.
+    """
+    bisect.insort(session_index["by_start_time"], (session["start_time"], session["session_id"]))
+    if session["state"] == "archived":
+        bisect.insort(session_index["archived_by_end_time"], (session["end_time"], session["session_id"]))
+
+
+def remove_from_session_index(session_index: SessionIndexT, session: TrainingSession) -> None:
+    """
+    Remove a session from the index
+    """
+    for entries, entry in [
+        (session_index["by_start_time"], (session["start_time"], session["session_id"])),
+        (session_index["archived_by_end_time"], (session["end_time"], session["session_id"])),
+    ]:
+        i = bisect.bisect_left(entries, entry)
+        if i < len(entries) and entries[i] == entry:
+            del entries[i]
+
+
+def make_fragments(data: Data) -> FragmentsT:
+    """
+    Serialize each user and session of the data
+    """
+    return FragmentsT(
+        users={user_id: json.dumps(user).encode("utf-8") for user_id, user in data["users"].items()},
+        sessions={session_id: json.dumps(session).encode("utf-8") for session_id, session in data["sessions"].items()},
+    )
+
+
+def diff_entries(previous: Mapping[str, V], current: Mapping[str, V]) -> dict[str, V | None]:
+    """
+    Return the entries that were added or changed, and None for the entries that were removed
+    """
+    changes: dict[str, V | None] = {key: value for key, value in current.items() if previous.get(key) != value}
+    changes.update({key: None for key in previous if key not in current})
+    return changes
+
+
+def journal_key(version: int) -> str:
+    """
+    Return the private S3 key of the journal entry creating a version of the data
+    """
+    return f"journal/{version:010d}.json"
+
+
+def apply_journal_entry(
+    data: Data, user_index: UserIndexT, session_index: SessionIndexT, fragments: FragmentsT, entry: JournalEntryT
+) -> None:
+    """
+    Apply the changes of a journal entry to the data, its indexes and fragments
+    """
+    for user_id, user in entry["users"].items():
+        if (previous := data["users"].get(user_id)) is not None:
+            if user_index["by_name"].get(previous["name"]) == user_id:
+                del user_index["by_name"][previous["name"]]
+            user_index["by_token_hash"].pop(user_index["token_hashes"].pop(user_id), None)
+        if user is None:
+            data["users"].pop(user_id, None)
+            fragments["users"].pop(user_id, None)
+        else:
+            data["users"][user_id] = user
+            fragments["users"][user_id] = json.dumps(user).encode("utf-8")
+            user_index["by_name"][user["name"]] = user_id
+            user_index["token_hashes"][user_id] = hash_token(user["auth_token"])
+            user_index["by_token_hash"][user_index["token_hashes"][user_id]] = user_id
+    for session_id, session in entry["sessions"].items():
+        if (previous_session := data["sessions"].get(session_id)) is not None:
+            remove_from_session_index(session_index, previous_session)
+        if session is None:
+            data["sessions"].pop(session_id, None)
+            fragments["sessions"].pop(session_id, None)
+        else:
+            data["sessions"][session_id] = session
+            fragments["sessions"][session_id] = json.dumps(session).encode("utf-8")
+            add_to_session_index(session_index, session)
+    data["version"] = entry["version"]
+
+
+def changes_key(version: int) -> str:
+    """
+    Return the public S3 key of the change log entry for a version of data.json
+    """
+    return f"changes/{version}.json"
+
+
+PUBLIC_MANIFEST_KEY: Final = "manifest.json"
+USERS_SHARD_KEY: Final = "shards/users.json"
+UPCOMING_SHARD_KEY: Final = "shards/upcoming.json"
+
+
+def participation_shard_key(session_id: str) -> str:
+    """
+    Return the public S3 key of the participation of a session. See PublicManifestT
+    """
+    return f"shards/participation/{session_id}.json"
+
+
+# Number of versions listed in the change log. See PublicManifestT
+CHANGE_LOG_LENGTH: Final = 100
+
+# Cache-Control of public objects that are overwritten and of those that never change
+MUTABLE_CACHE_CONTROL: Final = "no-cache"
+IMMUTABLE_CACHE_CONTROL: Final = "public, max-age=31536000, immutable"
+
+
+def json_object_pieces(members: Mapping[str, bytes | list[bytes]]) -> list[bytes]:
+    """
+    Return the pieces of a json object with the given already serialized members, each encoded or as pieces.
+
+    Joined, the pieces are identical to json.dumps of the deserialized object encoded. The members are not copied,
+    so an object can be hashed and compressed piece by piece without ever holding it in one piece.
+    """
+    pieces = [b"{"]
+    for key, value in members.items():
+        pieces.append(f"{', ' if len(pieces) > 1 else ''}{json.dumps(key)}: ".encode("utf-8"))
+        if isinstance(value, bytes):
+            pieces.append(value)
+        else:
+            pieces += value
+    pieces.append(b"}")
+    return pieces
+
+
+def hash_pieces(pieces: list[bytes]) -> str:
+    """
+    Return the sha256 of the joined pieces
+    """
+    sha256_hash = hashlib.sha256()
+    for piece in pieces:
+        sha256_hash.update(piece)
+    return sha256_hash.hexdigest()
+
+
+def make_auth_token(random: Random | None = None) -> str:
+    """
+    Creates a new login token for a user
+    """
+    return "".join((random or SystemRandom()).choice(string.ascii_letters + string.digits) for _ in range(8))
+
+
+def make_id() -> str:
+    """
+    Creates a new id string
+    """
+    from uuid import uuid4  # pylint: disable=import-outside-toplevel
+
+    return str(uuid4())
+
+
+def make_training_session(start_time: EpochT, end_time: EpochT, coach: str, comment: str) -> TrainingSession:
+    """
+    Creates a new scheduled training session
+    """
+    return TrainingSession(
+        session_id=make_id(),
+        start_time=start_time,
+        end_time=end_time,
+        state="scheduled",
+        coach=coach,
+        comment=comment,
+        participation={coach: "Yes"},
+    )
+
+
+def make_weekly_intervals(  # pylint: disable=too-many-arguments,too-many-positional-arguments
+    weekday: int,
+    local_time: datetime.time,
+    duration: int,
+    first_date: datetime.date,
+    last_date: datetime.date,
+    excluded_dates: set[datetime.date],
+    tzinfo: datetime.tzinfo,
+) -> list[tuple[EpochT, EpochT]]:
+    """
+    Return the intervals [start, end[ starting at local_time on every weekday (Monday is 0) in [first_date, last_date]
+
+    Daylight saving time is taken into account, so the local time is the same all year.
+    At most MAX_RECURRING_SESSIONS + 1 intervals are returned.
+    """
+    intervals: list[tuple[EpochT, EpochT]] = []
+    date = first_date + datetime.timedelta(days=(weekday - first_date.weekday()) % 7)
+    while date <= last_date and len(intervals) <= MAX_RECURRING_SESSIONS:
+        if date not in excluded_dates:
+            start_time = EpochT(int(datetime.datetime.combine(date, local_time, tzinfo).timestamp()))
+            intervals.append((start_time, EpochT(start_time + duration)))
+        date += datetime.timedelta(days=7)
+    return intervals
+
+
+def find_overlaps(
+    sessions: Iterable[TrainingSession], intervals: Iterable[tuple[EpochT, EpochT]]
+) -> list[tuple[EpochT, EpochT]]:
+    """
+    Return the intervals [start, end[ overlapping any of the sessions
+
+    The sessions are sorted by start_time once. Then each interval is checked with a binary search: It overlaps
+    a session if any session starting before the interval ends, ends after the interval starts.
+    """
+    index = sorted((session["start_time"], session["end_time"]) for session in sessions)
+    start_times = [start_time for start_time, _ in index]
+    max_end_times = list(itertools.accumulate((end_time for _, end_time in index), max))
+    overlaps = []
+    for start_time, end_time in intervals:
+        n_starting_before = bisect.bisect_left(start_times, end_time)
+        if n_starting_before and max_end_times[n_starting_before - 1] > start_time:
+            overlaps.append((start_time, end_time))
+    return overlaps
+
+
+def make_default_data() -> Data:
+    """
+    Creates a small valid dataset
+    """
+    default_admin_id = make_id()
+
+    time_now = time.time()
+    session_1_start_time = 1727370000
+    while session_1_start_time < time_now:
+        session_1_start_time += 604800
+    session_2_start_time = 1727802000
+    while session_2_start_time < time_now:
+        session_2_start_time += 604800
+
+    return Data(
+        users={
+            default_admin_id: User(
+                user_id=default_admin_id,
+                role="Admin",
+                name="Default admin",
+                auth_token=make_auth_token(),
+            ),
+        },
+        sessions={},
+    )
+
+
+def make_test_data() -> tuple[Data, dict[str, Participation]]:  # pylint: disable=too-many-locals
+    """
+    Creates a small valid dataset
+    """
+    admin_id = "01ebbd39-3f48-43d5-89c4-98383d185a27"
+    tuesday_coach_id = "5bca8421-f626-4358-b51e-57f8f81aaeba"
+    thursday_coach_id = "252451bc-b589-4f63-bbaa-9451da6f2baf"
     current_coach_id = "6ecd9949-0896-4cac-a7f8-e187f239f7bf"
     student_id_1 = "0dbb7c34-bcdc-4ebf-9885-1fd43813e399"
     student_id_2 = "2c78ebd0-6f60-48f4-b646-61c7e0f628e2"
@@ -480,102 +1484,1787 @@ def make_test_data() -> tuple[Data, dict[str, Participation]]:  # pylint: disabl
             participation = historic_participation(data["sessions"][session_id], n_weeks_ago)
             historic_data[participation["session"]["session_id"]] = participation
 
-    return data, historic_data
+    return data, historic_data
+
+
+class ArgumentError(Exception):
+    """
+    These exceptions will cause a 400 response
+    """
+
+
+class ConcurrentModificationError(Exception):
+    """
+    A conditional write to S3 failed because another request changed the object since it was read.
+
+    The request is retried from scratch by lambda_handler.
+    """
+
+
+# The error codes S3 returns when the If-Match/If-None-Match condition of a write is not met
+CONFLICT_ERROR_CODES: Final = ("PreconditionFailed", "ConditionalRequestConflict")
+
+# Number of times a request is executed before giving up on conflicting writes
+MAX_ATTEMPTS: Final = 8
+
+# Maximum number of actions in a single any_batch request
+MAX_BATCH_SIZE: Final = 100
+
+# Maximum number of sessions created by a single coach_add_recurring_sessions request
+MAX_RECURRING_SESSIONS: Final = 60
+
+# coach_add_recurring_sessions only accepts dates up to this many days ahead
+MAX_SCHEDULE_DAYS: Final = 3 * 366
+
+# Maximum number of sessions in a page of coach_get_historical_participation
+MAX_HISTORY_PAGE_SIZE: Final = 1000
+
+# S3 requires all parts of a multipart upload but the last to have at least this size
+MIN_PART_SIZE: Final = 5 * 2**20
+
+# The outcome of a request with a request_id is the private S3 object idempotency/{scope}/{request_id}.json,
+# where the scope is the user_id of the caller. See run_idempotent_action
+IDEMPOTENCY_PREFIX: Final = "idempotency/"
+
+# Number of seconds the outcome of a request with a request_id is kept. The objects should be expired by a
+# lifecycle rule of the private bucket.
+IDEMPOTENCY_TTL: Final = 86400
+
+# Maximum number of outcomes kept in memory by a warm Lambda instance
+MAX_CACHED_IDEMPOTENCY_RECORDS: Final = 1000
+
+# Larger responses (e.g. of big batches) are not kept, only their status code
+MAX_IDEMPOTENT_RESPONSE_SIZE: Final = 4096
+
+# Number of seconds a request with a request_id may run before a request with the same request_id executes again.
+# More than the timeout of the Lambda function.
+IDEMPOTENCY_PENDING_TTL: Final = 120
+
+# A request_id is part of an S3 key
+REQUEST_ID_PATTERN: Final = re.compile(r"[A-Za-z0-9_.-]{1,128}")
+
+# The time zone of the local times given to coach_add_recurring_sessions unless specified
+DEFAULT_TIMEZONE: Final = "Europe/Copenhagen"
+
+
+class S3Error(Exception):
+    """
+    An error response from S3, e.g. code "NoSuchKey", "NotModified" or "PreconditionFailed"
+    """
+
+    def __init__(self, code: str, message: str = "") -> None:
+        super().__init__(f"{code}: {message}" if message else code)
+        self.code = code
+
+
+class S3Client(Protocol):
+    """
+    The S3 operations used by the backend
+    """
+
+    def get_object(self, bucket: str, key: str, if_none_match: str | None = None) -> tuple[bytes, str]:
+        """
+        Return the body and ETag of an object.
+
+        Raises S3Error with code "NotModified" if if_none_match is the current ETag of the object.
+        """
+
+    def put_object(  # pylint: disable=too-many-arguments
+        self,
+        bucket: str,
+        key: str,
+        body: bytes,
+        if_match: str | None = None,
+        if_none_match: str | None = None,
+        *,
+        content_type: str | None = None,
+        content_encoding: str | None = None,
+        cache_control: str | None = None,
+    ) -> str:
+        """
+        Write an object and return its new ETag.
+
+        content_type, content_encoding and cache_control are stored with the object and returned by S3 on GET.
+        Raises S3Error with code "PreconditionFailed" if the If-Match/If-None-Match condition is not met.
+        """
+
+    def create_multipart_upload(self, bucket: str, key: str, *, content_type: str | None = None) -> str:
+        """
+        Start writing an object in parts and return the upload id. See upload_in_parts
+        """
+
+    def upload_part(self, bucket: str, key: str, upload_id: str, part_number: int, body: bytes) -> str:
+        """
+        Upload part part_number (1, 2, ...) of a multipart upload and return its ETag.
+
+        All parts but the last must be at least MIN_PART_SIZE bytes.
+        """
+
+    def complete_multipart_upload(self, bucket: str, key: str, upload_id: str, part_etags: list[str]) -> str:
+        """
+        Write the object from the uploaded parts (the ETags of parts 1, 2, ...) and return its ETag
+        """
+
+    def abort_multipart_upload(self, bucket: str, key: str, upload_id: str) -> None:
+        """
+        Discard a multipart upload and its uploaded parts
+        """
+
+    def presign_get_object(self, bucket: str, key: str, expires_in: int) -> str | None:
+        """
+        Return a URL that allows anyone to GET the object for expires_in seconds. None if the storage has no URLs.
+        """
+
+
+class BotocoreS3Client:
+    """
+    S3Client based on botocore
+    """
+
+    def __init__(self) -> None:
+        # Imported here as the import alone takes a significant part of the cold start
+        from botocore.exceptions import ClientError  # pylint: disable=import-outside-toplevel
+        from botocore.session import Session  # pylint: disable=import-outside-toplevel
+
+        self._client_error: Final = ClientError
+        self._client: Final[Any] = Session().create_client("s3")  # Very slow operation!
+
+    def _s3_error(self, e: Any) -> S3Error:
+        code = e.response["Error"]["Code"]
+        return S3Error("NotModified" if code == "304" else code, e.response["Error"].get("Message", ""))
+
+    def get_object(self, bucket: str, key: str, if_none_match: str | None = None) -> tuple[bytes, str]:
+        """
+        See S3Client
+        """
+        kwargs = {} if if_none_match is None else {"IfNoneMatch": if_none_match}
+        try:
+            response = self._client.get_object(Bucket=bucket, Key=key, **kwargs)
+        except self._client_error as e:
+            raise self._s3_error(e) from e
+        return cast(bytes, response["Body"].read()), cast(str, response["ETag"])
+
+    def put_object(  # pylint: disable=too-many-arguments
+        self,
+        bucket: str,
+        key: str,
+        body: bytes,
+        if_match: str | None = None,
+        if_none_match: str | None = None,
+        *,
+        content_type: str | None = None,
+        content_encoding: str | None = None,
+        cache_control: str | None = None,
+    ) -> str:
+        """
+        See S3Client
+        """
+        kwargs = {}
+        for name, value in [
+            ("IfMatch", if_match),
+            ("IfNoneMatch", if_none_match),
+            ("ContentType", content_type),
+            ("ContentEncoding", content_encoding),
+            ("CacheControl", cache_control),
+        ]:
+            if value is not None:
+                kwargs[name] = value
+        try:
+            response = self._client.put_object(Body=body, Bucket=bucket, Key=key, **kwargs)
+        except self._client_error as e:
+            raise self._s3_error(e) from e
+        return cast(str, response["ETag"])
+
+    def create_multipart_upload(self, bucket: str, key: str, *, content_type: str | None = None) -> str:
+        """
+        See S3Client
+        """
+        kwargs = {} if content_type is None else {"ContentType": content_type}
+        try:
+            response = self._client.create_multipart_upload(Bucket=bucket, Key=key, **kwargs)
+        except self._client_error as e:
+            raise self._s3_error(e) from e
+        return cast(str, response["UploadId"])
+
+    def upload_part(self, bucket: str, key: str, upload_id: str, part_number: int, body: bytes) -> str:
+        """
+        See S3Client
+        """
+        try:
+            response = self._client.upload_part(
+                Body=body, Bucket=bucket, Key=key, UploadId=upload_id, PartNumber=part_number
+            )
+        except self._client_error as e:
+            raise self._s3_error(e) from e
+        return cast(str, response["ETag"])
+
+    def complete_multipart_upload(self, bucket: str, key: str, upload_id: str, part_etags: list[str]) -> str:
+        """
+        See S3Client
+        """
+        parts = [{"ETag": etag, "PartNumber": part_number} for part_number, etag in enumerate(part_etags, 1)]
+        try:
+            response = self._client.complete_multipart_upload(
+                Bucket=bucket, Key=key, UploadId=upload_id, MultipartUpload={"Parts": parts}
+            )
+        except self._client_error as e:
+            raise self._s3_error(e) from e
+        return cast(str, response["ETag"])
+
+    def abort_multipart_upload(self, bucket: str, key: str, upload_id: str) -> None:
+        """
+        See S3Client
+        """
+        try:
+            self._client.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+        except self._client_error as e:
+            raise self._s3_error(e) from e
+
+    def presign_get_object(self, bucket: str, key: str, expires_in: int) -> str | None:
+        """
+        See S3Client
+        """
+        return cast(
+            str,
+            self._client.generate_presigned_url(
+                "get_object", Params={"Bucket": bucket, "Key": key}, ExpiresIn=expires_in
+            ),
+        )
+
+
+class SigV4S3Client:
+    """
+    S3Client based on the standard library only. Requests are signed with AWS Signature Version 4.
+
+    The credentials are read from the environment variables that Lambda defines for the execution role.
+    One connection per host and thread is kept open between requests.
+    If AWS_ENDPOINT_URL_S3 is set, then path-style requests are sent to that endpoint instead of AWS.
+    """
+
+    def __init__(self) -> None:
+        self._access_key_id: Final = os.environ["AWS_ACCESS_KEY_ID"]
+        self._secret_access_key: Final = os.environ["AWS_SECRET_ACCESS_KEY"]
+        self._session_token: Final = os.getenv("AWS_SESSION_TOKEN")
+        self._region: Final = os.getenv("AWS_REGION") or os.environ["AWS_DEFAULT_REGION"]
+        self._endpoint: Final = urlsplit(os.getenv("AWS_ENDPOINT_URL_S3") or os.getenv("AWS_ENDPOINT_URL") or "")
+        self._connections: Final = threading.local()
+
+    def _host_and_path(self, bucket: str, key: str) -> tuple[str, str]:
+        if self._endpoint.netloc:
+            return self._endpoint.netloc, f"{self._endpoint.path.rstrip('/')}/{bucket}/{quote(key, safe='/~')}"
+        return f"{bucket}.s3.{self._region}.amazonaws.com", f"/{quote(key, safe='/~')}"
+
+    def _connection(self, host: str) -> "http.client.HTTPConnection":
+        import http.client  # pylint: disable=import-outside-toplevel,redefined-outer-name
+
+        connections: dict[str, http.client.HTTPConnection] = self._connections.__dict__.setdefault("by_host", {})
+        if (connection := connections.get(host)) is None:
+            if self._endpoint.scheme == "http":
+                connection = http.client.HTTPConnection(host, timeout=10)
+            else:
+                connection = http.client.HTTPSConnection(host, timeout=10)
+            connections[host] = connection
+        return connection
+
+    def _scope(self, amz_date: str) -> str:
+        return f"{amz_date[:8]}/{self._region}/s3/aws4_request"
+
+    def _signature(self, amz_date: str, canonical_request: str) -> str:
+        string_to_sign = "\n".join(
+            [
+                "AWS4-HMAC-SHA256",
+                amz_date,
+                self._scope(amz_date),
+                hashlib.sha256(canonical_request.encode("utf-8")).hexdigest(),
+            ]
+        )
+        signing_key = f"AWS4{self._secret_access_key}".encode("utf-8")
+        for part in [amz_date[:8], self._region, "s3", "aws4_request"]:
+            signing_key = hmac.new(signing_key, part.encode("utf-8"), hashlib.sha256).digest()
+        return hmac.new(signing_key, string_to_sign.encode("utf-8"), hashlib.sha256).hexdigest()
+
+    def _signed_headers(self, method: str, host: str, path: str, query: str, body: bytes) -> dict[str, str]:
+        amz_date = datetime.datetime.now(datetime.timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+        headers = {
+            "host": host,
+            "x-amz-content-sha256": hashlib.sha256(body).hexdigest(),
+            "x-amz-date": amz_date,
+        }
+        if self._session_token:
+            headers["x-amz-security-token"] = self._session_token
+        signed_header_names = ";".join(sorted(headers))
+        canonical_request = "\n".join(
+            [
+                method,
+                path,
+                query,
+                "".join(f"{name}:{headers[name]}\n" for name in sorted(headers)),
+                signed_header_names,
+                headers["x-amz-content-sha256"],
+            ]
+        )
+        signature = self._signature(amz_date, canonical_request)
+        headers["authorization"] = (
+            f"AWS4-HMAC-SHA256 Credential={self._access_key_id}/{self._scope(amz_date)}, "
+            f"SignedHeaders={signed_header_names}, Signature={signature}"
+        )
+        return headers
+
+    def _request(  # pylint: disable=too-many-arguments,too-many-positional-arguments,too-many-locals
+        self,
+        method: str,
+        bucket: str,
+        key: str,
+        body: bytes = b"",
+        extra_headers: Mapping[str, str] | None = None,
+        query: Mapping[str, str] | None = None,
+    ) -> tuple[int, dict[str, str], bytes]:
+        import http.client  # pylint: disable=import-outside-toplevel,redefined-outer-name
+
+        host, path = self._host_and_path(bucket, key)
+        query_string = canonical_query_string(query or {})
+        headers = self._signed_headers(method, host, path, query_string, body) | dict(extra_headers or {})
+        target = f"{path}?{query_string}" if query_string else path
+        for attempt in range(2):
+            connection = self._connection(host)
+            try:
+                connection.request(method, target, body=body if method in ("PUT", "POST") else None, headers=headers)
+                response = connection.getresponse()
+                response_body = response.read()
+            except (http.client.HTTPException, OSError):
+                # The kept-alive connection may have been closed by S3. Retry once on a new connection.
+                connection.close()
+                self._connections.by_host.pop(host)
+                if attempt == 1:
+                    raise
+                continue
+            return response.status, {name.lower(): value for name, value in response.getheaders()}, response_body
+        raise AssertionError("Unreachable")
+
+    def _raise_for_status(self, status: int, body: bytes) -> None:
+        if status == 304:
+            raise S3Error("NotModified")
+        if status >= 300:
+            code = re.search(rb"<Code>([^<]*)</Code>", body)
+            message = re.search(rb"<Message>([^<]*)</Message>", body)
+            raise S3Error(
+                code.group(1).decode("utf-8") if code else str(status),
+                message.group(1).decode("utf-8") if message else "",
+            )
+
+    def get_object(self, bucket: str, key: str, if_none_match: str | None = None) -> tuple[bytes, str]:
+        """
+        See S3Client
+        """
+        status, headers, body = self._request(
+            "GET", bucket, key, extra_headers={} if if_none_match is None else {"If-None-Match": if_none_match}
+        )
+        self._raise_for_status(status, body)
+        return body, headers["etag"]
+
+    def put_object(  # pylint: disable=too-many-arguments
+        self,
+        bucket: str,
+        key: str,
+        body: bytes,
+        if_match: str | None = None,
+        if_none_match: str | None = None,
+        *,
+        content_type: str | None = None,
+        content_encoding: str | None = None,
+        cache_control: str | None = None,
+    ) -> str:
+        """
+        See S3Client
+        """
+        extra_headers = {}
+        for name, value in [
+            ("If-Match", if_match),
+            ("If-None-Match", if_none_match),
+            ("Content-Type", content_type),
+            ("Content-Encoding", content_encoding),
+            ("Cache-Control", cache_control),
+        ]:
+            if value is not None:
+                extra_headers[name] = value
+        status, headers, response_body = self._request("PUT", bucket, key, body=body, extra_headers=extra_headers)
+        self._raise_for_status(status, response_body)
+        return headers["etag"]
+
+    def create_multipart_upload(self, bucket: str, key: str, *, content_type: str | None = None) -> str:
+        """
+        See S3Client
+        """
+        extra_headers = {} if content_type is None else {"Content-Type": content_type}
+        status, _, body = self._request("POST", bucket, key, extra_headers=extra_headers, query={"uploads": ""})
+        self._raise_for_status(status, body)
+        return xml_element_text(body, "UploadId")
+
+    def upload_part(self, bucket: str, key: str, upload_id: str, part_number: int, body: bytes) -> str:
+        """
+        See S3Client
+        """
+        status, headers, response_body = self._request(
+            "PUT", bucket, key, body=body, query={"partNumber": str(part_number), "uploadId": upload_id}
+        )
+        self._raise_for_status(status, response_body)
+        return headers["etag"]
+
+    def complete_multipart_upload(self, bucket: str, key: str, upload_id: str, part_etags: list[str]) -> str:
+        """
+        See S3Client
+        """
+        parts = "".join(
+            f"<Part><PartNumber>{part_number}</PartNumber><ETag>{etag}</ETag></Part>"
+            for part_number, etag in enumerate(part_etags, 1)
+        )
+        request_body = f"<CompleteMultipartUpload>{parts}</CompleteMultipartUpload>".encode("utf-8")
+        status, _, body = self._request("POST", bucket, key, body=request_body, query={"uploadId": upload_id})
+        # S3 may report a failure of the completion with status 200
+        self._raise_for_status(500 if status == 200 and b"<Error>" in body else status, body)
+        return xml_element_text(body, "ETag")
+
+    def abort_multipart_upload(self, bucket: str, key: str, upload_id: str) -> None:
+        """
+        See S3Client
+        """
+        status, _, body = self._request("DELETE", bucket, key, query={"uploadId": upload_id})
+        self._raise_for_status(status, body)
+
+    def presign_get_object(self, bucket: str, key: str, expires_in: int) -> str | None:
+        """
+        See S3Client
+        """
+        host, path = self._host_and_path(bucket, key)
+        amz_date = datetime.datetime.now(datetime.timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+        query = {
+            "X-Amz-Algorithm": "AWS4-HMAC-SHA256",
+            "X-Amz-Credential": f"{self._access_key_id}/{self._scope(amz_date)}",
+            "X-Amz-Date": amz_date,
+            "X-Amz-Expires": str(expires_in),
+            "X-Amz-SignedHeaders": "host",
+        }
+        if self._session_token:
+            query["X-Amz-Security-Token"] = self._session_token
+        canonical_request = "\n".join(
+            ["GET", path, canonical_query_string(query), f"host:{host}\n", "host", "UNSIGNED-PAYLOAD"]
+        )
+        query["X-Amz-Signature"] = self._signature(amz_date, canonical_request)
+        return f"{self._endpoint.scheme or 'https'}://{host}{path}?{canonical_query_string(query)}"
+
+
+def xml_element_text(body: bytes, tag: str) -> str:
+    """
+    Return the text of the first element tag of an S3 XML response
+    """
+    if not (match := re.search(rb"<%s>([^<]*)</%s>" % (tag.encode("ascii"), tag.encode("ascii")), body)):
+        raise S3Error("InvalidResponse", f"No {tag} in the response")
+    text = match.group(1).decode("utf-8")
+    for entity, character in [("&quot;", '"'), ("&apos;", "'"), ("&lt;", "<"), ("&gt;", ">"), ("&amp;", "&")]:
+        text = text.replace(entity, character)
+    return text
+
+
+def canonical_query_string(query: Mapping[str, str]) -> str:
+    """
+    Return the query string of a request in the canonical form of AWS Signature Version 4
+    """
+    return "&".join(f"{quote(name, safe='-_.~')}={quote(value, safe='-_.~')}" for name, value in sorted(query.items()))
+
+
+def make_etag(body: bytes) -> str:
+    """
+    Return the ETag S3 gives an object uploaded in a single part
+    """
+    return f'"{hashlib.md5(body, usedforsecurity=False).hexdigest()}"'
+
+
+def make_multipart_etag(part_etags: list[str]) -> str:
+    """
+    Return the ETag S3 gives an object uploaded in parts with the given ETags
+    """
+    digests = b"".join(bytes.fromhex(etag.strip('"')) for etag in part_etags)
+    return f'"{hashlib.md5(digests, usedforsecurity=False).hexdigest()}-{len(part_etags)}"'
+
+
+def check_put_conditions(current_etag: str | None, if_match: str | None, if_none_match: str | None) -> None:
+    """
+    Raise S3Error like S3 does if a conditional PUT is not allowed. current_etag is None for a missing object.
+    """
+    if if_match is not None and if_match != current_etag:
+        raise S3Error("PreconditionFailed", "If-Match condition not met")
+    if if_none_match == "*" and current_etag is not None:
+        raise S3Error("PreconditionFailed", "If-None-Match condition not met")
+
+
+def check_completed_parts(uploaded: Mapping[int, tuple[int, str]], part_etags: list[str]) -> None:
+    """
+    Raise S3Error like S3 does if a multipart upload cannot be completed. uploaded: part number -> (size, ETag)
+    """
+    if not part_etags:
+        raise S3Error("MalformedXML", "No parts")
+    for part_number, etag in enumerate(part_etags, 1):
+        if part_number not in uploaded or uploaded[part_number][1] != etag:
+            raise S3Error("InvalidPart", f"Part {part_number} with ETag {etag} not found")
+        if part_number < len(part_etags) and uploaded[part_number][0] < MIN_PART_SIZE:
+            raise S3Error("EntityTooSmall", f"Part {part_number} is smaller than {MIN_PART_SIZE} bytes")
+
+
+class MemoryS3Client:
+    """
+    S3Client keeping the objects in memory. They are lost when the process ends.
+
+    The headers (content_type etc.) are not stored.
+    """
+
+    def __init__(self) -> None:
+        self._objects: Final[dict[tuple[str, str], tuple[bytes, str]]] = {}  # (bucket, key) -> (body, ETag)
+        self._uploads: Final[dict[str, dict[int, bytes]]] = {}  # upload id -> part number -> body
+        self._lock: Final = threading.Lock()
+
+    def get_object(self, bucket: str, key: str, if_none_match: str | None = None) -> tuple[bytes, str]:
+        """
+        See S3Client
+        """
+        with self._lock:
+            if (stored := self._objects.get((bucket, key))) is None:
+                raise S3Error("NoSuchKey")
+        if if_none_match == stored[1]:
+            raise S3Error("NotModified")
+        return stored
+
+    def put_object(  # pylint: disable=too-many-arguments,unused-argument
+        self,
+        bucket: str,
+        key: str,
+        body: bytes,
+        if_match: str | None = None,
+        if_none_match: str | None = None,
+        *,
+        content_type: str | None = None,
+        content_encoding: str | None = None,
+        cache_control: str | None = None,
+    ) -> str:
+        """
+        See S3Client
+        """
+        with self._lock:
+            stored = self._objects.get((bucket, key))
+            check_put_conditions(None if stored is None else stored[1], if_match, if_none_match)
+            etag = make_etag(body)
+            self._objects[(bucket, key)] = (body, etag)
+        return etag
+
+    def create_multipart_upload(  # pylint: disable=unused-argument
+        self, bucket: str, key: str, *, content_type: str | None = None
+    ) -> str:
+        """
+        See S3Client
+        """
+        upload_id = os.urandom(16).hex()
+        with self._lock:
+            self._uploads[upload_id] = {}
+        return upload_id
+
+    def upload_part(  # pylint: disable=too-many-arguments,too-many-positional-arguments,unused-argument
+        self, bucket: str, key: str, upload_id: str, part_number: int, body: bytes
+    ) -> str:
+        """
+        See S3Client
+        """
+        with self._lock:
+            if (parts := self._uploads.get(upload_id)) is None:
+                raise S3Error("NoSuchUpload")
+            parts[part_number] = body
+        return make_etag(body)
+
+    def complete_multipart_upload(self, bucket: str, key: str, upload_id: str, part_etags: list[str]) -> str:
+        """
+        See S3Client
+        """
+        with self._lock:
+            if (parts := self._uploads.get(upload_id)) is None:
+                raise S3Error("NoSuchUpload")
+            check_completed_parts(
+                {part_number: (len(body), make_etag(body)) for part_number, body in parts.items()}, part_etags
+            )
+            etag = make_multipart_etag(part_etags)
+            self._objects[(bucket, key)] = (b"".join(parts[i] for i in range(1, len(part_etags) + 1)), etag)
+            del self._uploads[upload_id]
+        return etag
+
+    def abort_multipart_upload(self, bucket: str, key: str, upload_id: str) -> None:  # pylint: disable=unused-argument
+        """
+        See S3Client
+        """
+        with self._lock:
+            if self._uploads.pop(upload_id, None) is None:
+                raise S3Error("NoSuchUpload")
+
+    def presign_get_object(  # pylint: disable=unused-argument
+        self, bucket: str, key: str, expires_in: int
+    ) -> str | None:
+        """
+        See S3Client
+        """
+        return None
+
+
+class FileS3Client:
+    """
+    S3Client storing each object as the file <directory>/<bucket>/<key>.
+
+    The headers (content_type etc.) are not stored. Files are replaced atomically, but the conditional writes are
+    only safe within a single process. The parts of multipart uploads are stored in <directory>/.uploads, and the
+    objects written from them get the ETag of a single part upload.
+    """
+
+    def __init__(self, directory: str) -> None:
+        self._directory: Final = os.path.abspath(directory)
+        self._lock: Final = threading.Lock()
+
+    def _path(self, bucket: str, key: str) -> str:
+        bucket_directory = os.path.join(self._directory, bucket)
+        path = os.path.abspath(os.path.join(bucket_directory, key))
+        if not path.startswith(bucket_directory + os.sep):
+            raise S3Error("InvalidObjectName", f"Invalid key: {key}")
+        return path
+
+    def _read(self, path: str) -> tuple[bytes, str] | None:
+        try:
+            with open(path, "rb") as file:
+                body = file.read()
+        except (FileNotFoundError, IsADirectoryError):
+            return None
+        return body, make_etag(body)
+
+    def get_object(self, bucket: str, key: str, if_none_match: str | None = None) -> tuple[bytes, str]:
+        """
+        See S3Client
+        """
+        if (stored := self._read(self._path(bucket, key))) is None:
+            raise S3Error("NoSuchKey")
+        if if_none_match == stored[1]:
+            raise S3Error("NotModified")
+        return stored
+
+    def put_object(  # pylint: disable=too-many-arguments,unused-argument
+        self,
+        bucket: str,
+        key: str,
+        body: bytes,
+        if_match: str | None = None,
+        if_none_match: str | None = None,
+        *,
+        content_type: str | None = None,
+        content_encoding: str | None = None,
+        cache_control: str | None = None,
+    ) -> str:
+        """
+        See S3Client
+        """
+        path = self._path(bucket, key)
+        with self._lock:
+            stored = self._read(path)
+            check_put_conditions(None if stored is None else stored[1], if_match, if_none_match)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            import tempfile  # pylint: disable=import-outside-toplevel
+
+            with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), delete=False) as file:
+                file.write(body)
+            os.replace(file.name, path)
+        return make_etag(body)
+
+    def _upload_directory(self, upload_id: str) -> str:
+        if not re.fullmatch(r"[0-9a-f]{32}", upload_id) or not os.path.isdir(
+            directory := os.path.join(self._directory, ".uploads", upload_id)
+        ):
+            raise S3Error("NoSuchUpload")
+        return directory
+
+    def create_multipart_upload(  # pylint: disable=unused-argument
+        self, bucket: str, key: str, *, content_type: str | None = None
+    ) -> str:
+        """
+        See S3Client
+        """
+        upload_id = os.urandom(16).hex()
+        os.makedirs(os.path.join(self._directory, ".uploads", upload_id))
+        return upload_id
+
+    def upload_part(  # pylint: disable=too-many-arguments,too-many-positional-arguments,unused-argument
+        self, bucket: str, key: str, upload_id: str, part_number: int, body: bytes
+    ) -> str:
+        """
+        See S3Client
+        """
+        with open(os.path.join(self._upload_directory(upload_id), str(part_number)), "wb") as file:
+            file.write(body)
+        return make_etag(body)
+
+    def complete_multipart_upload(  # pylint: disable=too-many-locals
+        self, bucket: str, key: str, upload_id: str, part_etags: list[str]
+    ) -> str:
+        """
+        See S3Client
+        """
+        directory = self._upload_directory(upload_id)
+        path = self._path(bucket, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        import shutil  # pylint: disable=import-outside-toplevel
+        import tempfile  # pylint: disable=import-outside-toplevel
+
+        uploaded = {}
+        for name in os.listdir(directory):
+            with open(os.path.join(directory, name), "rb") as part_file:
+                body = part_file.read()
+            uploaded[int(name)] = (len(body), make_etag(body))
+        check_completed_parts(uploaded, part_etags)
+        with self._lock:
+            # The parts are copied one at a time, so only one of them is held in memory
+            object_md5 = hashlib.md5(usedforsecurity=False)
+            with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), delete=False) as file:
+                for part_number in range(1, len(part_etags) + 1):
+                    with open(os.path.join(directory, str(part_number)), "rb") as part_file:
+                        body = part_file.read()
+                    object_md5.update(body)
+                    file.write(body)
+            os.replace(file.name, path)
+        shutil.rmtree(directory)
+        return f'"{object_md5.hexdigest()}"'
+
+    def abort_multipart_upload(self, bucket: str, key: str, upload_id: str) -> None:  # pylint: disable=unused-argument
+        """
+        See S3Client
+        """
+        import shutil  # pylint: disable=import-outside-toplevel
+
+        shutil.rmtree(self._upload_directory(upload_id))
+
+    def presign_get_object(  # pylint: disable=unused-argument
+        self, bucket: str, key: str, expires_in: int
+    ) -> str | None:
+        """
+        See S3Client
+        """
+        return None
+
+
+def upload_in_parts(client: S3Client, bucket: str, key: str, chunks: Iterable[bytes], content_type: str) -> str:
+    """
+    Write an object with a multipart upload, one chunk per part, and return its ETag.
+
+    The chunks are consumed one at a time. All but the last must have at least MIN_PART_SIZE bytes.
+    The upload is aborted if a chunk cannot be produced or uploaded.
+    """
+    upload_id = client.create_multipart_upload(bucket, key, content_type=content_type)
+    try:
+        part_etags = []
+        for part_number, chunk in enumerate(chunks, 1):
+            with trace_span("s3_upload_part", key=key, part=part_number, bytes=len(chunk)):
+                part_etags.append(client.upload_part(bucket, key, upload_id, part_number, chunk))
+        return client.complete_multipart_upload(bucket, key, upload_id, part_etags)
+    except BaseException:
+        client.abort_multipart_upload(bucket, key, upload_id)
+        raise
+
+
+# Define a global S3 client to avoid creating a new client for every request on a warm Lambda instance
+S3_CLIENT: S3Client | None = None
+
+
+@traced
+def create_s3_client() -> S3Client:
+    """
+    Creates the storage client selected by the environment variables STORAGE and S3_TRANSPORT
+
+    STORAGE "s3" (the default) uses S3 with the S3_TRANSPORT:
+    "botocore" (the default) uses botocore.
+    "sigv4" uses a minimal client based on the standard library. It avoids importing botocore and constructing
+    its client, which is the slowest part of a cold start.
+
+    STORAGE "file" stores the objects in STORAGE_DIRECTORY. STORAGE "memory" keeps them in memory.
+    """
+    global S3_CLIENT  # pylint: disable=global-statement
+    if S3_CLIENT is None:
+        if STORAGE == "file":
+            S3_CLIENT = FileS3Client(STORAGE_DIRECTORY)
+        elif STORAGE == "memory":
+            S3_CLIENT = MemoryS3Client()
+        elif STORAGE != "s3":
+            raise ValueError(f"Unsupported STORAGE: {STORAGE}")
+        elif S3_TRANSPORT == "sigv4":
+            S3_CLIENT = SigV4S3Client()
+        elif S3_TRANSPORT == "botocore":
+            S3_CLIENT = BotocoreS3Client()
+        else:
+            raise ValueError(f"Unsupported S3_TRANSPORT: {S3_TRANSPORT}")
+    return S3_CLIENT
+
+
+# The number of S3 PUTs done and skipped (because the content was unchanged) by the current request
+S3_WRITES: Final = {"done": 0, "skipped": 0}
+
+
+# The parsed data.json is kept between invocations of a warm Lambda instance.
+# It is revalidated with a conditional GET on every request, so it is only downloaded again when changed.
+DATA_CACHE: CachedDataT | None = None
+
+
+# The history partitions read by coach_get_attendance_stats: partition -> (ETag, history), and their bitsets.
+# The ETag is None if the partition did not exist. Kept between invocations of a warm Lambda instance like DATA_CACHE.
+HISTORY_CACHE: Final[dict[str, tuple[str | None, dict[str, Participation]]]] = {}
+PARTICIPATION_MATRIX: ParticipationMatrixT | None = None
+
+
+# The completed requests with a request_id seen by this instance by S3 key, oldest first. Kept between invocations.
+IDEMPOTENCY_CACHE: Final[dict[str, IdempotencyRecordT]] = {}
+
+
+def forget_cached_data() -> None:
+    """
+    Drop the cached data.json
+
+    Must be called if the cached data might have been modified without being saved.
+    """
+    global DATA_CACHE  # pylint: disable=global-statement
+    DATA_CACHE = None
+
+
+class ActionT(TypedDict):
+    """
+    An action of the API as registered by @api_action
+    """
+
+    name: str
+    role: RoleOrAnyT  # From the prefix of the name
+    description: str  # The first line of the docstring
+    required: Mapping[str, Any]  # key -> type
+    optional: Mapping[str, Any]  # key -> type
+    either: list[Mapping[str, Any]]  # Alternative required keys. See make_validator
+    choices: Mapping[str, tuple[Any, ...]]  # key -> allowed values (of the items of lists and objects)
+    mutating: bool  # Changes the data. Takes the optional request_id, see run_idempotent_action
+    atomic: bool  # Writes nothing but data.json, so it can be part of an atomic batch
+    handler: Callable[[Any, Mapping[str, Any]], Mapping[str, Any]]  # The Backend method
+    validate: Callable[[Mapping[str, Any]], None]  # Raises ArgumentError for an invalid request
+
+
+# All actions by name. Filled by @api_action when the module is imported
+ACTIONS: Final[dict[str, ActionT]] = {}
+
+# The json types of the python types used in the argument types
+JSON_TYPES: Final[Mapping[Any, str]] = {
+    str: "string",
+    int: "integer",
+    float: "number",
+    bool: "boolean",
+    list: "array",
+    dict: "object",
+    type(None): "null",
+}
+
+
+def make_type_check(key_type: Any) -> Callable[[Any], bool]:
+    """
+    Return a function checking if a value has the type.
+
+    The type is Any, a class, list[T], dict[str, T] or a union of those, e.g. str | None.
+    """
+    if key_type is Any:
+        return lambda value: True
+    origin = get_origin(key_type)
+    if origin is list:
+        check_item = make_type_check(get_args(key_type)[0])
+        return lambda value: isinstance(value, list) and all(check_item(item) for item in value)
+    if origin is dict:
+        check_item = make_type_check(get_args(key_type)[1])
+        return lambda value: isinstance(value, dict) and all(check_item(item) for item in value.values())
+    if origin is UnionType:
+        checks = [make_type_check(member) for member in get_args(key_type)]
+        return lambda value: any(check(value) for check in checks)
+    return lambda value: isinstance(value, key_type)
+
+
+def make_validator(
+    required: Mapping[str, Any],
+    optional: Mapping[str, Any],
+    either: list[Mapping[str, Any]],
+    choices: Mapping[str, tuple[Any, ...]],
+) -> Callable[[Mapping[str, Any]], None]:
+    """
+    Return a function raising ArgumentError if a request does not have the arguments.
+
+    Of the alternatives in either, the first one whose first key is in the request is required,
+    or the last one if none of them is.
+    The type checks are made once, so validating a request is just a loop over its arguments.
+    """
+
+    def compile_keys(keys_and_types: Mapping[str, Any], key_required: bool) -> list[tuple[str, Any, bool, Any]]:
+        return [
+            (key, make_type_check(key_type), key_required, choices.get(key)) for key, key_type in keys_and_types.items()
+        ]
+
+    checks = compile_keys(required, True) + compile_keys(optional, False)
+    alternatives = [compile_keys(keys_and_types, True) for keys_and_types in either]
+
+    def check(data: Mapping[str, Any], key: str, type_check: Any, key_required: bool, key_choices: Any) -> None:
+        if key not in data:
+            if key_required:
+                raise ArgumentError(f"Missing key {key}")
+            return
+        value = data[key]
+        if not type_check(value):
+            raise ArgumentError(f"Invalid type of key {key}")
+        if key_choices is not None:
+            items = value.values() if isinstance(value, dict) else value if isinstance(value, list) else [value]
+            if not all(item in key_choices for item in items):
+                raise ArgumentError(f"Invalid {key}: {value}")
+
+    def validate(data: Mapping[str, Any]) -> None:
+        for key_check in checks:
+            check(data, *key_check)
+        if alternatives:
+            alternative = next((keys for keys in alternatives if keys[0][0] in data), alternatives[-1])
+            for key_check in alternative:
+                check(data, *key_check)
+
+    return validate
+
+
+def api_action(  # pylint: disable=too-many-arguments
+    *,
+    required: Mapping[str, Any] | None = None,
+    optional: Mapping[str, Any] | None = None,
+    either: list[Mapping[str, Any]] | None = None,
+    choices: Mapping[str, tuple[Any, ...]] | None = None,
+    mutating: bool = False,
+    atomic: bool = True,
+) -> Callable[[F], F]:
+    """
+    Register a method of Backend as an action with the types of its arguments (see make_type_check).
+
+    The required role is the prefix of the name. Requests are validated before the data is loaded,
+    so the method can use the arguments without checking their types.
+    Actions changing the data should be mutating, so retried requests can be recognized by their request_id.
+    Actions writing other objects than data.json are not atomic: any_batch can't undo those writes.
+    """
+    optional = dict(optional or {}) | ({"request_id": str} if mutating else {})
+
+    def register(func: F) -> F:
+        prefix = func.__name__.split("_")[0].capitalize()
+        assert prefix in get_args(RoleOrAnyT), f"Invalid prefix {prefix} for action: {func.__name__}"
+        ACTIONS[func.__name__] = ActionT(
+            name=func.__name__,
+            role=cast(RoleOrAnyT, prefix),
+            description=(func.__doc__ or "").strip().split("\n")[0],
+            required=required or {},
+            optional=optional,
+            either=either or [],
+            choices=choices or {},
+            mutating=mutating,
+            atomic=atomic,
+            handler=func,
+            validate=make_validator(required or {}, optional, either or [], choices or {}),
+        )
+        return func
+
+    return register
+
+
+def get_action(data: Mapping[str, Any]) -> ActionT:
+    """
+    Return the action requested by data
+    """
+    if not isinstance(name := data.get("action"), str):
+        raise ArgumentError(f"Invalid or missing action: {name}")
+    if (spec := ACTIONS.get(name)) is None:
+        raise ArgumentError(f"Unknown action {name}")
+    return spec
+
+
+def json_schema(key_type: Any, key_choices: tuple[Any, ...] | None = None) -> dict[str, Any]:
+    """
+    Return the JSON Schema of an argument type
+    """
+    origin = get_origin(key_type)
+    if origin is list:
+        return {"type": "array", "items": json_schema(get_args(key_type)[0], key_choices)}
+    if origin is dict:
+        return {"type": "object", "additionalProperties": json_schema(get_args(key_type)[1], key_choices)}
+    if origin is UnionType and key_choices is None:
+        return {"anyOf": [json_schema(member) for member in get_args(key_type)]}
+    if key_choices is not None:
+        return {"enum": list(key_choices)}
+    return {} if key_type is Any else {"type": JSON_TYPES[key_type]}
+
+
+def describe_api() -> dict[str, Any]:
+    """
+    Return a machine readable description of the actions, with a JSON Schema of the request of each
+    """
+    actions = {}
+    for name, spec in sorted(ACTIONS.items()):
+        arguments = dict(spec["required"]) | dict(spec["optional"])
+        for keys_and_types in spec["either"]:
+            arguments |= keys_and_types
+        required = ["action"] + ([] if spec["role"] == "Any" else ["auth_token"]) + list(spec["required"])
+        request: dict[str, Any] = {
+            "type": "object",
+            "properties": {"action": {"const": name}}
+            | ({} if spec["role"] == "Any" else {"auth_token": {"type": "string"}})
+            | {key: json_schema(key_type, spec["choices"].get(key)) for key, key_type in arguments.items()},
+            "required": required,
+        }
+        if spec["either"]:
+            request["anyOf"] = [{"required": list(keys_and_types)} for keys_and_types in spec["either"]]
+        actions[name] = {
+            "role": spec["role"],
+            "description": spec["description"],
+            "mutating": spec["mutating"],
+            "atomic": spec["atomic"],
+            "request": request,
+        }
+    return {"actions": actions}
+
+
+class Backend:  # pylint: disable=too-many-instance-attributes,too-many-public-methods
+    """
+    Communication with S3 backend
+
+    The actions are the methods registered with @api_action. They take self and the request as arguments and return
+    the response.
+    """
+
+    @traced
+    def __init__(self, request: Mapping[str, Any] | None = None) -> None:
+        """
+        request is recorded in the journal with the changes it makes (SAVE_MODE "journal")
+        """
+        self._client: Final = create_s3_client()
+        self._request: Final = request or {}
+        self._etag: str | None = None  # The ETag of data.json when read. None if it did not exist
+        self._snapshot_version = 0  # See CachedDataT
+        self._journal_start = 0.0  # See CachedDataT
+        self._private_digest = ""  # sha256 of data.json in the private bucket. "" if unknown
+        self._fragments: FragmentsT | None = None  # See CachedDataT
+        self._body = b""  # See CachedDataT. b"" if data.json did not exist
+        self._manifest: PublicManifestT | None = None  # See CachedDataT
+        self._defer_save = False  # True while any_batch executes its actions
+        self._save_pending = False  # True if _save_data was called while deferred
+        try:
+            self._data, self._user_index, self._session_index = self._load_data()
+            if SAVE_MODE == "journal":
+                self._read_journal()
+        except S3Error as e:
+            if e.code == "NoSuchKey":
+                self._data = make_default_data()
+                self._user_index = make_user_index(self._data["users"])
+                self._session_index = make_session_index(self._data["sessions"])
+                self._save_data()
+            else:
+                raise
+
+    def _load_data(self) -> tuple[Data, UserIndexT, SessionIndexT]:
+        """
+        Return the content of data.json and its indexes - from DATA_CACHE if the object is unchanged on S3
+        """
+        global DATA_CACHE  # pylint: disable=global-statement
+        if DATA_CACHE is None:
+            body, etag = self._read_bytes_from_private_s3(key="data.json")
+        else:
+            try:
+                body, etag = self._read_bytes_from_private_s3(key="data.json", if_none_match=DATA_CACHE["etag"])
+            except S3Error as e:
+                if e.code != "NotModified":
+                    raise
+                logger.info("Using cached data.json (not modified)")
+                self._etag = DATA_CACHE["etag"]
+                self._snapshot_version = DATA_CACHE["snapshot_version"]
+                self._journal_start = DATA_CACHE["journal_start"]
+                self._private_digest = DATA_CACHE["private_digest"]
+                self._fragments = DATA_CACHE["fragments"]
+                self._body = DATA_CACHE["body"]
+                self._manifest = DATA_CACHE["manifest"]
+                return DATA_CACHE["data"], DATA_CACHE["user_index"], DATA_CACHE["session_index"]
+        with trace_span("json_decode", key="data.json", bytes=len(body)):
+            data = cast(Data, json.loads(body.decode("utf-8")))
+        self._etag = etag
+        self._snapshot_version = data.get("version", 0)
+        self._private_digest = hashlib.sha256(body).hexdigest()
+        self._body = body
+        DATA_CACHE = CachedDataT(
+            etag=etag,
+            data=data,
+            snapshot_version=self._snapshot_version,
+            journal_start=0.0,
+            user_index=make_user_index(data["users"]),
+            session_index=make_session_index(data["sessions"]),
+            private_digest=self._private_digest,
+            fragments=None,
+            body=body,
+            manifest=None,
+        )
+        return DATA_CACHE["data"], DATA_CACHE["user_index"], DATA_CACHE["session_index"]
+
+    def _read_journal(self) -> None:
+        """
+        Apply the journal entries newer than the data (SAVE_MODE "journal")
+        """
+        global DATA_CACHE  # pylint: disable=global-statement
+        version = self._data.get("version", 0)
+        entries: list[JournalEntryT] = []
+        while True:
+            try:
+                entries.append(
+                    cast(JournalEntryT, self._read_from_private_s3(key=journal_key(version + len(entries) + 1)))
+                )
+            except S3Error as e:
+                if e.code != "NoSuchKey":
+                    raise
+                break
+        if not entries:
+            return
+        if self._fragments is None:
+            self._fragments = make_fragments(self._data)
+        for entry in entries:
+            apply_journal_entry(self._data, self._user_index, self._session_index, self._fragments, entry)
+        self._journal_start = self._journal_start or entries[0]["time"]
+        self._body = b""
+        self._manifest = None  # Published by the requests that wrote the entries
+        DATA_CACHE = CachedDataT(
+            etag=cast(str, self._etag),
+            data=self._data,
+            snapshot_version=self._snapshot_version,
+            journal_start=self._journal_start,
+            user_index=self._user_index,
+            session_index=self._session_index,
+            private_digest=self._private_digest,
+            fragments=self._fragments,
+            body=b"",
+            manifest=None,
+        )
+
+    def _read_from_private_s3(self, key: str) -> dict[str, Any]:
+        body_dict, _ = self._read_from_private_s3_with_etag(key=key)
+        return body_dict
+
+    def _read_from_private_s3_with_etag(self, key: str, if_none_match: str | None = None) -> tuple[dict[str, Any], str]:
+        """
+        Return the parsed object and its ETag.
+
+        With if_none_match an S3Error with code "NotModified" is raised if the object still has that ETag.
+        """
+        body, etag = self._read_bytes_from_private_s3(key=key, if_none_match=if_none_match)
+        with trace_span("json_decode", key=key, bytes=len(body)):
+            body_dict = cast(dict[str, Any], json.loads(body.decode("utf-8")))
+        return body_dict, etag
+
+    def _read_bytes_from_private_s3(self, key: str, if_none_match: str | None = None) -> tuple[bytes, str]:
+        """
+        Return the raw object and its ETag. See _read_from_private_s3_with_etag
+        """
+        with trace_span("s3_get", key=key) as attributes:
+            try:
+                body, etag = self._client.get_object(PRIVATE_BUCKET_NAME, key, if_none_match=if_none_match)
+            except S3Error as e:
+                attributes["status"] = e.code
+                raise
+            attributes["bytes"] = len(body)
+        return body, etag
+
+    def _write_to_private_s3(self, data: Mapping[str, Any] | bytes, key: str, if_match: str | None = None) -> str:
+        """
+        Returns the ETag of the written object
+
+        data is serialized as json unless it is already bytes.
+
+        With if_match the object is only written if it is unchanged since it was read with that ETag.
+        Use if_match="" for an object that did not exist when read.
+        ConcurrentModificationError is raised if the condition is not met.
+        """
+        S3_WRITES["done"] += 1
+        if not isinstance(data, bytes):
+            with trace_span("json_encode", key=key):
+                data = json.dumps(data).encode("utf-8")
+        try:
+            with trace_span("s3_put", key=key, bytes=len(data)):
+                return self._client.put_object(
+                    PRIVATE_BUCKET_NAME,
+                    key,
+                    data,
+                    if_match=if_match or None,
+                    if_none_match="*" if if_match == "" else None,
+                )
+        except S3Error as e:
+            if e.code in CONFLICT_ERROR_CODES:
+                raise ConcurrentModificationError(f"{key} was modified by another request") from e
+            raise
+
+    def _write_to_public_s3(self, pieces: list[bytes], key: str, cache_control: str = MUTABLE_CACHE_CONTROL) -> None:
+        """
+        pieces is the content, compressed piece by piece. See json_object_pieces
+
+        The object is stored gzip compressed. Clients get it with Content-Encoding: gzip.
+        """
+        with trace_span("gzip", key=key, bytes=sum(len(piece) for piece in pieces)):
+            # wbits=31 writes a gzip header without a time, which keeps the ETag the same for the same content
+            compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+            body = b"".join([compressor.compress(piece) for piece in pieces] + [compressor.flush()])
+        with trace_span("s3_put", key=key, bytes=len(body)):
+            self._client.put_object(
+                PUBLIC_BUCKET_NAME,
+                key,
+                body,
+                content_type="application/json",
+                content_encoding="gzip",
+                cache_control=cache_control,
+            )
+
+    def _make_changes(self, previous: FragmentsT, current: FragmentsT) -> ChangesT:
+        """
+        Return the changes from the previous version to self._data as the entry of the change log
+        """
+        users, sessions = self._data["users"], self._data["sessions"]
+        return ChangesT(
+            version=self._data["version"],
+            users={
+                user_id: (
+                    None
+                    if fragment is None
+                    else users[user_id] | {"auth_token": self._user_index["token_hashes"][user_id]}
+                )
+                for user_id, fragment in diff_entries(previous["users"], current["users"]).items()
+            },
+            sessions={
+                session_id: None if fragment is None else sessions[session_id]
+                for session_id, fragment in diff_entries(previous["sessions"], current["sessions"]).items()
+            },
+        )
+
+    @traced
+    def _save_data(self) -> None:
+        """
+        Write data.json to the private bucket and then the public objects of PUBLIC_FORMAT (see _publish).
+
+        The members shared by the two (everything but the users) are only serialized once.
+        The users and sessions are serialized one by one, so the fragments can be compared with the previous version.
+        An object is not written if its content is unchanged. Otherwise the version is incremented and the changes
+        are published in the change log (PUBLIC_FORMAT "data_json").
+
+        With SAVE_MODE "journal" the private data.json is a snapshot. Each change is written as a new journal entry
+        instead, which only succeeds if no other request wrote that version first. See _compact_journal.
+        """
+        if self._defer_save:
+            self._save_pending = True
+            return
+        self._save_pending = False
+        self._filter_old_data()
+        with trace_span("json_encode", key="data.json"):
+            fragments = make_fragments(self._data)
+        members: dict[str, bytes | list[bytes]] = {"sessions": json_object_pieces(fragments["sessions"])}
+        for key, value in self._data.items():
+            if key not in ("users", "sessions"):
+                members[key] = json.dumps(value).encode("utf-8")
+        private_members = {"users": json_object_pieces(fragments["users"])} | members
+
+        if SAVE_MODE == "journal" and self._etag is not None:
+            previous_fragments = self._append_to_journal(fragments)
+        else:
+            previous_fragments = self._write_snapshot(fragments, private_members)
+        if "version" in self._data:
+            members["version"] = json.dumps(self._data["version"]).encode("utf-8")
+
+        changes = None
+        if previous_fragments is not None and PUBLIC_FORMAT == "data_json":
+            changes = self._make_changes(previous_fragments, fragments)
+        if self._publish(self._public_members(members), changes):
+            self._publish_newer_versions()
+
+    def _public_members(self, members: dict[str, bytes | list[bytes]]) -> dict[str, bytes | list[bytes]]:
+        """
+        Return the serialized members of the public data.json: The users with hashed auth tokens and members
+        """
+        public_users = {
+            user_id: user | {"auth_token": self._user_index["token_hashes"][user_id]}
+            for user_id, user in self._data["users"].items()
+        }
+        return {"users": json.dumps(public_users).encode("utf-8")} | members
+
+    @traced
+    def _publish(self, public_members: dict[str, bytes | list[bytes]], changes: ChangesT | None) -> bool:
+        """
+        Write the public objects of PUBLIC_FORMAT whose content changed, and then the manifest (see PublicManifestT).
+
+        changes is the new entry of the change log, if the version was incremented (PUBLIC_FORMAT "data_json").
+        The objects are written concurrently, so the time does not grow with their number.
+        Returns True if anything was written.
+        """
+        if self._manifest is None:
+            self._manifest = self._read_public_manifest()
+        version = self._data.get("version", 0)
+        if PUBLIC_FORMAT == "shards":
+            bodies = {key: [body] for key, body in self._make_shards(cast(bytes, public_members["users"])).items()}
+            oldest_version = version + 1
+        else:
+            bodies = {"data.json": json_object_pieces(public_members)}
+            oldest_version = max(1, version - CHANGE_LOG_LENGTH + 1)
+
+        manifest = PublicManifestT(version=version, oldest_version=oldest_version, objects={})
+        writes: dict[str, tuple[list[bytes], str]] = {}  # key -> (content as pieces, Cache-Control)
+        if changes is not None:
+            writes[changes_key(version)] = ([json.dumps(changes).encode("utf-8")], IMMUTABLE_CACHE_CONTROL)
+        for key, pieces in bodies.items():
+            manifest["objects"][key] = hash_pieces(pieces)[:16]
+            if self._manifest["objects"].get(key) != manifest["objects"][key]:
+                writes[key] = (pieces, MUTABLE_CACHE_CONTROL)
+        skipped = len(bodies) + (changes is not None) - len(writes)
+        S3_WRITES["done"] += len(writes)
+        map_concurrently(lambda key: self._write_to_public_s3(writes[key][0], key, writes[key][1]), list(writes))
+        if manifest == self._manifest:
+            skipped += 1
+        else:
+            S3_WRITES["done"] += 1
+            self._write_to_public_s3(pieces=[json.dumps(manifest).encode("utf-8")], key=PUBLIC_MANIFEST_KEY)
+        S3_WRITES["skipped"] += skipped
+        logger.info("Skipped writing %d of %d public objects and manifest (unchanged)", skipped, len(bodies) + 1)
+        written = manifest != self._manifest
+        self._manifest = manifest
+        if DATA_CACHE is not None and DATA_CACHE["data"] is self._data:
+            DATA_CACHE["manifest"] = manifest
+        return written
+
+    def _publish_newer_versions(self) -> None:
+        """
+        Publish the data again while another request changed it since this one read or wrote it.
+
+        The public objects are written without a condition after the private ones. A request that is slow to
+        publish may thereby overwrite the objects of a newer version. Whichever request publishes last sees that the
+        data moved on and publishes the newest version.
+        """
+        moved_on = self._data_moved_on()
+        for _ in range(MAX_ATTEMPTS):
+            if not moved_on:
+                return
+            logger.info("Publishing again: data.json changed while publishing version %d", self._data.get("version", 0))
+            moved_on = Backend().publish_again()
+        logger.warning("Gave up publishing again after %d attempts", MAX_ATTEMPTS)
+
+    def publish_again(self) -> bool:
+        """
+        Write every public object, as another request may have overwritten any with an older version.
+
+        Returns True if the data moved on again meanwhile. See _publish_newer_versions
+        """
+        self._manifest = PublicManifestT(version=0, oldest_version=1, objects={})
+        members: dict[str, bytes | list[bytes]] = {
+            key: json.dumps(value).encode("utf-8") for key, value in self._data.items() if key != "users"
+        }
+        self._publish(self._public_members(members), None)
+        return self._data_moved_on()
+
+    def _data_moved_on(self) -> bool:
+        """
+        Return True if another request wrote a newer version of the data since this one read or wrote it
+        """
+        try:
+            if SAVE_MODE == "journal":
+                self._read_bytes_from_private_s3(key=journal_key(self._data.get("version", 0) + 1))
+            else:
+                self._read_bytes_from_private_s3(key="data.json", if_none_match=self._etag)
+        except S3Error as e:
+            if e.code in ("NotModified", "NoSuchKey"):
+                return False
+            raise
+        return True
+
+    def _make_shards(self, users_json: bytes) -> dict[str, bytes]:
+        """
+        Return the public shards by key (PUBLIC_FORMAT "shards")
+
+        users_json is the serialized public users. The other shards are only the sessions in the window,
+        so the cost does not grow with the number of sessions.
+        """
+        window_start = int(time.time()) // 3600 * 3600 - 43200
+        window_end = window_start + PUBLIC_WINDOW_DAYS * 86400
+        by_start_time = self._session_index["by_start_time"]
+        sessions = [
+            session
+            for _, session_id in by_start_time[: bisect.bisect_left(by_start_time, (window_end,))]
+            if (session := self._data["sessions"][session_id])["end_time"] > window_start
+        ]
+        upcoming = {
+            "window_start": window_start,
+            "window_end": window_end,
+            "sessions": [
+                {key: value for key, value in session.items() if key != "participation"} for session in sessions
+            ],
+        }
+        return {USERS_SHARD_KEY: users_json, UPCOMING_SHARD_KEY: json.dumps(upcoming).encode("utf-8")} | {
+            participation_shard_key(session["session_id"]): json.dumps(session["participation"]).encode("utf-8")
+            for session in sessions
+        }
+
+    def _read_public_manifest(self) -> PublicManifestT:
+        """
+        Return the public manifest.json. Empty if it does not exist
+        """
+        with trace_span("s3_get", key=PUBLIC_MANIFEST_KEY) as attributes:
+            try:
+                body, _ = self._client.get_object(PUBLIC_BUCKET_NAME, PUBLIC_MANIFEST_KEY)
+            except S3Error as e:
+                attributes["status"] = e.code
+                if e.code != "NoSuchKey":
+                    raise
+                return PublicManifestT(version=0, oldest_version=1, objects={})
+            attributes["bytes"] = len(body)
+        return cast(PublicManifestT, json.loads(zlib.decompress(body, wbits=31)))
+
+    def _previous_fragments(self) -> FragmentsT:
+        """
+        Return the fragments of the data as last read or written. See CachedDataT
+        """
+        if self._fragments is not None:
+            return self._fragments
+        return make_fragments(cast(Data, json.loads(self._body)) if self._body else Data(users={}, sessions={}))
+
+    def _write_snapshot(
+        self, fragments: FragmentsT, private_members: dict[str, bytes | list[bytes]]
+    ) -> FragmentsT | None:
+        """
+        Write the private data.json unless unchanged. See _save_data
+
+        Returns the fragments of the previous version. None if nothing was written.
+        """
+        global DATA_CACHE  # pylint: disable=global-statement
+        if self._etag is not None and hash_pieces(json_object_pieces(private_members)) == self._private_digest:
+            # Safe even if another request changed data.json meanwhile: This request then happened before it
+            S3_WRITES["skipped"] += 1
+            logger.info("Skipped writing private data.json (unchanged)")
+            return None
+        previous_fragments = self._previous_fragments()
+        self._data["version"] = self._data.get("version", 0) + 1
+        private_members["version"] = json.dumps(self._data["version"]).encode("utf-8")
+        private_body = b"".join(json_object_pieces(private_members))
+        private_digest = hashlib.sha256(private_body).hexdigest()
+
+        self._etag = self._write_to_private_s3(data=private_body, key="data.json", if_match=self._etag or "")
+        self._snapshot_version = self._data["version"]
+        self._journal_start = 0.0
+        self._private_digest = private_digest
+        self._fragments = fragments
+        self._body = b""
+        DATA_CACHE = CachedDataT(
+            etag=self._etag,
+            data=self._data,
+            snapshot_version=self._snapshot_version,
+            journal_start=0.0,
+            user_index=self._user_index,
+            session_index=self._session_index,
+            private_digest=private_digest,
+            fragments=fragments,
+            body=b"",
+            manifest=self._manifest,
+        )
+        return previous_fragments
+
+    def _append_to_journal(self, fragments: FragmentsT) -> FragmentsT | None:
+        """
+        Write the changes since the previous version as a new journal entry unless unchanged. See _save_data
+
+        Returns the fragments of the previous version. None if nothing was written.
+        """
+        global DATA_CACHE  # pylint: disable=global-statement
+        previous_fragments = self._previous_fragments()
+        changed_users = diff_entries(previous_fragments["users"], fragments["users"])
+        changed_sessions = diff_entries(previous_fragments["sessions"], fragments["sessions"])
+        if not changed_users and not changed_sessions:
+            S3_WRITES["skipped"] += 1
+            logger.info("Skipped writing journal entry (unchanged)")
+            return None
+        caller = None
+        if isinstance(auth_token := self._request.get("auth_token"), str):
+            caller = self._find_user_by_auth_token(auth_token)
+        version = self._data.get("version", 0) + 1
+        entry = JournalEntryT(
+            version=version,
+            time=time.time(),
+            action=self._request.get("action"),
+            caller=caller["user_id"] if caller is not None else None,
+            arguments=redact(dict(self._request), max_items=None),
+            users={
+                user_id: None if change is None else self._data["users"][user_id]
+                for user_id, change in changed_users.items()
+            },
+            sessions={
+                session_id: None if change is None else self._data["sessions"][session_id]
+                for session_id, change in changed_sessions.items()
+            },
+        )
+        # Fails if another request wrote this version first
+        self._write_to_private_s3(data=entry, key=journal_key(version), if_match="")
+        self._data["version"] = version
+        self._journal_start = self._journal_start or entry["time"]
+        self._fragments = fragments
+        self._body = b""
+        DATA_CACHE = CachedDataT(
+            etag=cast(str, self._etag),
+            data=self._data,
+            snapshot_version=self._snapshot_version,
+            journal_start=self._journal_start,
+            user_index=self._user_index,
+            session_index=self._session_index,
+            private_digest=self._private_digest,
+            fragments=fragments,
+            body=b"",
+            manifest=self._manifest,
+        )
+        self._compact_journal()
+        return previous_fragments
+
+    def _compact_journal(self, force: bool = False) -> None:
+        """
+        Write the data as a new snapshot (the private data.json) if the journal has JOURNAL_SNAPSHOT_ENTRIES entries
+        or its oldest entry is JOURNAL_SNAPSHOT_SECONDS old. Or if forced.
+
+        The journal entries are kept as an audit trail. If another request wrote a snapshot meanwhile this one is
+        skipped. The journal is complete either way.
+        """
+        version = self._data.get("version", 0)
+        if version == self._snapshot_version:
+            return
+        if (
+            not force
+            and version - self._snapshot_version < JOURNAL_SNAPSHOT_ENTRIES
+            and time.time() - self._journal_start < JOURNAL_SNAPSHOT_SECONDS
+        ):
+            return
+        fragments = self._previous_fragments()
+        private_members: dict[str, bytes | list[bytes]] = {
+            "users": json_object_pieces(fragments["users"]),
+            "sessions": json_object_pieces(fragments["sessions"]),
+        }
+        for key, value in self._data.items():
+            if key not in ("users", "sessions"):
+                private_members[key] = json.dumps(value).encode("utf-8")
+        private_body = b"".join(json_object_pieces(private_members))
+        try:
+            etag = self._write_to_private_s3(data=private_body, key="data.json", if_match=self._etag or "")
+        except ConcurrentModificationError:
+            logger.info("Skipped writing snapshot (written by another request)")
+            return
+        self._etag = etag
+        self._snapshot_version = version
+        self._journal_start = 0.0
+        self._private_digest = hashlib.sha256(private_body).hexdigest()
+        if DATA_CACHE is not None and DATA_CACHE["data"] is self._data:
+            DATA_CACHE["etag"] = etag
+            DATA_CACHE["snapshot_version"] = version
+            DATA_CACHE["journal_start"] = 0.0
+            DATA_CACHE["private_digest"] = self._private_digest
+
+    def _filter_old_data(self) -> None:
+        """
+        Remove the archived sessions that ended more than 12 hours ago from self._data
+
+        Only the expired sessions are visited: they are the head of the archived sessions ordered by end time.
+        """
+        archived_by_end_time = self._session_index["archived_by_end_time"]
+        n_expired = bisect.bisect_left(archived_by_end_time, (time.time() - 43200,))
+        expired_sessions = [self._data["sessions"][session_id] for _, session_id in archived_by_end_time[:n_expired]]
+        for session in expired_sessions:
+            remove_from_session_index(self._session_index, session)
+            del self._data["sessions"][session["session_id"]]
+
+    def _read_history(self, partition: str) -> tuple[dict[str, Participation], str]:
+        """
+        Return a history partition and its ETag. An empty partition and "" if it does not exist.
+        """
+        try:
+            history, etag = self._read_from_private_s3_with_etag(key=history_key(partition))
+        except S3Error as e:
+            if e.code != "NoSuchKey":
+                raise
+            return {}, ""
+        return cast(dict[str, Participation], history), etag
 
+    def _read_histories(self, partitions: list[str]) -> list[dict[str, Participation]]:
+        """
+        Read the history partitions concurrently. The result has the same order as partitions.
+        """
 
-class ArgumentError(Exception):
-    """
-    These exceptions will cause a 400 response
-    """
+        def read_history(partition: str) -> dict[str, Participation]:
+            history, _ = self._read_history(partition)
+            return history
 
+        return map_concurrently(read_history, partitions)
 
-# Define a global boto3 client to avoid creating a new client for every request
-# (the instance is short lived though, so this probably won't help that much)
-S3_CLIENT: Any = None
+    def _iter_history(
+        self, start_time: int, end_time: int, after: tuple[int, str] | None = None
+    ) -> Iterator[tuple[str, Participation]]:
+        """
+        Yield the sessions of the history starting in [start_time, end_time[, sorted by start time and session id.
+        With after, only the sessions sorted after that (start_time, session_id).
 
+        The partitions are read when needed, 1, 2, 4, ... up to S3_CONCURRENCY at a time, so stopping
+        early leaves the remaining partitions unread and only a few partitions are held in memory.
+        """
+        if after is not None:
+            start_time = max(start_time, after[0])
+        first_partition, last_partition = history_partition(start_time), history_partition(end_time - 1)
+        manifest, _ = self._read_history_manifest()
+        partitions = [
+            partition for partition in manifest["partitions"] if first_partition <= partition <= last_partition
+        ]
+        # A session is in the partition of its start time, so sorting each partition sorts them all
+        n_read, n_concurrent = 0, 1
+        while n_read < len(partitions):
+            for history in self._read_histories(partitions[n_read : n_read + n_concurrent]):
+                participations = sorted(
+                    (
+                        (participation["session"]["start_time"], session_id, participation)
+                        for session_id, participation in history.items()
+                        if start_time <= participation["session"]["start_time"] < end_time
+                        and (after is None or (participation["session"]["start_time"], session_id) > after)
+                    ),
+                    key=lambda item: item[:2],
+                )
+                for _, session_id, participation in participations:
+                    yield session_id, participation
+            n_read += n_concurrent
+            n_concurrent = min(2 * n_concurrent, S3_CONCURRENCY)
+
+    def _load_participation_matrix(self, start_time: int, end_time: int) -> ParticipationMatrixT:
+        """
+        Return PARTICIPATION_MATRIX, including the history partitions overlapping [start_time, end_time[.
 
-@log_execution_time
-def create_s3_client() -> Any:
-    """
-    Creates an S3 client using botocore
-    """
-    global S3_CLIENT  # pylint: disable=global-statement
-    if S3_CLIENT is None:
-        session = Session()
-        S3_CLIENT = session.create_client("s3")  # Very slow operation!
-    return S3_CLIENT
+        The cached partitions in the range are revalidated with conditional GETs, and the matrix is only rebuilt if
+        one of them changed or was not cached.
+        """
+        global PARTICIPATION_MATRIX  # pylint: disable=global-statement
 
+        def revalidate(partition: str) -> bool:
+            cached_etag = HISTORY_CACHE[partition][0] if partition in HISTORY_CACHE else None
+            etag: str | None
+            try:
+                history, etag = self._read_from_private_s3_with_etag(
+                    key=history_key(partition), if_none_match=cached_etag
+                )
+            except S3Error as e:
+                if e.code == "NotModified":
+                    return False
+                if e.code != "NoSuchKey":
+                    raise
+                if partition in HISTORY_CACHE and cached_etag is None:
+                    return False  # Still does not exist
+                history, etag = {}, None
+            HISTORY_CACHE[partition] = (etag, cast(dict[str, Participation], history))
+            return True
+
+        manifest, _ = self._read_history_manifest()
+        first_partition, last_partition = history_partition(start_time), history_partition(end_time - 1)
+        partitions = [
+            partition for partition in manifest["partitions"] if first_partition <= partition <= last_partition
+        ]
+        if any(map_concurrently(revalidate, partitions)) or PARTICIPATION_MATRIX is None:
+            with trace_span("make_participation_matrix", partitions=len(HISTORY_CACHE)):
+                PARTICIPATION_MATRIX = make_participation_matrix(history for _, history in HISTORY_CACHE.values())
+        return PARTICIPATION_MATRIX
 
-class Backend:
-    """
-    Communication with S3 backend
+    def _read_history_manifest(self) -> tuple[HistoryManifestT, str]:
+        """
+        Return the history manifest and its ETag. An empty manifest and "" if it does not exist.
+        """
+        try:
+            manifest, etag = self._read_from_private_s3_with_etag(key=HISTORY_MANIFEST_KEY)
+        except S3Error as e:
+            if e.code != "NoSuchKey":
+                raise
+            return HistoryManifestT(partitions=[]), ""
+        return cast(HistoryManifestT, manifest), etag
 
-    All attributes that are NOT _ prefixed must be methods taking self and dict[str, Any] as
-    arguments and returning dict[str, Any]
-    """
+    def _add_history_partitions(self, partitions: Iterable[str]) -> None:
+        """
+        Make sure the history manifest lists the partitions
+        """
+        manifest, etag = self._read_history_manifest()
+        if not set(partitions) <= set(manifest["partitions"]):
+            manifest["partitions"] = sorted(set(manifest["partitions"]) | set(partitions))
+            self._write_to_private_s3(data=manifest, key=HISTORY_MANIFEST_KEY, if_match=etag)
 
-    @log_execution_time
-    def __init__(self) -> None:
-        self._client: Final = create_s3_client()
+    def _read_monthly_attendance_etag(self, partition: str) -> str:
+        """
+        Return the ETag of the attendance of a history partition. "" if it does not exist.
+        """
         try:
-            self._data = cast(Data, self._read_from_private_s3("data.json"))
-        except ClientError as e:
-            if e.response["Error"]["Code"] == "NoSuchKey":
-                self._data = make_default_data()
-                self._save_data()
-            else:
+            _, etag = self._read_bytes_from_private_s3(key=attendance_key(partition))
+        except S3Error as e:
+            if e.code != "NoSuchKey":
                 raise
+            return ""
+        return etag
 
-    @log_execution_time
-    def _read_from_private_s3(self, key: str) -> dict[str, Any]:
-        response = self._client.get_object(Bucket=PRIVATE_BUCKET_NAME, Key=key)
-        body_dict = cast(dict[str, Any], json.loads(response["Body"].read().decode("utf-8")))
-        return body_dict
+    def _write_monthly_attendance(
+        self, partition: str, history: Mapping[str, Participation], if_match: str | None = None
+    ) -> dict[str, MonthlyAttendanceT]:
+        """
+        Recompute the attendance of a history partition that was just written, and save it.
 
-    @log_execution_time
-    def _write_to_private_s3(self, data: Mapping[str, Any], key: str) -> None:
-        self._client.put_object(
-            Body=json.dumps(data),
-            Bucket=PRIVATE_BUCKET_NAME,
-            Key=key,
-        )
+        With if_match the ETag must have been read before the partition: If another request updates the attendance
+        in between, then the conditional write fails and the request is retried with the newer partition.
+        Since a month is recomputed from the content of the partition the update is idempotent.
+        """
+        monthly_attendance = make_monthly_attendance(history)
+        self._write_to_private_s3(data=monthly_attendance, key=attendance_key(partition), if_match=if_match)
+        return monthly_attendance
 
-    @log_execution_time
-    def _write_to_public_s3(self, data: Mapping[str, Any], key: str) -> None:
-        self._client.put_object(Body=json.dumps(data), Bucket=PUBLIC_BUCKET_NAME, Key=key)
+    def _read_attendance_summary(self) -> AttendanceSummaryT:
+        """
+        Add up the attendance of all history partitions, read concurrently.
 
-    @log_execution_time
-    def _save_data(self) -> None:
-        data = self._filter_old_data()
-        self._write_to_private_s3(
-            data=data,
-            key="data.json",
-        )
-        self._write_to_public_s3(
-            data=data
-            | {
-                "users": {
-                    user_id: user | {"auth_token": hash_token(user["auth_token"])}
-                    for user_id, user in data["users"].items()
-                }
-            },
-            key="data.json",
-        )
+        The attendance of a partition is created from the partition if it is missing.
+        """
+        manifest, _ = self._read_history_manifest()
+
+        def read_monthly_attendance(partition: str) -> dict[str, MonthlyAttendanceT]:
+            try:
+                monthly_attendance = self._read_from_private_s3(key=attendance_key(partition))
+            except S3Error as e:
+                if e.code != "NoSuchKey":
+                    raise
+                history, _ = self._read_history(partition)
+                return self._write_monthly_attendance(partition, history, if_match="")
+            return cast(dict[str, MonthlyAttendanceT], monthly_attendance)
+
+        partitions = manifest["partitions"]
+        return make_attendance_summary(dict(zip(partitions, map_concurrently(read_monthly_attendance, partitions))))
+
+    def _rebuild_attendance_summary(self) -> AttendanceSummaryT:
+        """
+        Recreate the attendance of all history partitions from the partitions, concurrently
+        """
+        manifest, _ = self._read_history_manifest()
+
+        def rebuild_monthly_attendance(partition: str) -> dict[str, MonthlyAttendanceT]:
+            history, _ = self._read_history(partition)
+            return self._write_monthly_attendance(partition, history)
 
-    def _filter_old_data(self) -> dict[str, Any]:
+        partitions = manifest["partitions"]
+        return make_attendance_summary(dict(zip(partitions, map_concurrently(rebuild_monthly_attendance, partitions))))
+
+    def _find_user_by_auth_token(self, auth_token: str) -> User | None:
         """
-        Remove old data from self._data
+        Lookup by the hash of the token followed by a constant-time comparison of the token itself
         """
-        data: dict[str, Any] = dict(deepcopy(self._data))
-        time_now = time.time()
-        for session_id, session in list(data["sessions"].items()):
-            if session["state"] == "archived" and session["end_time"] + 43200 < time_now:
-                data["sessions"].pop(session_id)
-        return data
+        if (user_id := self._user_index["by_token_hash"].get(hash_token(auth_token))) is None:
+            return None
+        user = self._data["users"][user_id]
+        if not hmac.compare_digest(user["auth_token"].encode("utf-8"), auth_token.encode("utf-8")):
+            return None
+        return user
 
     def _get_caller(self, data: Mapping[str, Any]) -> User:
-        for user in self._data["users"].values():
-            if user["auth_token"] == data.get("auth_token"):
+        if isinstance(auth_token := data.get("auth_token"), str):
+            if (user := self._find_user_by_auth_token(auth_token)) is not None:
                 return user
         raise ArgumentError("Authentication token not provided or not recognized")
 
@@ -584,42 +3273,43 @@ class Backend:
             return None
         return self._get_caller(data)
 
-    @log_execution_time
-    def authenticate(self, data: Mapping[str, Any]) -> None:
+    @traced
+    def authenticate(self, data: Mapping[str, Any]) -> User | None:
         """
-        Validates data["auth_token"] according to data["action"]
-        """
-        if (
-            (action := data.get("action")) is None
-            or not isinstance(action, str)
-            or action.startswith("_")
-            or "_" not in action
-        ):
-            raise ArgumentError(f"Invalid or missing action: {action}")
-
-        tmp = action.split("_")[0]
-        tmp = tmp[0].upper() + tmp[1:]
-        if tmp not in get_args(RoleOrAnyT):
-            raise ArgumentError(f"Invalid prefix {tmp} for action: {action}")
-        role = cast(RoleOrAnyT, tmp)
+        Validates data["auth_token"] according to the role of data["action"] and returns the caller.
 
+        For actions of role "Any" the caller is None unless the auth_token is recognized.
+        """
+        role = get_action(data)["role"]
         if role == "Any":
-            return
+            auth_token = data.get("auth_token")
+            return self._find_user_by_auth_token(auth_token) if isinstance(auth_token, str) else None
         user = self._get_caller(data)
-        if not role_includes(cast(RoleT, user["role"]), role):
+        if not role_includes(user["role"], role):
             raise ArgumentError(f"User is not authorized for role {role}")
+        return user
 
+    def _dispatch(self, data: Mapping[str, Any]) -> Mapping[str, Any]:
+        """
+        Validate, authenticate and execute a single action of a batch
+        """
+        spec = get_action(data)
+        if spec["name"] == "any_batch":
+            raise ArgumentError("Batches cannot be nested")
+        spec["validate"](data)
+        self.authenticate(data)
+        return spec["handler"](self, data)
+
+    @api_action(required={"role": str, "name": str}, choices={"role": get_args(RoleT)}, mutating=True)
     def admin_create_user(self, data: Mapping[str, Any]) -> Mapping[str, Any]:
         """
         Create a new user.
         """
-        role, name = parse(data, [("role", str), ("name", str)])  # pylint: disable=unbalanced-tuple-unpacking
-        if role not in get_args(RoleT):
-            raise ArgumentError(f"Invalid role: {role}")
-        name = unicodedata.normalize("NFKC", name.strip())
+        role = data["role"]
+        name = unicodedata.normalize("NFKC", data["name"].strip())
         if not 3 <= len(name) <= 60:
             raise ArgumentError("Name must have length in [3..60] (after normalization)")
-        if any(name == user["name"] for user in self._data["users"].values()):
+        if name in self._user_index["by_name"]:
             raise ArgumentError("Name already in use")
         user_id = make_id()
         user = User(
@@ -629,79 +3319,79 @@ class Backend:
             auth_token=make_auth_token(),
         )
         self._data["users"][user["user_id"]] = user
+        self._user_index["by_name"][name] = user_id
+        self._user_index["token_hashes"][user_id] = hash_token(user["auth_token"])
+        self._user_index["by_token_hash"][self._user_index["token_hashes"][user_id]] = user_id
         self._save_data()
         return user
 
+    @api_action(required={"user_id": str, "role": str, "name": str}, choices={"role": get_args(RoleT)}, mutating=True)
     def admin_update_user(self, data: Mapping[str, Any]) -> Mapping[str, Any]:
         """
         Update a user.
         """
-        user_id, role, name = parse(  # pylint: disable=unbalanced-tuple-unpacking
-            data, [("user_id", str), ("role", str), ("name", str)]
-        )
+        user_id, role, name = data["user_id"], data["role"], data["name"]
         if (user := self._data["users"].get(user_id)) is None:
             raise ArgumentError(f"User with id {user_id} not found")
-        if role not in get_args(RoleT):
-            raise ArgumentError(f"Invalid role: {role}")
         if not 3 <= len(name) <= 60:
             raise ArgumentError("Name must have length in [3..60]")
+        if self._user_index["by_name"].get(name, user_id) != user_id:
+            raise ArgumentError("Name already in use")
 
+        if self._user_index["by_name"].get(user["name"]) == user_id:
+            del self._user_index["by_name"][user["name"]]
+        self._user_index["by_name"][name] = user_id
         user["role"] = cast(RoleT, role)
         user["name"] = name
         self._save_data()
         return {}
 
+    @api_action(required={"user_id": str}, mutating=True)
     def admin_delete_user(self, data: Mapping[str, Any]) -> Mapping[str, Any]:
         """
         Deletes a user
         """
-        (user_id,) = parse(data, [("user_id", str)])  # pylint: disable=unbalanced-tuple-unpacking
-        user = self._data["users"].pop(user_id, None)
+        user_id = data["user_id"]
+        user = self._data["users"].get(user_id)
         if user is None:
             raise ArgumentError(f"User with id {user_id} not found")
         if user is self._get_caller(data):
             raise ArgumentError("Cannot delete yourself")
+        self._data["users"].pop(user_id)
+        if self._user_index["by_name"].get(user["name"]) == user_id:
+            del self._user_index["by_name"][user["name"]]
+        self._user_index["by_token_hash"].pop(self._user_index["token_hashes"].pop(user_id), None)
         self._save_data()
         return {}
 
+    @api_action(required={"user_id": str})
     def admin_show_auth_token(self, data: Mapping[str, Any]) -> Mapping[str, Any]:
         """
         Returns the private auth_token for a user
         """
-        (user_id,) = parse(data, [("user_id", str)])  # pylint: disable=unbalanced-tuple-unpacking
+        user_id = data["user_id"]
         if (user := self._data["users"].get(user_id)) is None:
             raise ArgumentError(f"User with id {user_id} not found")
         return {"auth_token": user["auth_token"]}
 
+    @api_action(
+        required={"joining_sessions": dict[str, str | None], "user_auth_tokens": list[str]},
+        choices={"joining_sessions": get_args(YesNoMaybeT) + (None,)},
+        mutating=True,
+    )
     def any_register_participation(self, data: Mapping[str, Any]) -> Mapping[str, Any]:
         """
         Register one of more users intended participation ("Yes"/"No"/"Maybe"/None) to one or more training sessions.
 
         None means unspecified/no information - the participance information is removed.
         """
-        (joining_sessions, user_auth_tokens) = parse(  # pylint: disable=unbalanced-tuple-unpacking
-            data,
-            [
-                ("joining_sessions", dict),
-                ("user_auth_tokens", list),
-            ],
-        )
-        if not all(
-            isinstance(session_id, str) and isinstance(joining, str) for session_id, joining in joining_sessions.items()
-        ):
-            raise ArgumentError("Invalid session data type")
+        joining_sessions, user_auth_tokens = data["joining_sessions"], data["user_auth_tokens"]
         if any(self._data["sessions"].get(session_id) is None for session_id in joining_sessions):
             raise ArgumentError("One or more unrecognized session ids")
-        if not all(joining is None or joining in get_args(YesNoMaybeT) for joining in joining_sessions.values()):
-            raise ArgumentError("One or more invalid values for joining")
-        if not all(isinstance(auth_token, str) for auth_token in user_auth_tokens):
-            raise ArgumentError("user_auth_tokens must be a list of strings")
 
-        user_auth_tokens_set = set(user_auth_tokens)
-        identified_users = []
-        for user in self._data["users"].values():
-            if user["auth_token"] in user_auth_tokens_set:
-                identified_users.append(user)
+        identified_users = [
+            user for auth_token in set(user_auth_tokens) if (user := self._find_user_by_auth_token(auth_token))
+        ]
 
         for session_id, joining in joining_sessions.items():
             session = self._data["sessions"][session_id]
@@ -714,6 +3404,73 @@ class Backend:
         self._save_data()
         return {}
 
+    @api_action(
+        required={"actions": list[dict[str, Any]]},
+        optional={"auth_token": str, "mode": str},
+        choices={"mode": get_args(BatchModeT)},
+        mutating=True,
+    )
+    def any_batch(self, data: Mapping[str, Any]) -> Mapping[str, Any]:
+        """
+        Execute several actions in order with a single save of data.json.
+
+        Each item of "actions" is a request as it would be sent on its own. Items without an auth_token use the
+        auth_token of the batch. Every item is authenticated separately.
+        With mode "atomic" (the default) nothing is saved if an item fails. Actions writing other objects than
+        data.json (e.g. coach_register_participation) are rejected in this mode, as their writes can't be undone.
+        With mode "best_effort" the error of a failed item is returned and the other items are saved.
+        The actions validate their arguments before modifying anything, so a failed item leaves no partial changes.
+        """
+        actions, mode = data["actions"], data.get("mode", "atomic")
+        if not 1 <= len(actions) <= MAX_BATCH_SIZE:
+            raise ArgumentError(f"Number of actions must be in [1..{MAX_BATCH_SIZE}]")
+        if mode == "atomic":
+            for index, item in enumerate(actions):
+                name = item.get("action")
+                if isinstance(name, str) and name in ACTIONS and not ACTIONS[name]["atomic"]:
+                    raise ArgumentError(f"Action {index} ({name}) can't be part of an atomic batch")
+
+        defaults = {"auth_token": data["auth_token"]} if "auth_token" in data else {}
+        results: list[Mapping[str, Any]] = []
+        self._defer_save = True
+        try:
+            for index, item in enumerate(actions):
+                try:
+                    results.append({"result": self._dispatch(defaults | item)})
+                except ArgumentError as exc:
+                    if mode == "atomic":
+                        raise ArgumentError(f"Action {index} ({item.get('action')}) failed: {exc}") from exc
+                    results.append({"error": str(exc)})
+        finally:
+            self._defer_save = False
+
+        if self._save_pending:
+            self._save_data()
+        return {"results": results}
+
+    @api_action(
+        required={"start_time": int, "end_time": int},
+        optional={"states": list[str]},
+        choices={"states": get_args(SessionStateT)},
+    )
+    def any_get_sessions(self, data: Mapping[str, Any]) -> Mapping[str, Any]:
+        """
+        Return the sessions starting in [start_time, end_time[ sorted by start time, optionally only those in states.
+
+        The sessions in the range are found by bisecting the session index.
+        """
+        start_time, end_time = data["start_time"], data["end_time"]
+        if start_time >= end_time:
+            raise ArgumentError(f"Invalid time range: {start_time} >= {end_time}")
+        states = data.get("states", get_args(SessionStateT))
+
+        by_start_time = self._session_index["by_start_time"]
+        first = bisect.bisect_left(by_start_time, (start_time,))
+        last = bisect.bisect_left(by_start_time, (end_time,), lo=first)
+        sessions = (self._data["sessions"][session_id] for _, session_id in by_start_time[first:last])
+        return {"sessions": [session for session in sessions if session["state"] in states]}
+
+    @api_action()
     def any_trigger_initialization(  # pylint: disable=unused-argument
         self, data: Mapping[str, Any]
     ) -> Mapping[str, Any]:
@@ -722,6 +3479,14 @@ class Backend:
         """
         return {}
 
+    @api_action()
+    def any_describe_api(self, data: Mapping[str, Any]) -> Mapping[str, Any]:  # pylint: disable=unused-argument
+        """
+        Return the actions with their role and the JSON Schema of their request
+        """
+        return describe_api()
+
+    @api_action(optional={"test_secret": str}, atomic=False)
     def any_reset_test_setup(self, data: Mapping[str, Any]) -> Mapping[str, Any]:  # pylint: disable=unused-argument
         """
         This requires the environment variable TEST_SECRET to be set.
@@ -731,96 +3496,212 @@ class Backend:
             raise ArgumentError("TEST_SECRET is not defined in the backend")
         if data.get("test_secret") != TEST_SECRET:
             raise ArgumentError("Invalid test secret")
+        version = self._data.get("version", 0)
         self._data, historic_data = make_test_data()
+        self._data["version"] = version  # Versions must keep increasing for the clients following the change log
+        self._user_index = make_user_index(self._data["users"])
+        self._session_index = make_session_index(self._data["sessions"])
         self._save_data()
 
-        historic_data_this_year = {}
-        historic_data_last_year = {}
-        yyyy_this = datetime.datetime.fromtimestamp(int(time.time()), datetime.timezone.utc).strftime("%Y")
-        yyyy_last = str(int(yyyy_this) - 1)
-        for participation in historic_data.values():
-            yyyy = datetime.datetime.fromtimestamp(
-                participation["session"]["start_time"], datetime.timezone.utc
-            ).strftime("%Y")
-            if yyyy == yyyy_this:
-                historic_data_this_year[participation["session"]["session_id"]] = participation
-            else:
-                historic_data_last_year[participation["session"]["session_id"]] = participation
-
-        if historic_data_this_year:
-            self._write_to_private_s3(data=historic_data_this_year, key=f"sessions/participation_data_{yyyy_this}.json")
-        if historic_data_last_year:
-            self._write_to_private_s3(data=historic_data_last_year, key=f"sessions/participation_data_{yyyy_last}.json")
+        history_by_partition: dict[str, dict[str, Participation]] = {}
+        for session_id, participation in historic_data.items():
+            partition = history_partition(participation["session"]["start_time"])
+            history_by_partition.setdefault(partition, {})[session_id] = participation
+        for partition, history in history_by_partition.items():
+            self._write_to_private_s3(data=history, key=history_key(partition))
+        # Partitions from earlier test setups are dropped by overwriting the manifest
+        self._write_to_private_s3(
+            data=HistoryManifestT(partitions=sorted(history_by_partition)), key=HISTORY_MANIFEST_KEY
+        )
+        for partition, history in history_by_partition.items():
+            self._write_monthly_attendance(partition, history)
 
         return {}
 
+    @api_action(atomic=False)
+    def admin_compact_journal(self, data: Mapping[str, Any]) -> Mapping[str, Any]:  # pylint: disable=unused-argument
+        """
+        Write the data including all journal entries as a new snapshot (SAVE_MODE "journal").
+
+        Run this before switching to SAVE_MODE "snapshot", which does not read the journal.
+        """
+        if SAVE_MODE != "journal":
+            raise ArgumentError("SAVE_MODE is not journal")
+        self._compact_journal(force=True)
+        return {"version": self._data.get("version", 0)}
+
+    @api_action(atomic=False)
+    def admin_migrate_participation_history(  # pylint: disable=unused-argument
+        self, data: Mapping[str, Any]
+    ) -> Mapping[str, Any]:
+        """
+        One-shot migration of the yearly history files to the monthly history partitions.
+
+        Sessions already present in a monthly partition are kept as is. It is safe to run this more than once.
+        """
+        history_by_partition: dict[str, dict[str, Participation]] = {}
+        yyyy_this = int(datetime.datetime.fromtimestamp(int(time.time()), datetime.timezone.utc).strftime("%Y"))
+        for yyyy in range(int(history_partition(EARLIEST_HISTORY_TIME)[:4]), yyyy_this + 1):
+            try:
+                legacy_history = cast(
+                    dict[str, Participation], self._read_from_private_s3(key=legacy_history_key(yyyy))
+                )
+            except S3Error as e:
+                if e.code == "NoSuchKey":
+                    continue
+                raise
+            for session_id, participation in legacy_history.items():
+                partition = history_partition(participation["session"]["start_time"])
+                history_by_partition.setdefault(partition, {})[session_id] = participation
+
+        for partition, legacy_partition in sorted(history_by_partition.items()):
+            history, etag = self._read_history(partition)
+            self._write_to_private_s3(data=legacy_partition | history, key=history_key(partition), if_match=etag)
+        self._add_history_partitions(history_by_partition)
+
+        self._rebuild_attendance_summary()
+
+        return {
+            "migrated_sessions": sum(len(history) for history in history_by_partition.values()),
+            "partitions": sorted(history_by_partition),
+        }
+
+    @api_action(atomic=False)
+    def admin_rebuild_attendance_summary(  # pylint: disable=unused-argument
+        self, data: Mapping[str, Any]
+    ) -> Mapping[str, Any]:
+        """
+        Recreate the attendance of every month from its history partition
+        """
+        summary = self._rebuild_attendance_summary()
+        return {"users": len(summary["users"])}
+
+    @api_action(
+        required={"start_time": int, "end_time": int, "coach": str | None, "comment": str | None}, mutating=True
+    )
     def coach_add_training_session(self, data: Mapping[str, Any]) -> Mapping[str, Any]:
         """
         Add a training session
         """
-        (start_time, end_time, coach, comment) = parse(  # pylint: disable=unbalanced-tuple-unpacking
-            data,
-            [
-                ("start_time", int),
-                ("end_time", int),
-                ("coach", str | None),
-                ("comment", str | None),
-            ],
-        )
+        start_time, end_time, coach, comment = data["start_time"], data["end_time"], data["coach"], data["comment"]
         if coach not in self._data["users"]:
             raise ArgumentError(f"Unrecognized coach: {coach}")
-        session_id = make_id()
-        session = TrainingSession(
-            session_id=session_id,
-            start_time=start_time,
-            end_time=end_time,
-            state="scheduled",
-            coach=coach,
-            comment=comment,
-            participation={coach: "Yes"},
-        )
-        self._data["sessions"][session_id] = session
+        session = make_training_session(start_time, end_time, coach, comment)
+        self._data["sessions"][session["session_id"]] = session
+        add_to_session_index(self._session_index, session)
         self._save_data()
         return {"session": session}
 
+    @api_action(
+        required={
+            "weekday": int,
+            "time_of_day": str,
+            "duration": int,
+            "first_date": str,
+            "last_date": str,
+            "coach": str | None,
+            "comment": str | None,
+        },
+        optional={"excluded_dates": list[str], "timezone": str},
+        mutating=True,
+    )
+    def coach_add_recurring_sessions(  # pylint: disable=too-many-locals
+        self, data: Mapping[str, Any]
+    ) -> Mapping[str, Any]:
+        """
+        Add a weekly training session on every weekday in [first_date, last_date] except the excluded dates.
+
+        time_of_day is the local time in the time zone. All sessions are rejected if any of them overlaps
+        an existing session that is not cancelled.
+        """
+        weekday, duration, coach = data["weekday"], data["duration"], data["coach"]
+        if not 0 <= weekday <= 6:
+            raise ArgumentError(f"Invalid weekday (Monday is 0): {weekday}")
+        if not 0 < duration <= 86400:
+            raise ArgumentError(f"Invalid duration (seconds): {duration}")
+        if coach not in self._data["users"]:
+            raise ArgumentError(f"Unrecognized coach: {coach}")
+        excluded_dates = data.get("excluded_dates", [])
+        timezone = data.get("timezone", DEFAULT_TIMEZONE)
+        from zoneinfo import ZoneInfo, ZoneInfoNotFoundError  # pylint: disable=import-outside-toplevel
+
+        try:
+            tzinfo = ZoneInfo(timezone)
+        except (ZoneInfoNotFoundError, ValueError) as exc:
+            raise ArgumentError(f"Unrecognized timezone: {timezone}") from exc
+        try:
+            first_date = datetime.date.fromisoformat(data["first_date"])
+            last_date = datetime.date.fromisoformat(data["last_date"])
+            earliest_date = datetime.datetime.fromtimestamp(EARLIEST_HISTORY_TIME, tzinfo).date()
+            latest_date = datetime.datetime.now(tzinfo).date() + datetime.timedelta(days=MAX_SCHEDULE_DAYS)
+            for date in [first_date, last_date]:
+                if not earliest_date <= date <= latest_date:
+                    raise ArgumentError(f"Invalid date (not in [{earliest_date}, {latest_date}]): {date}")
+            intervals = make_weekly_intervals(
+                weekday,
+                datetime.time.fromisoformat(data["time_of_day"]),
+                duration,
+                first_date,
+                last_date,
+                {datetime.date.fromisoformat(excluded_date) for excluded_date in excluded_dates},
+                tzinfo,
+            )
+        except (ValueError, OverflowError) as exc:
+            raise ArgumentError(f"Invalid date or time: {exc}") from exc
+        if not intervals:
+            raise ArgumentError("No sessions in the date range")
+        if len(intervals) > MAX_RECURRING_SESSIONS:
+            raise ArgumentError(f"More than {MAX_RECURRING_SESSIONS} sessions")
+
+        active_sessions = (session for session in self._data["sessions"].values() if session["state"] != "cancelled")
+        if overlaps := find_overlaps(active_sessions, intervals):
+            raise ArgumentError(
+                "Overlapping existing sessions: "
+                + ", ".join(datetime.datetime.fromtimestamp(start, tzinfo).isoformat() for start, _ in overlaps)
+            )
+
+        sessions = [
+            make_training_session(start_time, end_time, coach, data["comment"]) for start_time, end_time in intervals
+        ]
+        for session in sessions:
+            self._data["sessions"][session["session_id"]] = session
+            add_to_session_index(self._session_index, session)
+        self._save_data()
+        return {"sessions": sessions}
+
     def _coach_set_training_session_state(self, data: Mapping[str, Any]) -> Mapping[str, Any]:
         """
         Changes the state of a training session
         """
-        (session_id, session_state) = parse(  # pylint: disable=unbalanced-tuple-unpacking
-            data,
-            [
-                ("session_id", str),
-                ("session_state", str),
-            ],
-        )
+        session_id, session_state = data["session_id"], data["session_state"]
         if (session := self._data["sessions"].get(session_id)) is None:
             raise ArgumentError(f"Unrecognized session id: {session_id}")
         if session_state == "deleted":
             self._data["sessions"].pop(session_id)
+            remove_from_session_index(self._session_index, session)
         else:
-            if session_state not in get_args(SessionStateT):
-                raise ArgumentError(f"Unrecognized session state: {session_state}")
+            remove_from_session_index(self._session_index, session)
             session["state"] = session_state
+            add_to_session_index(self._session_index, session)
         self._save_data()
         return {}
 
+    @api_action(
+        required={"session_id": str},
+        either=[
+            {"session_state": str},
+            {"start_time": int, "end_time": int, "coach": str | None, "comment": str | None},
+        ],
+        choices={"session_state": get_args(SessionStateT) + ("deleted",)},
+        mutating=True,
+    )
     def coach_update_training_session(self, data: Mapping[str, Any]) -> Mapping[str, Any]:
         """
-        Update a training session
+        Update a training session: Either its state (or delete it) or its time, coach and comment.
         """
         if "session_state" in data:
             return self._coach_set_training_session_state(data)
-        (session_id, start_time, end_time, coach, comment) = parse(  # pylint: disable=unbalanced-tuple-unpacking
-            data,
-            [
-                ("session_id", str),
-                ("start_time", int),
-                ("end_time", int),
-                ("coach", str | None),
-                ("comment", str | None),
-            ],
-        )
+        session_id, coach = data["session_id"], data["coach"]
         if (session := self._data["sessions"].get(session_id)) is None:
             raise ArgumentError(f"Unrecognized session id: {session_id}")
         if self._data["sessions"][session_id]["state"] != "scheduled":
@@ -828,97 +3709,195 @@ class Backend:
         if coach not in self._data["users"]:
             raise ArgumentError(f"Unrecognized coach: {coach}")
 
-        session["start_time"] = start_time
-        session["end_time"] = end_time
+        remove_from_session_index(self._session_index, session)
+        session["start_time"] = data["start_time"]
+        session["end_time"] = data["end_time"]
         session["coach"] = coach
-        session["comment"] = comment
+        session["comment"] = data["comment"]
+        add_to_session_index(self._session_index, session)
         self._save_data()
         return {"session": session}
 
+    @api_action(required={"session_id": str, "participants": list[str]}, mutating=True, atomic=False)
     def coach_register_participation(self, data: Mapping[str, Any]) -> Mapping[str, Any]:
         """
         Register who actually showed up to a training session.
         """
-        (session_id, participants) = parse(  # pylint: disable=unbalanced-tuple-unpacking
-            data,
-            [
-                ("session_id", str),
-                ("participants", list),
-            ],
-        )
+        session_id, participants = data["session_id"], data["participants"]
         if (session := self._data["sessions"].get(session_id)) is None:
             raise ArgumentError(f"Unrecognized session id: {session_id}")
         if self._data["sessions"][session_id]["state"] not in ["scheduled", "archived"]:
             raise ArgumentError(f"Session is not scheduled or archived: {session_id}")
         if time.time() < session["start_time"] - 600:
             raise ArgumentError("Training session wont start for at least another 10 minutes - too early to register")
-        if not all(isinstance(user_id, str) for user_id in participants):
-            raise ArgumentError(f"Each participant must be a string id: {participants}")
         if not set(participants) <= set(self._data["users"]):
             raise ArgumentError(f"Unrecognized users: {set(participants) - set(self._data['users'])}")
 
-        yyyy = datetime.datetime.fromtimestamp(session["start_time"], datetime.timezone.utc).strftime("%Y")
-        key = f"sessions/participation_data_{yyyy}.json"
-        try:
-            history: dict[str, Participation] = self._read_from_private_s3(key=key)
-        except ClientError as e:
-            if e.response["Error"]["Code"] == "NoSuchKey":
-                history = {}
-
+        partition = history_partition(session["start_time"])
+        # Read before the history partition. See _write_monthly_attendance
+        attendance_etag = self._read_monthly_attendance_etag(partition)
+        history, history_etag = self._read_history(partition)
         participants.sort()
         history[session_id] = Participation(
             session=session,
             participants=participants,
         )
-        self._write_to_private_s3(data=history, key=key)
-
-        self._data["sessions"][session_id]["state"] = "archived"
+        self._write_to_private_s3(data=history, key=history_key(partition), if_match=history_etag)
+        if not history_etag:
+            self._add_history_partitions([partition])
+        self._write_monthly_attendance(partition, history, if_match=attendance_etag)
+
+        remove_from_session_index(self._session_index, session)
+        session["state"] = "archived"
+        add_to_session_index(self._session_index, session)
         self._save_data()
         return {}
 
+    @api_action(required={"start_time": int, "end_time": int}, optional={"limit": int, "cursor": str})
     def coach_get_historical_participation(self, data: Mapping[str, Any]) -> Mapping[str, Any]:
         """
         Return historical participation data.
 
         Return data for all historical sessions where the session start_time is in the range [start_time, end_time[
+
+        With limit or cursor, a page of up to limit sessions and the cursor of the next page (None after the last).
+        Only the partitions up to the end of the page are read.
         """
-        (start_time, end_time) = parse(  # pylint: disable=unbalanced-tuple-unpacking
-            data,
-            [
-                ("start_time", int),
-                ("end_time", int),
-            ],
-        )
-        if start_time >= end_time:
-            raise ArgumentError(f"Invalid time range: {start_time} >= {end_time}")
-        if start_time < 1700000000:
-            raise ArgumentError(f"Invalid start time (too far in the past): {start_time}")
-        if end_time > time.time() + 31 * 86400:
-            raise ArgumentError(f"Invalid end time (in the future): {end_time}")
+        start_time, end_time = data["start_time"], data["end_time"]
+        check_history_range(start_time, end_time)
+        if (limit := data.get("limit")) is not None and not 1 <= limit <= MAX_HISTORY_PAGE_SIZE:
+            raise ArgumentError(f"Invalid limit: {limit}")
+        after = decode_history_cursor(data["cursor"]) if "cursor" in data else None
+        if after is not None and not start_time <= after[0] < end_time:
+            raise ArgumentError(f"Invalid cursor (not in the time range): {data['cursor']}")
+
+        participations = self._iter_history(start_time, end_time, after)
+        result = {}
+        last = None
+        for session_id, participation in itertools.islice(participations, limit):
+            last = (participation["session"]["start_time"], session_id)
+            result[session_id] = {
+                "session": {
+                    "start_time": participation["session"]["start_time"],
+                    "end_time": participation["session"]["end_time"],
+                    "coach": participation["session"]["coach"],
+                    "comment": participation["session"]["comment"],
+                },
+                "participants": participation["participants"],
+            }
 
-        yyyy_first = int(datetime.datetime.fromtimestamp(start_time, datetime.timezone.utc).strftime("%Y"))
-        yyyy_last = int(datetime.datetime.fromtimestamp(end_time - 1, datetime.timezone.utc).strftime("%Y"))
+        if limit is None and after is None:
+            return result
+        # The page is complete if no session follows it
+        cursor = encode_history_cursor(*last) if last and next(participations, None) is not None else None
+        return {"sessions": result, "cursor": cursor}
 
-        result = {}
-        for yyyy in range(yyyy_first, yyyy_last + 1):
-            key = f"sessions/participation_data_{yyyy}.json"
-            try:
-                history: dict[str, Participation] = self._read_from_private_s3(key=key)
-            except ClientError as e:
-                if e.response["Error"]["Code"] == "NoSuchKey":
-                    continue
+    def _iter_export_rows(self, start_time: int, end_time: int) -> Iterator[tuple[str, ...]]:
+        """
+        Yield EXPORT_COLUMNS and a row per participant of each session of the history in [start_time, end_time[
+        """
+        from zoneinfo import ZoneInfo  # pylint: disable=import-outside-toplevel
+
+        tzinfo = ZoneInfo(DEFAULT_TIMEZONE)
+        users = self._data["users"]
+
+        def user_name(user_id: str) -> str:
+            # Deleted users have no name
+            return users[user_id]["name"] if user_id in users else ""
+
+        yield EXPORT_COLUMNS
+        for session_id, participation in self._iter_history(start_time, end_time):
+            session = participation["session"]
+            coach = session.get("coach") or ""
+            session_columns = (
+                session_id,
+                datetime.datetime.fromtimestamp(session["start_time"], tzinfo).isoformat(),
+                datetime.datetime.fromtimestamp(session["end_time"], tzinfo).isoformat(),
+                coach,
+                user_name(coach),
+                session["comment"],
+            )
+            for user_id in participation["participants"]:
+                yield session_columns + (user_id, user_name(user_id))
+
+    @api_action(required={"start_time": int, "end_time": int}, atomic=False)
+    def coach_export_participation(self, data: Mapping[str, Any]) -> Mapping[str, Any]:
+        """
+        Write the participation in the sessions starting in [start_time, end_time[ as CSV to the private bucket.
+
+        Returns the key and a presigned URL (None if the storage has no URLs) of the CSV instead of its content.
+        The history is read a few partitions at a time and uploaded in parts of EXPORT_PART_SIZE, so the memory
+        used does not depend on the length of the range.
+        """
+        start_time, end_time = data["start_time"], data["end_time"]
+        check_history_range(start_time, end_time)
+        key = (
+            f"{EXPORT_KEY_PREFIX}participation_{history_partition(start_time)}_{history_partition(end_time - 1)}"
+            f"_{os.urandom(8).hex()}.csv"
+        )
+        chunks = encode_csv_chunks(self._iter_export_rows(start_time, end_time), EXPORT_PART_SIZE)
+        with trace_span("upload_in_parts", key=key):
+            upload_in_parts(self._client, PRIVATE_BUCKET_NAME, key, chunks, "text/csv; charset=utf-8")
+        S3_WRITES["done"] += 1
+        return {"key": key, "url": self._client.presign_get_object(PRIVATE_BUCKET_NAME, key, EXPORT_URL_EXPIRES)}
+
+    @api_action(
+        required={"start_time": int, "end_time": int},
+        optional={"group_by": str},
+        choices={"group_by": get_args(AttendanceGroupT)},
+    )
+    def coach_get_attendance_stats(self, data: Mapping[str, Any]) -> Mapping[str, Any]:
+        """
+        Return how often each user attended the sessions starting in [start_time, end_time[.
+
+        With group_by "coach" or "weekday" (in DEFAULT_TIMEZONE, Monday is 0) per coach or weekday with sessions
+        instead of in total ("user", the default). The history partitions are cached as bitsets, see
+        ParticipationMatrixT, so only their revalidation takes time once they are read.
+        """
+        start_time, end_time = data["start_time"], data["end_time"]
+        check_history_range(start_time, end_time)
+        matrix = self._load_participation_matrix(start_time, end_time)
+        with trace_span("count_attendance"):
+            return {"groups": count_attendance(matrix, start_time, end_time, data.get("group_by", "user"))}
+
+    @api_action(optional={"since": int | None})
+    def coach_get_attendance_summary(self, data: Mapping[str, Any]) -> Mapping[str, Any]:
+        """
+        Return the attendance of every user who attended at least one session.
 
-            for session_id, participation in history.items():
-                if start_time <= participation["session"]["start_time"] < end_time:
-                    result[session_id] = {
-                        "session": {
-                            "start_time": participation["session"]["start_time"],
-                            "end_time": participation["session"]["end_time"],
-                            "coach": participation["session"]["coach"],
-                            "comment": participation["session"]["comment"],
-                        },
-                        "participants": participation["participants"],
-                    }
+        With the optional "since" also the number of sessions attended with start_time >= since.
+        """
+        since = data.get("since")
+        if since is not None:
+            if since > time.time() + 31 * 86400:
+                raise ArgumentError(f"Invalid since (in the future): {since}")
+            # The history has no earlier sessions, so the counts are the same
+            since = max(since, EARLIEST_HISTORY_TIME)
+
+        summary = self._read_attendance_summary()
+
+        result: dict[str, dict[str, Any]] = {
+            user_id: {
+                "total": attendance["total"],
+                "last_attended": attendance["last_attended"],
+                "per_month": {month: attendance["months"][month]["count"] for month in sorted(attendance["months"])},
+            }
+            for user_id, attendance in summary["users"].items()
+        }
+
+        if since is not None:
+            # Whole months after the month of since are taken from the summary. The month of since is counted exactly.
+            since_partition = history_partition(since)
+            history, _ = self._read_history(since_partition)
+            since_partition_counts: dict[str, int] = {}
+            for participation in history.values():
+                if participation["session"]["start_time"] >= since:
+                    for user_id in participation["participants"]:
+                        since_partition_counts[user_id] = since_partition_counts.get(user_id, 0) + 1
+            for user_id, attendance in summary["users"].items():
+                result[user_id]["attended_since"] = since_partition_counts.get(user_id, 0) + sum(
+                    month["count"] for partition, month in attendance["months"].items() if partition > since_partition
+                )
 
         return result
 
@@ -978,25 +3957,24 @@ class EventT(TypedDict):
     isBase64Encoded: bool
 
 
-def parse(data: Mapping[str, Any], keys_and_types: list[tuple[str, Any]]) -> tuple[Any, ...]:
+def lambda_handler(event: dict[str, Any], context: LambdaContext) -> dict[str, Any]:
     """
-    Convenience function
+    The handler function called by AWS
     """
-    result = []
-    for key, key_type in keys_and_types:
-        if key not in data:
-            raise ArgumentError(f"Missing key {key}")
-        if not isinstance(data[key], key_type):
-            raise ArgumentError(f"Invalid type of key {key}")
-        result.append(data[key])
-    return tuple(result)
+    if not TRACING:
+        return handle_request(event)
+    with trace_request(getattr(context, "aws_request_id", None)):
+        response = handle_request(event)
+        add_span_attributes(status_code=response["statusCode"])
+        return response
 
 
-def lambda_handler(event: dict[str, Any], context: LambdaContext) -> dict[str, Any]:  # pylint: disable=unused-argument
+def handle_request(event: dict[str, Any]) -> dict[str, Any]:
     """
-    The handler function called by AWS
+    Respond to a request to the function URL
     """
-    logger.info(f"Raw event: {json.dumps(event)}")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Raw event without body: %s", LoggedRequest({k: v for k, v in event.items() if k != "body"}))
 
     access_control_headers = {
         "Access-Control-Allow-Headers": "Content-Type",
@@ -1009,33 +3987,338 @@ def lambda_handler(event: dict[str, Any], context: LambdaContext) -> dict[str, A
 
     try:
         if (is_base_64_encoded := event.get("isBase64Encoded")) is not None:
-            data = json.loads(base64.b64decode(event.get("body", "")) if is_base_64_encoded else event.get("body", {}))
+            with trace_span("json_decode", key="request"):
+                body = event.get("body", "")
+                data = json.loads(base64.b64decode(body) if is_base_64_encoded else body)
         else:
             data = event
     except json.decoder.JSONDecodeError as exc:
         return {"statusCode": 400, "body": f"Body is not valid json: {exc}"}
+    if isinstance(data, dict) and isinstance(action := data.get("action"), str):
+        # The action is the dimension of the metrics. Each name sent would otherwise add a metric
+        add_span_attributes(action=action if action in ACTIONS else "unknown")
 
-    logger.info(f"Parsed request data: {json.dumps(data)}")
+    if logged := is_request_logged(data.get("action") if isinstance(data, dict) else None):
+        logger.info("Request: %s", LoggedRequest(data))
 
     headers = {"headers": {"Content-Type": "application/json"} | access_control_headers}
 
-    backend = Backend()
+    S3_WRITES.update(done=0, skipped=0)
+    if get_request_id(data) is None:
+        status_code, response_body, attempt = run_action_with_retries(data)
+    else:
+        status_code, response_body, attempt = run_idempotent_action(data)
+    logger.info("S3 writes: %d done, %d skipped", S3_WRITES["done"], S3_WRITES["skipped"])
+    if status_code != 200 and not logged:
+        # Failed requests are always logged
+        logger.info("Failed request: %s", LoggedRequest(data))
+    add_span_attributes(attempts=attempt)
+
+    with trace_span("json_encode", key="response"):
+        body = json.dumps(response_body)
+    return {
+        "statusCode": status_code,
+        "body": body,
+    } | headers
+
+
+def run_action_with_retries(
+    data: Mapping[str, Any], backend: Backend | None = None
+) -> tuple[int, Mapping[str, Any], int]:
+    """
+    Run the action until it does not conflict with other requests, up to MAX_ATTEMPTS times.
+    The first attempt uses backend if given.
+
+    Returns the status code, the response body and the number of attempts.
+    """
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        try:
+            status_code, response_body = run_action(data, backend if attempt == 1 else None)
+        except ConcurrentModificationError as exc:
+            # Another request won the race. Start over with freshly loaded data.
+            forget_cached_data()
+            logger.info("Attempt %d of %d failed: %s", attempt, MAX_ATTEMPTS, exc)
+            if attempt == MAX_ATTEMPTS:
+                return 409, {"error": str(exc)}, attempt
+            time.sleep(SystemRandom().uniform(0, 0.025 * 2**attempt))
+            continue
+        return status_code, response_body, attempt
+    raise AssertionError("Unreachable")
+
+
+def get_request_id(data: Any) -> str | None:
+    """
+    Return the request_id of a request of a mutating action. None if it has none.
+    """
+    if not isinstance(data, dict) or not isinstance(request_id := data.get("request_id"), str):
+        return None
+    spec = ACTIONS.get(action) if isinstance(action := data.get("action"), str) else None
+    return request_id if spec is not None and spec["mutating"] else None
+
+
+def put_idempotency_record(client: S3Client, key: str, record: IdempotencyRecordT, if_match: str | None = None) -> str:
+    """
+    Write the record of a request_id and return its ETag. Without if_match only if there is none.
+    """
+    body = json.dumps(record).encode("utf-8")
+    with trace_span("s3_put", key=key, bytes=len(body)):
+        etag = client.put_object(
+            PRIVATE_BUCKET_NAME, key, body, if_match=if_match, if_none_match="*" if if_match is None else None
+        )
+    S3_WRITES["done"] += 1
+    return etag
+
+
+def make_idempotency_record(request_hash: str, outcome: tuple[int, Mapping[str, Any]] | None) -> IdempotencyRecordT:
+    """
+    Return the record keeping the outcome of a request, or releasing its request_id (an expired record) if None
+    """
+    if outcome is None:
+        return IdempotencyRecordT(request_hash=request_hash, expires=0.0, status_code=0, response=None)
+    response: Mapping[str, Any] | None = outcome[1]
+    if len(json.dumps(response)) > MAX_IDEMPOTENT_RESPONSE_SIZE:
+        response = None
+    return IdempotencyRecordT(
+        request_hash=request_hash, expires=time.time() + IDEMPOTENCY_TTL, status_code=outcome[0], response=response
+    )
+
+
+def run_idempotent_action(  # pylint: disable=too-many-locals
+    data: Mapping[str, Any],
+) -> tuple[int, Mapping[str, Any], int]:
+    """
+    Run a mutating action with a request_id once. Returns like run_action_with_retries.
+
+    The request is validated and authenticated first, so an invalid or unauthorized request writes nothing and
+    can't claim a request_id. Each caller has its own request_ids: the outcome is kept in
+    idempotency/{user_id}/{request_id}.json for IDEMPOTENCY_TTL. A request without a recognized caller (of an action
+    of role "Any") is scoped by its own hash instead of a user_id.
+    A request with the same request_id gets the same response without running the action again. On a warm instance
+    it is answered from IDEMPOTENCY_CACHE without reading the object. Before the action runs, the object is created
+    with If-None-Match, which reserves the request_id: a retry that arrives while the request is still running gets
+    status 409 instead of running the action twice.
+    A request_id used for a different request is an error. The outcome is not kept for status 409, so the request
+    can be retried with the same request_id.
+    """
+    request_id = data["request_id"]
     try:
-        backend.authenticate(data)
+        if not REQUEST_ID_PATTERN.fullmatch(request_id):
+            raise ArgumentError(f"Invalid request_id: {request_id}")
+        get_action(data)["validate"](data)
+        backend = Backend(data)  # Only loaded for a valid request
+        caller = backend.authenticate(data)
     except ArgumentError as exc:
-        return {"statusCode": 400, "body": json.dumps({"error": str(exc)})} | headers
+        return 400, {"error": str(exc)}, 0
+    request_hash = hashlib.sha256(json.dumps(data, sort_keys=True).encode("utf-8")).hexdigest()
+    key = f"{IDEMPOTENCY_PREFIX}{request_hash if caller is None else caller['user_id']}/{request_id}.json"
+
+    def replay(record: IdempotencyRecordT) -> tuple[int, Mapping[str, Any], int]:
+        if record["request_hash"] != request_hash:
+            return 400, {"error": f"request_id {request_id} was used for a different request"}, 0
+        if not record["status_code"]:
+            return 409, {"error": f"Request {request_id} is in progress"}, 0
+        logger.info("Replaying the response to request %s", request_id)
+        response = record["response"]
+        return record["status_code"], {"request_id": request_id} if response is None else response, 0
+
+    if (cached := IDEMPOTENCY_CACHE.get(key)) is not None and cached["expires"] > time.time():
+        return replay(cached)
+
+    client = create_s3_client()
+    pending = IdempotencyRecordT(
+        request_hash=request_hash, expires=time.time() + IDEMPOTENCY_PENDING_TTL, status_code=0, response=None
+    )
+    with trace_span("reserve_request_id"):
+        try:
+            etag = put_idempotency_record(client, key, pending)
+        except S3Error as e:
+            if e.code not in CONFLICT_ERROR_CODES:
+                raise
+            # The request_id was seen before. Its record is taken over once it has expired.
+            body, current_etag = client.get_object(PRIVATE_BUCKET_NAME, key)
+            if (record := cast(IdempotencyRecordT, json.loads(body))).get("expires", 0) > time.time():
+                return replay(record)
+            try:
+                etag = put_idempotency_record(client, key, pending, if_match=current_etag)
+            except S3Error as e2:
+                if e2.code not in CONFLICT_ERROR_CODES:
+                    raise
+                return 409, {"error": f"Request {request_id} is in progress"}, 0
+
+    def complete(outcome: tuple[int, Mapping[str, Any]] | None) -> None:
+        # Keep the outcome, or release the request_id if None. A failure only affects retries, so the response is
+        # still returned.
+        record = make_idempotency_record(request_hash, outcome)
+        if outcome is not None:
+            IDEMPOTENCY_CACHE[key] = record
+            if len(IDEMPOTENCY_CACHE) > MAX_CACHED_IDEMPOTENCY_RECORDS:
+                del IDEMPOTENCY_CACHE[next(iter(IDEMPOTENCY_CACHE))]
+        try:
+            with trace_span("complete_request_id"):
+                put_idempotency_record(client, key, record, if_match=etag)
+        except Exception:  # pylint: disable=broad-exception-caught
+            logger.exception("Failed to update request_id %s", request_id)
 
     try:
-        action_func = cast(Callable[[dict[str, Any]], dict[str, Any]], getattr(backend, data["action"]))
-    except AttributeError as exc:
-        return {"statusCode": 400, "body": json.dumps({"error": f"Unknown action {data['action']}"})} | headers
+        status_code, response_body, attempt = run_action_with_retries(data, backend)
+    except Exception:
+        complete(None)
+        raise
+    complete(None if status_code == 409 else (status_code, response_body))
+    return status_code, response_body, attempt
+
+
+def run_action(data: Mapping[str, Any], backend: Backend | None = None) -> tuple[int, Mapping[str, Any]]:
+    """
+    Executes the requested action on freshly loaded data, or with backend if given.
 
+    The request is validated before the data is loaded. Returns the status code and the response body.
+    """
     try:
-        response_body = action_func(data)
+        spec = get_action(data)
+        spec["validate"](data)
     except ArgumentError as exc:
-        return {"statusCode": 400, "body": json.dumps({"error": str(exc)})} | headers
+        return 400, {"error": str(exc)}
 
-    return {
-        "statusCode": 200,
-        "body": json.dumps(response_body),
-    } | headers
+    backend = backend or Backend(data)
+    try:
+        backend.authenticate(data)
+    except ArgumentError as exc:
+        return 400, {"error": str(exc)}
+
+    try:
+        with trace_span(spec["name"]):
+            return 200, spec["handler"](backend, data)
+    except ArgumentError as exc:
+        # The action may have modified the cached data before failing
+        forget_cached_data()
+        return 400, {"error": str(exc)}
+    except Exception:
+        forget_cached_data()
+        raise
+
+
+def serve(host: str, port: int) -> None:
+    """
+    Serve the actions and the public objects over HTTP, for running the backend without Lambda.
+
+    POST / takes the same requests as the Lambda function URL. GET /public/<key> returns a public object.
+    The requests are executed one at a time as they share the cached data.
+    """
+    # Imported here as only needed outside of Lambda
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer  # pylint: disable=import-outside-toplevel
+
+    lock = threading.Lock()
+
+    class RequestHandler(BaseHTTPRequestHandler):
+        """
+        Translates HTTP requests to lambda_handler events
+        """
+
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True  # The headers and the body are sent separately
+
+        def _send(self, status: int, headers: Mapping[str, str], body: bytes) -> None:
+            self.send_response(status)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            if self.command != "HEAD":
+                self.wfile.write(body)
+
+        def _handle_action(self) -> None:
+            body = self.rfile.read(int(self.headers.get("Content-Length", "0")))
+            event = {
+                "requestContext": {"http": {"method": self.command}},
+                "body": body.decode("utf-8", errors="replace"),
+                "isBase64Encoded": False,
+            }
+            try:
+                with lock:
+                    response = lambda_handler(event, cast(LambdaContext, None))
+            except Exception:  # pylint: disable=broad-exception-caught
+                logger.exception("Request failed")
+                response = {"statusCode": 500, "body": json.dumps({"error": "Internal server error"})}
+            self._send(response["statusCode"], response.get("headers", {}), response.get("body", "").encode("utf-8"))
+
+        do_OPTIONS = _handle_action
+        do_POST = _handle_action
+
+        def do_GET(self) -> None:  # pylint: disable=invalid-name
+            """
+            Return a public object
+            """
+            path = urlsplit(self.path).path
+            if not path.startswith("/public/"):
+                self._send(404, {}, b"")
+                return
+            key = unquote(path.removeprefix("/public/"))
+            headers = {"Cache-Control": MUTABLE_CACHE_CONTROL, "Access-Control-Allow-Origin": "*"}
+            try:
+                body, etag = create_s3_client().get_object(
+                    PUBLIC_BUCKET_NAME, key, if_none_match=self.headers.get("If-None-Match")
+                )
+            except S3Error as e:
+                if e.code == "NotModified":
+                    self._send(304, headers | {"ETag": self.headers["If-None-Match"]}, b"")
+                else:
+                    self._send(404, headers, b"")
+                return
+            headers |= {"ETag": etag, "Content-Type": "application/json" if key.endswith(".json") else "text/plain"}
+            if body.startswith(b"\x1f\x8b"):  # The public objects are written gzip compressed
+                headers["Content-Encoding"] = "gzip"
+            self._send(200, headers, body)
+
+        do_HEAD = do_GET
+
+        def log_message(self, format: str, *args: Any) -> None:  # pylint: disable=redefined-builtin
+            logger.info(format, *args)
+
+    server = ThreadingHTTPServer((host, port), RequestHandler)
+    logger.warning(f"Serving on http://{host}:{server.server_port} using storage {STORAGE}")
+    server.serve_forever()
+
+
+def prewarm() -> None:
+    """
+    Create the S3 client and read data.json into DATA_CACHE before the first request.
+
+    Lambda imports the module in the INIT phase of a new instance, which runs with more CPU than the requests.
+    The first request then only revalidates data.json. A failure is logged and left to the first request.
+    """
+    try:
+        Backend()
+    except Exception:  # pylint: disable=broad-exception-caught
+        logger.exception("Prewarming failed")
+        forget_cached_data()
+
+
+def cli() -> None:
+    """
+    Command line interface for running the backend without Lambda
+    """
+    import argparse  # pylint: disable=import-outside-toplevel
+
+    parser = argparse.ArgumentParser(description="Run the backend without Lambda. See also the environment variables.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    serve_parser = subparsers.add_parser("serve", help="Serve the actions and the public objects over HTTP")
+    serve_parser.add_argument("--host", default="127.0.0.1")
+    serve_parser.add_argument("--port", type=int, default=8000)
+    serve_parser.add_argument("--log-level", default="WARNING", help="INFO logs every request like on Lambda")
+    subparsers.add_parser("describe-api", help="Print the actions with the JSON Schema of their requests")
+    args = parser.parse_args()
+
+    if args.command == "describe-api":
+        print(json.dumps(describe_api(), indent=2))
+        return
+    logging.basicConfig(format="%(asctime)s %(levelname)s %(message)s")
+    logger.setLevel(args.log_level)
+    serve(args.host, args.port)
+
+
+if PREWARM:
+    prewarm()
+
+if __name__ == "__main__":
+    cli()